@@ -0,0 +1,404 @@
+"""
+    Offline benchmark of the slot parsing and detection path
+
+    Runs the finder against a fake web driver serving synthetic pages, and recorded pages from
+    a fixtures directory, with every parser backend. Reports time and peak memory per cycle and
+    per date, checks that every backend finds the same dates, and fails when a measurement is
+    slower than the saved baseline by more than the tolerance.
+
+    python benchmark.py [--iterations N] [--fixtures DIR] [--baseline FILE] [--save-baseline]
+
+    With --imports it instead runs the config and history commands of main.py under
+    python -X importtime and fails when one imports the browser stack or goes over the budget.
+
+    python benchmark.py --imports [--import-budget MS]
+"""
+import os
+import sys
+import json
+import time
+import datetime
+import argparse
+import tempfile
+import subprocess
+import tracemalloc
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+from page_readiness import PageReadiness
+from slot_extraction import (EXTRACTION_SCRIPT, EXTRACTION_SOUP, DateSlots, SlotIndex,
+                             get_available_parsers)
+from slot_finder import AmazonSlotFinder
+
+DEFAULT_ITERATIONS = 3
+DEFAULT_TOLERANCE = 0.5 # Fraction a measurement can grow over the baseline before failing
+# Growth below these is timer and allocator noise, not a regression
+MIN_REGRESSION = {'cycle_ms': 1.0, 'peak_kb': 64.0}
+DEFAULT_BASELINE_FILE = 'benchmark_baseline.json'
+PAGE_PADDING_ELEMENTS = 1500 # Unrelated markup around the slot grid, real pages are a few hundred KB
+WINDOWS_PER_DATE = 12
+FIRST_PAGE_DATES = 4 # Dates loaded before the next button is clicked
+
+DEFAULT_IMPORT_BUDGET_MS = 60.0 # Imports of a config or history command, on top of the interpreter startup
+# Commands that only read the config file or the database
+IMPORT_CHECK_COMMANDS = [['-r'], ['-nu'], ['-dn', '1'], ['-so'], ['-sp']]
+# Top level packages of the browser, parser and notification stack
+SCANNING_PACKAGES = ('selenium', 'bs4', 'lxml', 'notify_run', 'requests', 'urllib3')
+
+
+class FakeNextButton:
+    """ The next button of the slot page, moves the fake driver to its next page """
+
+    def __init__(self, driver: 'FakeWebDriver'):
+        self.driver = driver
+
+    def click(self):
+        """ Shows the next page of dates """
+        self.driver.page_index = min(self.driver.page_index + 1, len(self.driver.pages) - 1)
+
+
+class FakeWebDriver:
+    """
+        Stand in for a selenium web driver that serves recorded or synthetic pages.
+
+        execute_script answers the scripts the finder runs from the parsed page, which is
+        computed once up front so it is not part of the measurements.
+    """
+
+    def __init__(self, pages: List[str], script_results: Optional[List[dict]] = None):
+        self.pages = pages
+        self.page_index = 0
+        self.refreshes = 0
+        self.current_url = AmazonSlotFinder.SLOT_PAGE_URL
+        self.script_results = script_results or get_script_results(pages)
+
+    @property
+    def page_source(self) -> str:
+        """ Source of the current page """
+        return self.pages[self.page_index]
+
+    def get(self, url: str): # pylint: disable=unused-argument
+        """ Opens the first page """
+        self.page_index = 0
+
+    def refresh(self):
+        """ Reloads the current page """
+        self.refreshes += 1
+
+    def quit(self):
+        """ Nothing to stop """
+
+    def get_cookies(self) -> List[dict]:
+        """ The fake session has no cookies """
+        return []
+
+    def find_element_by_xpath(self, xpath: str): # pylint: disable=unused-argument
+        """ Only the next button is ever looked up """
+        return FakeNextButton(self)
+
+    def execute_script(self, script: str, *args): # pylint: disable=unused-argument
+        """ Answers the slot extraction script, and the readiness script with the container ids """
+        result = self.script_results[self.page_index]
+        if 'box-group' in script:
+            return result
+        return [f'slot-container-{date}:{self.page_index}' for date in result]
+
+
+def get_script_results(pages: List[str]) -> List[dict]:
+    """ What SLOT_EXTRACTION_SCRIPT returns on every page """
+    return [{date: _to_script_result(slots) for date, slots in SlotIndex.from_html(page).dates.items()}
+            for page in pages]
+
+
+def _to_script_result(slots: DateSlots) -> dict:
+    """ The result SLOT_EXTRACTION_SCRIPT returns for a date """
+    windows = []
+    if slots.found and not slots.alert:
+        windows = [True] * (slots.window_count - slots.disabled_count) + [False] * slots.disabled_count
+    return {'found': slots.found, 'alert': slots.alert, 'windows': windows, 'disabled': slots.disabled_count,
+            'slots': [[window.delivery_type, window.enabled, window.label] for window in slots.windows]}
+
+
+class FakeSlotFinder(AmazonSlotFinder):
+    """ Finder on a fake driver, a replaced browser serves the same pages """
+
+    def create_driver(self):
+        """ A new fake driver on the same pages """
+        return FakeWebDriver(self.driver.pages, self.driver.script_results)
+
+
+class FakeClock:
+    """ Clock for the page readiness that moves forward when it sleeps """
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float):
+        """ Moves the clock instead of sleeping """
+        self.now += seconds
+
+
+def build_date_container(date: str, state: str, windows: int = WINDOWS_PER_DATE) -> str:
+    """ Markup of one date, state is one of alert, disabled or open """
+    if state == 'alert':
+        unattended = ('<div class="a-box a-alert a-alert-info"><div class="a-box-inner a-alert-container">'
+                      '<div class="a-alert-content">No delivery windows available</div></div></div>')
+    else:
+        slots = []
+        for index in range(windows):
+            disabled = state == 'disabled' or index % 3 != 1
+            box_class = 'disabledRadioBox' if disabled else 'a-radio'
+            slots.append(f'<div class="ufss-slot-container"><div class="{box_class}">'
+                         f'<label><input type="radio" name="slot-{date}"/>'
+                         f'<span class="ufss-slot-time-window-text">{8 + index}:00 - {9 + index}:00</span>'
+                         f'</label></div></div>')
+        unattended = f'<div id="root-{date}-UNATTENDED-box-group">{"".join(slots)}</div>'
+    return (f'<div id="slot-container-{date}" class="ufss-date-container">'
+            f'<div id="slot-container-ATTENDED"><div class="a-box a-alert a-alert-info">'
+            f'<div class="a-alert-content">Attended delivery is not available</div></div></div>'
+            f'<div id="slot-container-UNATTENDED">{unattended}</div></div>')
+
+
+def build_page(dates: List[Tuple[str, str]], padding: int = PAGE_PADDING_ELEMENTS,
+               windows: int = WINDOWS_PER_DATE) -> str:
+    """ A ship option page with the given (date, state) containers surrounded by unrelated markup """
+    filler = ''.join(f'<div class="a-row"><span class="a-size-base">Item {index}</span>'
+                     f'<a href="/dp/{index}">Details</a></div>' for index in range(padding))
+    containers = ''.join(build_date_container(date, state, windows) for date, state in dates)
+    return (f'<html><head><title>Select a delivery window</title></head><body>'
+            f'<div id="header">{filler}</div><div id="slot-grid">{containers}</div>'
+            f'<div id="footer">{filler}</div></body></html>')
+
+
+def get_dates(count: int) -> List[str]:
+    """ Consecutive dates from today, in the format of the container ids """
+    today = datetime.date.today()
+    return [(today + datetime.timedelta(days=day)).strftime(AmazonSlotFinder.DATE_FORMAT_STRING)
+            for day in range(count)]
+
+
+def build_paged_scenario(dates: List[Tuple[str, str]], windows: int = WINDOWS_PER_DATE,
+                         padding: int = PAGE_PADDING_ELEMENTS) -> List[str]:
+    """
+        The page that is opened first, with the first FIRST_PAGE_DATES dates, and the page
+        shown after clicking next, with every date
+    """
+    return [build_page(dates[:FIRST_PAGE_DATES], padding, windows), build_page(dates, padding, windows)]
+
+
+def build_synthetic_scenarios(padding: int = PAGE_PADDING_ELEMENTS) -> Dict[str, List[str]]:
+    """ The pages of every synthetic scenario """
+    dates = get_dates(24)
+    first = dates[:8]
+    return {
+        'all_disabled': build_paged_scenario([(date, 'disabled') for date in first], padding=padding),
+        'alert': build_paged_scenario([(date, 'alert') for date in first], padding=padding),
+        'partially_open': build_paged_scenario([(date, 'open' if index % 4 == 2 else 'disabled')
+                                                for index, date in enumerate(first)], padding=padding),
+        'large_grid': build_paged_scenario([(date, 'open' if index % 7 == 5 else 'disabled')
+                                            for index, date in enumerate(dates)], windows=24, padding=padding),
+    }
+
+
+def load_recorded_scenarios(directory: str) -> Dict[str, List[str]]:
+    """ Every .html file of the directory is a recorded page, shown both before and after next """
+    scenarios = {}
+    for entry in sorted(os.scandir(directory), key=lambda entry: entry.name):
+        if entry.name.endswith('.html'):
+            with open(entry.path, 'r', encoding='utf-8') as page:
+                source = page.read()
+            scenarios[f'recorded/{entry.name[:-5]}'] = [source, source]
+    return scenarios
+
+
+def get_backends() -> Dict[str, dict]:
+    """ The finder settings to compare, the first one is the reference """
+    backends = {}
+    for parser in get_available_parsers():
+        backends[parser] = {'parser': parser}
+        backends[f'{parser}+strainer'] = {'parser': parser, 'strain': True}
+        backends[f'{parser}+incremental'] = {'parser': parser, 'incremental': True}
+    backends['script'] = {'extraction': EXTRACTION_SCRIPT}
+    return backends
+
+
+def create_finder(pages: List[str], script_results: List[dict], settings: dict) -> AmazonSlotFinder:
+    """ A logged in finder on a fake driver that never sleeps """
+    clock = FakeClock()
+    readiness = PageReadiness(clock=clock, sleep=clock.sleep)
+    finder = FakeSlotFinder(FakeWebDriver(pages, script_results), readiness=readiness,
+                            extraction=settings.get('extraction', EXTRACTION_SOUP),
+                            parser=settings.get('parser', 'html.parser'),
+                            strain=settings.get('strain', False),
+                            incremental=settings.get('incremental', False))
+    finder.logged_in = True
+    date_range = sorted(script_results[-1]) or get_dates(8)
+    finder.get_date_range = lambda: date_range # type: ignore
+    return finder
+
+
+def measure(cycle: Callable[[], List[str]], iterations: int) -> Tuple[List[str], float, float]:
+    """ Returns the result of the cycle, its best time in seconds and its peak memory in bytes """
+    result = cycle() # Warm up, also primes the incremental cache the way a running loop would
+    best = float('inf')
+    for _ in range(iterations):
+        start = time.perf_counter()
+        cycle()
+        best = min(best, time.perf_counter() - start)
+    tracemalloc.start()
+    cycle()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, best, peak
+
+
+def run_benchmarks(scenarios: Dict[str, List[str]], iterations: int) -> Tuple[Dict[str, dict], List[str]]:
+    """ Measures every backend on every scenario, returns the measurements and the mismatches """
+    results: Dict[str, dict] = {}
+    mismatches = []
+    for scenario, pages in scenarios.items():
+        reference = None
+        script_results = get_script_results(pages)
+        for backend, settings in get_backends().items():
+            finder = create_finder(pages, script_results, settings)
+
+            def cycle(finder=finder):
+                finder.driver.page_index = 0
+                return finder.get_available_dates()
+
+            available_dates, seconds, peak = measure(cycle, iterations)
+            if reference is None:
+                reference = available_dates
+            elif available_dates != reference:
+                mismatches.append(f'{scenario} {backend}: {available_dates} != {reference}')
+            date_count = max(1, len(finder.get_date_range()))
+            results[f'{scenario} {backend}'] = {
+                'cycle_ms': seconds * 1000,
+                'date_ms': seconds * 1000 / date_count,
+                'peak_kb': peak / 1024,
+            }
+    return results, mismatches
+
+
+def find_regressions(results: Dict[str, dict], baseline: Dict[str, dict], tolerance: float) -> List[str]:
+    """ The measurements that grew over the baseline by more than the tolerance """
+    regressions = []
+    for name, measurement in results.items():
+        for key in ('cycle_ms', 'peak_kb'):
+            previous = baseline.get(name, {}).get(key)
+            if (previous and measurement[key] > previous * (1 + tolerance)
+                    and measurement[key] - previous > MIN_REGRESSION[key]):
+                regressions.append(f'{name} {key}: {measurement[key]:.2f} > {previous:.2f}')
+    return regressions
+
+
+def print_results(results: Dict[str, dict]):
+    """ Table of the measurements """
+    print(f'{"scenario / backend":<45} {"cycle ms":>10} {"date ms":>10} {"peak KB":>10}')
+    for name, measurement in results.items():
+        print(f'{name:<45} {measurement["cycle_ms"]:>10.2f} {measurement["date_ms"]:>10.3f} '
+              f'{measurement["peak_kb"]:>10.0f}')
+
+
+def get_import_times(stderr: str) -> Dict[str, int]:
+    """ Cumulative import time in microseconds of every top level import in the -X importtime output """
+    times = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        parts = line[len('import time:'):].split('|')
+        if len(parts) != 3 or parts[2].startswith('  ') or not parts[1].strip().isdigit():
+            continue # Header or a nested import, already counted in its parent
+        times[parts[2].strip()] = int(parts[1])
+    return times
+
+
+def run_with_import_times(arguments: List[str], home: str) -> Tuple[Dict[str, int], str]:
+    """ Runs python -X importtime with the arguments in an empty home, returns the top level imports and stderr """
+    environment = {key: value for key, value in os.environ.items() if not key.startswith('XDG_')}
+    environment['HOME'] = home
+    completed = subprocess.run([sys.executable, '-X', 'importtime'] + arguments, env=environment,
+                               cwd=os.path.dirname(os.path.abspath(__file__)), stdin=subprocess.DEVNULL,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, check=False)
+    return get_import_times(completed.stderr), completed.stderr
+
+
+def get_imported_packages(stderr: str) -> Set[str]:
+    """ Top level package of every module in the -X importtime output """
+    return {line.split('|')[2].strip().split('.')[0] for line in stderr.splitlines()
+            if line.startswith('import time:') and line.count('|') == 2}
+
+
+def get_command_import_ms(arguments: List[str], home: str, startup: Dict[str, int]) -> Tuple[float, Set[str]]:
+    """
+        Import time in milliseconds of main.py with the arguments, without the imports of the
+        interpreter startup, and the top level packages it imported
+    """
+    times, stderr = run_with_import_times(['main.py'] + arguments, home)
+    total_ms = sum(cumulative for name, cumulative in times.items() if name not in startup) / 1000
+    return total_ms, get_imported_packages(stderr)
+
+
+def check_import_budget(budget_ms: float) -> List[str]:
+    """ Runs every config and history command, returns the commands over budget or importing the browser stack """
+    failures = []
+    with tempfile.TemporaryDirectory() as home:
+        startup, _ = run_with_import_times(['-c', 'pass'], home)
+        for command in IMPORT_CHECK_COMMANDS:
+            total_ms, imported = get_command_import_ms(command, home, startup)
+            print(f'{" ".join(command):<10} {total_ms:>8.1f} ms')
+            scanning = sorted(imported.intersection(SCANNING_PACKAGES))
+            if scanning:
+                failures.append(f'{" ".join(command)} imports {", ".join(scanning)}')
+            if total_ms > budget_ms:
+                failures.append(f'{" ".join(command)} imports take {total_ms:.1f} ms > {budget_ms:.1f} ms')
+    return failures
+
+
+def main(argv) -> int:
+    """ Benchmark entry point, returns the exit code """
+    parser = argparse.ArgumentParser(description='Benchmark the slot parsing and detection path offline')
+    parser.add_argument("-i", "--iterations", help="Timed cycles per measurement", type=int, default=DEFAULT_ITERATIONS)
+    parser.add_argument("-f", "--fixtures", help="Directory of recorded ship option pages (.html)", type=str)
+    parser.add_argument("-b", "--baseline", help="Baseline file to compare with", type=str, default=DEFAULT_BASELINE_FILE)
+    parser.add_argument("-s", "--save-baseline", help="Save the measurements as the new baseline", action="store_true")
+    parser.add_argument("-t", "--tolerance", help="Allowed growth over the baseline, 0.5 is 50%%", type=float, default=DEFAULT_TOLERANCE)
+    parser.add_argument("-m", "--imports", help="Check the import time of the config and history commands instead", action="store_true")
+    parser.add_argument("--import-budget", help="Allowed import time of a command in milliseconds", type=float, default=DEFAULT_IMPORT_BUDGET_MS)
+    args = parser.parse_args(argv)
+
+    if args.imports:
+        failures = check_import_budget(args.import_budget)
+        for failure in failures:
+            print(f'IMPORTS {failure}')
+        return 1 if failures else 0
+
+    scenarios = build_synthetic_scenarios()
+    if args.fixtures:
+        scenarios.update(load_recorded_scenarios(args.fixtures))
+
+    results, mismatches = run_benchmarks(scenarios, args.iterations)
+    print_results(results)
+
+    failed = False
+    for mismatch in mismatches:
+        print(f'MISMATCH {mismatch}')
+        failed = True
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as baseline_file:
+            json.dump(results, baseline_file, indent=2, sort_keys=True)
+        print(f'Saved baseline to {args.baseline}')
+    elif os.path.exists(args.baseline):
+        with open(args.baseline, 'r') as baseline_file:
+            regressions = find_regressions(results, json.load(baseline_file), args.tolerance)
+        for regression in regressions:
+            print(f'REGRESSION {regression}')
+            failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,298 @@
+"""
+    Local control API of the daemon: status, last results, history, pause and resume, forced checks
+    and the refresh interval, served as JSON over a Unix socket or a localhost port
+"""
+import os
+import json
+import errno
+import time
+import socket
+import logging
+import threading
+import http.client
+import socketserver
+from http.server import BaseHTTPRequestHandler, HTTPServer, ThreadingHTTPServer
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, urlencode, urlparse
+
+from database import UserConfiguration
+from memory_usage import get_rss_bytes
+from polling_scheduler import FixedPolicy
+
+if TYPE_CHECKING:
+    from finder_pool import FinderPool
+    from notifications import NotificationOutbox
+
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_CONTROL_PORT = 8790 # Used where Unix sockets are not available
+DEFAULT_HISTORY_HOURS = 24
+DEFAULT_HISTORY_LIMIT = 20
+REQUEST_TIMEOUT_SECONDS = 10
+
+
+class ControlError(Exception):
+    """ A control request that cannot be served, with the HTTP status to answer """
+
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+def get_control_address(user_configuration: UserConfiguration) -> Tuple[Optional[int], Optional[str]]:
+    """ The port, or else the socket path, the control API is served on """
+    port = user_configuration.get_control_port()
+    if port or not hasattr(socket, 'AF_UNIX'):
+        return port or DEFAULT_CONTROL_PORT, None
+    return None, user_configuration.get_control_socket()
+
+
+class ControlApi:
+    """
+        Answers the control requests, whatever the transport.
+
+        Changes go to the running pool, which applies them on its scheduling thread, and are
+        persisted in the config file so a restart keeps them. The config file is not read again
+        by the daemon, changes made by hand apply on the next start.
+    """
+
+    def __init__(self, pool: 'FinderPool', user_configuration: UserConfiguration, policy,
+                 outbox: Optional['NotificationOutbox'] = None):
+        self.pool = pool
+        self.user_configuration = user_configuration
+        self.policy = policy
+        self.outbox = outbox
+        self.started_at = time.time()
+        self.routes: Dict[Tuple[str, str], Callable[[dict], dict]] = {
+            ('GET', '/status'): self.get_status,
+            ('GET', '/results'): self.get_results,
+            ('GET', '/history'): self.get_history,
+            ('POST', '/pause'): self.pause,
+            ('POST', '/resume'): self.resume,
+            ('POST', '/check'): self.check,
+            ('POST', '/interval'): self.set_interval,
+            ('POST', '/notification-url'): self.set_notification_url,
+        }
+
+    def handle(self, method: str, path: str, arguments: dict) -> dict:
+        """ Runs the route of the request with the query string or body arguments """
+        route = self.routes.get((method, path))
+        if route is None:
+            if any(route_path == path for _, route_path in self.routes):
+                raise ControlError(405, f'{method} is not allowed on {path}')
+            raise ControlError(404, f'Unknown path {path}')
+        return route(arguments)
+
+    def _get_names(self, arguments: dict, action: Callable[[Optional[str]], List[str]]) -> dict:
+        try:
+            return {'accounts': action(arguments.get('account') or None)}
+        except KeyError as error:
+            raise ControlError(404, f'Unknown account {error.args[0]}')
+
+    def get_status(self, arguments: dict) -> dict: # pylint: disable=unused-argument
+        """ The state of the daemon and of every account """
+        refresh_seconds = None
+        if isinstance(self.policy, FixedPolicy):
+            refresh_seconds = self.policy.refresh_seconds()
+        return {'started_at': self.started_at, 'policy': type(self.policy).__name__,
+                'refresh_seconds': refresh_seconds, 'python_rss_bytes': get_rss_bytes(),
+                'accounts': self.pool.get_status()}
+
+    def get_results(self, arguments: dict) -> dict: # pylint: disable=unused-argument
+        """ The last result and error of every account """
+        return {'results': dict(self.pool.last_results), 'errors': dict(self.pool.last_errors)}
+
+    def get_history(self, arguments: dict) -> dict:
+        """ The recorded checks of the last hours and the last notifications """
+        try:
+            hours = float(arguments.get('hours', DEFAULT_HISTORY_HOURS))
+            limit = int(arguments.get('limit', DEFAULT_HISTORY_LIMIT))
+        except ValueError as error:
+            raise ControlError(400, str(error))
+        history = self.user_configuration.slot_history
+        accounts = [arguments['account']] if arguments.get('account') else history.get_accounts()
+        since = time.time() - hours * 3600
+        checks = {account: [{'checked_at': checked_at, 'duration_ms': duration_ms, 'open_dates': open_dates}
+                            for _, checked_at, duration_ms, open_dates in history.iter_checks(account, since)]
+                  for account in accounts}
+        notifications = [{'sent_at': sent_at, 'message': message}
+                         for sent_at, message in self.user_configuration.iter_notifications(limit)]
+        return {'checks': checks, 'notifications': notifications}
+
+    def pause(self, arguments: dict) -> dict:
+        """ Pauses one account, or every account """
+        return self._get_names(arguments, self.pool.pause)
+
+    def resume(self, arguments: dict) -> dict:
+        """ Resumes one account, or every account """
+        return self._get_names(arguments, self.pool.resume)
+
+    def check(self, arguments: dict) -> dict:
+        """ Checks one account, or every account, right away """
+        return self._get_names(arguments, self.pool.check_now)
+
+    def set_interval(self, arguments: dict) -> dict:
+        """ Changes the refresh interval of the fixed policy, live and in the config file """
+        if not isinstance(self.policy, FixedPolicy):
+            raise ControlError(409, 'The adaptive policy picks its own intervals, change the polling settings instead')
+        try:
+            seconds = int(arguments['seconds'])
+        except (KeyError, TypeError, ValueError):
+            raise ControlError(400, 'The interval needs a number of seconds')
+        if seconds < UserConfiguration.DEFAULT_SLEEP_TIME_SECONDS:
+            raise ControlError(400, f'The interval cannot be less than {UserConfiguration.DEFAULT_SLEEP_TIME_SECONDS} seconds')
+
+        self.policy.set_refresh_seconds(seconds)
+        self.pool.pull_in(seconds)
+        self.user_configuration.set_refresh_time_seconds(seconds)
+        LOGGER.info('Refresh interval set to %s seconds', seconds)
+        return {'refresh_seconds': seconds}
+
+    def set_notification_url(self, arguments: dict) -> dict:
+        """ Changes the notification subscription url """
+        url = arguments.get('url')
+        if not url:
+            raise ControlError(400, 'The notification url is missing')
+        self.user_configuration.set_notification_subscription(url)
+        if self.outbox:
+            self.outbox.wake_up.set() # The queued messages can be sent now
+        return {'url': url}
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """ HTTP server on a Unix socket, one thread per request """
+
+    daemon_threads = True
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            if is_listening(self.server_address):
+                raise OSError(errno.EADDRINUSE, f'Another daemon is serving the control API on {self.server_address}')
+            os.unlink(self.server_address) # Left behind by a daemon that did not stop cleanly
+        # Created with its final permissions, only the user running the daemon can control it
+        umask = os.umask(0o077)
+        try:
+            socketserver.UnixStreamServer.server_bind(self)
+        finally:
+            os.umask(umask)
+
+
+def is_listening(socket_path: str) -> bool:
+    """ True when a server accepts connections on the socket path """
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.settimeout(REQUEST_TIMEOUT_SECONDS)
+    try:
+        client.connect(socket_path)
+    except OSError:
+        return False
+    finally:
+        client.close()
+    return True
+
+
+def _create_handler(api: ControlApi):
+
+    class ControlHandler(BaseHTTPRequestHandler):
+        """ Maps the requests onto the control API """
+
+        def _serve(self, method: str):
+            url = urlparse(self.path)
+            arguments = {key: values[-1] for key, values in parse_qs(url.query).items()}
+            try:
+                length = int(self.headers.get('Content-Length') or 0)
+                if length:
+                    body = json.loads(self.rfile.read(length))
+                    if not isinstance(body, dict):
+                        raise ControlError(400, 'The body must be a JSON object')
+                    arguments.update(body)
+                status, response = 200, api.handle(method, url.path.rstrip('/') or '/', arguments)
+            except ControlError as error:
+                status, response = error.status, {'error': str(error)}
+            except ValueError as error:
+                status, response = 400, {'error': f'Invalid request: {error}'}
+            except Exception as error: # pylint: disable=broad-except
+                LOGGER.exception('Control request %s %s failed', method, self.path)
+                status, response = 500, {'error': str(error)}
+
+            body = json.dumps(response).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self): # pylint: disable=invalid-name
+            """ Read only requests """
+            self._serve('GET')
+
+        def do_POST(self): # pylint: disable=invalid-name
+            """ Requests that change the daemon """
+            self._serve('POST')
+
+        def address_string(self) -> str:
+            return self.client_address[0] if self.client_address else 'local'
+
+        def log_message(self, format, *args): # pylint: disable=redefined-builtin
+            LOGGER.debug('Control request: ' + format, *args)
+
+    return ControlHandler
+
+
+def serve(api: ControlApi, port: Optional[int] = None, socket_path: Optional[str] = None,
+          host: str = '127.0.0.1') -> HTTPServer:
+    """ Serves the control API from a background thread, on the socket path or else the local port """
+    server: socketserver.BaseServer
+    if socket_path:
+        server = UnixHTTPServer(socket_path, _create_handler(api))
+        location = socket_path
+    else:
+        server = ThreadingHTTPServer((host, port or DEFAULT_CONTROL_PORT), _create_handler(api))
+        location = f'http://{host}:{server.server_address[1]}'
+    threading.Thread(target=server.serve_forever, name='control-server', daemon=True).start()
+    LOGGER.info('Serving the control API on %s', location)
+    return server
+
+
+def close(server: socketserver.BaseServer):
+    """ Stops the control server and removes its socket """
+    server.shutdown()
+    server.server_close()
+    if isinstance(server, UnixHTTPServer) and os.path.exists(server.server_address):
+        os.unlink(server.server_address)
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """ HTTP connection over a Unix socket """
+
+    def __init__(self, socket_path: str, timeout: float = REQUEST_TIMEOUT_SECONDS):
+        super().__init__('localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+def send_request(method: str, path: str, arguments: Optional[dict] = None, port: Optional[int] = None,
+                 socket_path: Optional[str] = None) -> Tuple[int, dict]:
+    """
+        Sends a request to the control API of a running daemon, returns the status and the JSON answer.
+        The arguments go in the query string of a GET and in the JSON body of a POST.
+    """
+    if method == 'GET' and arguments:
+        path, arguments = f'{path}?{urlencode(arguments)}', None
+    connection: http.client.HTTPConnection
+    if socket_path:
+        connection = UnixHTTPConnection(socket_path)
+    else:
+        connection = http.client.HTTPConnection('127.0.0.1', port or DEFAULT_CONTROL_PORT,
+                                                timeout=REQUEST_TIMEOUT_SECONDS)
+    try:
+        body = json.dumps(arguments).encode('utf-8') if arguments is not None else None
+        headers = {'Content-Type': 'application/json'} if body is not None else {}
+        connection.request(method, path, body=body, headers=headers)
+        response = connection.getresponse()
+        return response.status, json.loads(response.read() or b'{}')
+    finally:
+        connection.close()
@@ -0,0 +1,418 @@
+"""
+    Coordination of several instances monitoring the same accounts: one instance polls an account
+    at a time under a lease, the others stand by with their browser logged in and take over when
+    the lease is not renewed. Results and sent notifications are shared so nothing is sent twice.
+"""
+import os
+import json
+import time
+import uuid
+import socket
+import logging
+import threading
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+from database import DatabaseConnection
+from metrics import METRICS
+
+LOGGER = logging.getLogger(__name__)
+
+BACKEND_SQLITE = 'sqlite'
+BACKEND_REDIS = 'redis'
+BACKENDS = [BACKEND_SQLITE, BACKEND_REDIS]
+
+DEFAULT_LEASE_SECONDS = 30
+CLAIM_RETENTION_SECONDS = 7 * 86400 # Sent notifications are remembered this long
+
+# Answers to a notification claim
+CLAIM_GRANTED = 'granted' # Send it
+CLAIM_SENT = 'sent' # Another instance sent it
+CLAIM_BUSY = 'busy' # Another instance is sending it, try again once its claim expires
+
+
+def get_instance_id() -> str:
+    """ Identifies this process among the instances, readable in the logs and the status """
+    return f'{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}'
+
+
+class CoordinationBackend:
+    """
+        The store shared by the instances. Every operation is atomic in the store, the instances
+        do not need to trust each other's clocks beyond the length of a lease.
+    """
+
+    def acquire(self, account: str, owner: str, lease_seconds: float, now: float) -> bool:
+        """ Takes or renews the lease of the account, True when the owner holds it until now + lease_seconds """
+        raise NotImplementedError
+
+    def release(self, account: str, owner: str):
+        """ Gives up the lease of the account if the owner holds it """
+        raise NotImplementedError
+
+    def get_leases(self, now: float) -> Dict[str, Tuple[str, float]]:
+        """ The owner and expiry of every lease that has not expired """
+        raise NotImplementedError
+
+    def publish_result(self, account: str, owner: str, result: dict, now: float) -> bool:
+        """ Stores the last result of the account, only while the owner holds its lease """
+        raise NotImplementedError
+
+    def get_result(self, account: str) -> Optional[dict]:
+        """ The last result published for the account, None when there is none """
+        raise NotImplementedError
+
+    def claim_notification(self, key: str, owner: str, claim_seconds: float, now: float) -> str:
+        """
+            Claims the sending of the notification with the idempotency key: CLAIM_GRANTED, CLAIM_SENT
+            when it was sent already or CLAIM_BUSY when another instance claimed it less than
+            claim_seconds ago
+        """
+        raise NotImplementedError
+
+    def confirm_notification(self, key: str, now: float):
+        """ Records that the claimed notification was sent """
+        raise NotImplementedError
+
+    def cleanup(self, now: float):
+        """ Forgets the expired leases and the old notifications """
+
+    def close(self):
+        """ Closes the connection to the store """
+
+
+class SharedDatabaseConnection(DatabaseConnection):
+    """ A connection to a database file several machines may open, which rules out the WAL """
+
+    PRAGMAS = [
+        'PRAGMA journal_mode = DELETE',
+        'PRAGMA synchronous = FULL',
+        'PRAGMA busy_timeout = 5000',
+    ]
+
+
+class SqliteCoordinationBackend(CoordinationBackend):
+    """ Coordination through a SQLite file every instance can open, on one host or a shared file system """
+
+    CREATE_TABLES = [
+        '''
+        CREATE TABLE IF NOT EXISTS leases (
+            account TEXT PRIMARY KEY,
+            owner TEXT NOT NULL,
+            acquired_at REAL NOT NULL,
+            expires_at REAL NOT NULL
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS results (
+            account TEXT PRIMARY KEY,
+            owner TEXT NOT NULL,
+            result TEXT NOT NULL
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS notification_claims (
+            idempotency_key TEXT PRIMARY KEY,
+            owner TEXT NOT NULL,
+            claimed_at REAL NOT NULL,
+            sent_at REAL
+        )
+        ''',
+    ]
+
+    # Taken when the lease is free, expired or already held by the owner
+    ACQUIRE_LEASE = '''
+        INSERT INTO leases (account, owner, acquired_at, expires_at) VALUES (?, ?, ?, ?)
+        ON CONFLICT(account) DO UPDATE SET
+            acquired_at = CASE WHEN leases.owner = excluded.owner THEN leases.acquired_at ELSE excluded.acquired_at END,
+            owner = excluded.owner, expires_at = excluded.expires_at
+        WHERE leases.owner = excluded.owner OR leases.expires_at <= ?
+    '''
+
+    RELEASE_LEASE = 'DELETE FROM leases WHERE account = ? AND owner = ?'
+
+    GET_LEASES = 'SELECT account, owner, expires_at FROM leases WHERE expires_at > ?'
+
+    HOLDS_LEASE = 'SELECT 1 FROM leases WHERE account = ? AND owner = ? AND expires_at > ?'
+
+    SET_RESULT = 'INSERT OR REPLACE INTO results (account, owner, result) VALUES (?, ?, ?)'
+
+    GET_RESULT = 'SELECT result FROM results WHERE account = ?'
+
+    CLAIM_NOTIFICATION = '''
+        INSERT INTO notification_claims (idempotency_key, owner, claimed_at) VALUES (?, ?, ?)
+        ON CONFLICT(idempotency_key) DO UPDATE SET owner = excluded.owner, claimed_at = excluded.claimed_at
+        WHERE notification_claims.sent_at IS NULL
+            AND (notification_claims.owner = excluded.owner OR notification_claims.claimed_at <= ?)
+    '''
+
+    GET_CLAIM_SENT_AT = 'SELECT sent_at FROM notification_claims WHERE idempotency_key = ?'
+
+    CONFIRM_NOTIFICATION = 'UPDATE notification_claims SET sent_at = ? WHERE idempotency_key = ?'
+
+    DELETE_EXPIRED_LEASES = 'DELETE FROM leases WHERE expires_at <= ?'
+
+    DELETE_OLD_CLAIMS = 'DELETE FROM notification_claims WHERE claimed_at <= ?'
+
+    def __init__(self, path: str):
+        self.database = SharedDatabaseConnection(path)
+        with self.database.transaction() as connection:
+            for statement in self.CREATE_TABLES:
+                connection.execute(statement)
+
+    def acquire(self, account: str, owner: str, lease_seconds: float, now: float) -> bool:
+        cursor = self.database.execute(self.ACQUIRE_LEASE, (account, owner, now, now + lease_seconds, now))
+        return cursor.rowcount > 0
+
+    def release(self, account: str, owner: str):
+        self.database.execute(self.RELEASE_LEASE, (account, owner))
+
+    def get_leases(self, now: float) -> Dict[str, Tuple[str, float]]:
+        return {account: (owner, expires_at)
+                for account, owner, expires_at in self.database.execute(self.GET_LEASES, (now,)).fetchall()}
+
+    def publish_result(self, account: str, owner: str, result: dict, now: float) -> bool:
+        with self.database.transaction() as connection:
+            if connection.execute(self.HOLDS_LEASE, (account, owner, now)).fetchone() is None:
+                return False
+            connection.execute(self.SET_RESULT, (account, owner, json.dumps(result)))
+        return True
+
+    def get_result(self, account: str) -> Optional[dict]:
+        row = self.database.execute(self.GET_RESULT, (account,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def claim_notification(self, key: str, owner: str, claim_seconds: float, now: float) -> str:
+        with self.database.transaction() as connection:
+            if connection.execute(self.CLAIM_NOTIFICATION, (key, owner, now, now - claim_seconds)).rowcount:
+                return CLAIM_GRANTED
+            sent_at = connection.execute(self.GET_CLAIM_SENT_AT, (key,)).fetchone()[0]
+        return CLAIM_SENT if sent_at is not None else CLAIM_BUSY
+
+    def confirm_notification(self, key: str, now: float):
+        self.database.execute(self.CONFIRM_NOTIFICATION, (now, key))
+
+    def cleanup(self, now: float):
+        with self.database.transaction() as connection:
+            connection.execute(self.DELETE_EXPIRED_LEASES, (now,))
+            connection.execute(self.DELETE_OLD_CLAIMS, (now - CLAIM_RETENTION_SECONDS,))
+
+    def close(self):
+        self.database.close()
+
+
+class RedisCoordinationBackend(CoordinationBackend):
+    """
+        Coordination through Redis, for instances that share no file system. The compare and set
+        operations run as Lua scripts so they are atomic in the server. Redis keeps the time of
+        the leases itself, the clocks of the instances are not used.
+    """
+
+    KEY_PREFIX = 'slot_finder:'
+    SENT = '\x00sent' # Value of a notification claim once it was sent, never an owner id
+
+    # KEYS[1] lease, ARGV owner and lease milliseconds
+    ACQUIRE_SCRIPT = '''
+        local owner = redis.call('GET', KEYS[1])
+        if owner == false or owner == ARGV[1] then
+            redis.call('SET', KEYS[1], ARGV[1], 'PX', ARGV[2])
+            return 1
+        end
+        return 0
+    '''
+
+    RELEASE_SCRIPT = '''
+        if redis.call('GET', KEYS[1]) == ARGV[1] then
+            return redis.call('DEL', KEYS[1])
+        end
+        return 0
+    '''
+
+    # KEYS[1] lease and KEYS[2] result, ARGV owner and result
+    PUBLISH_SCRIPT = '''
+        if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+            return 0
+        end
+        redis.call('SET', KEYS[2], ARGV[2])
+        return 1
+    '''
+
+    # KEYS[1] claim, ARGV owner, claim milliseconds and sent marker. 1 granted, 0 sent and 2 busy
+    CLAIM_SCRIPT = '''
+        local claim = redis.call('GET', KEYS[1])
+        if claim == ARGV[3] then
+            return 0
+        end
+        if claim ~= false and claim ~= ARGV[1] then
+            return 2
+        end
+        redis.call('SET', KEYS[1], ARGV[1], 'PX', ARGV[2])
+        return 1
+    '''
+    CLAIM_STATES = {0: CLAIM_SENT, 1: CLAIM_GRANTED, 2: CLAIM_BUSY}
+
+    def __init__(self, url: str):
+        try:
+            import redis  # pylint: disable=import-outside-toplevel
+        except ImportError:
+            raise ValueError('The redis coordination backend needs the redis package, pip install redis')
+        self.client = redis.Redis.from_url(url, decode_responses=True)
+        self.acquire_script = self.client.register_script(self.ACQUIRE_SCRIPT)
+        self.release_script = self.client.register_script(self.RELEASE_SCRIPT)
+        self.publish_script = self.client.register_script(self.PUBLISH_SCRIPT)
+        self.claim_script = self.client.register_script(self.CLAIM_SCRIPT)
+
+    def _key(self, kind: str, name: str) -> str:
+        return f'{self.KEY_PREFIX}{kind}:{name}'
+
+    def acquire(self, account: str, owner: str, lease_seconds: float, now: float) -> bool:
+        return bool(self.acquire_script(keys=[self._key('lease', account)],
+                                        args=[owner, int(lease_seconds * 1000)]))
+
+    def release(self, account: str, owner: str):
+        self.release_script(keys=[self._key('lease', account)], args=[owner])
+
+    def get_leases(self, now: float) -> Dict[str, Tuple[str, float]]:
+        leases = {}
+        prefix = self._key('lease', '')
+        for key in self.client.scan_iter(match=prefix + '*'):
+            owner = self.client.get(key)
+            milliseconds = self.client.pttl(key)
+            if owner is not None and milliseconds > 0:
+                leases[key[len(prefix):]] = (owner, now + milliseconds / 1000)
+        return leases
+
+    def publish_result(self, account: str, owner: str, result: dict, now: float) -> bool:
+        return bool(self.publish_script(keys=[self._key('lease', account), self._key('result', account)],
+                                        args=[owner, json.dumps(result)]))
+
+    def get_result(self, account: str) -> Optional[dict]:
+        result = self.client.get(self._key('result', account))
+        return json.loads(result) if result else None
+
+    def claim_notification(self, key: str, owner: str, claim_seconds: float, now: float) -> str:
+        return self.CLAIM_STATES[int(self.claim_script(keys=[self._key('claim', key)],
+                                                       args=[owner, int(claim_seconds * 1000), self.SENT]))]
+
+    def confirm_notification(self, key: str, now: float):
+        self.client.set(self._key('claim', key), self.SENT, ex=CLAIM_RETENTION_SECONDS)
+
+    def close(self):
+        self.client.close()
+
+
+def create_backend(settings: dict) -> CoordinationBackend:
+    """ Creates the backend of the coordination section of the config file """
+    backend = settings.get('backend', BACKEND_SQLITE)
+    if backend == BACKEND_SQLITE:
+        if not settings.get('path'):
+            raise ValueError('The sqlite coordination backend needs the path of the shared database')
+        return SqliteCoordinationBackend(settings['path'])
+    if backend == BACKEND_REDIS:
+        return RedisCoordinationBackend(settings.get('url', 'redis://localhost:6379/0'))
+    raise ValueError(f'Unknown coordination backend {backend}, use one of {", ".join(BACKENDS)}')
+
+
+class Coordinator:
+    """
+        The leases and the shared store as seen by one instance.
+
+        A lease lasts lease_seconds and is renewed by a heartbeat thread every third of it, so a
+        holder that dies or loses the store is replaced within lease_seconds plus retry_seconds.
+        A notification claim that was not confirmed within lease_seconds can be taken over too.
+    """
+
+    def __init__(self, backend: CoordinationBackend, lease_seconds: float = DEFAULT_LEASE_SECONDS,
+                 owner: Optional[str] = None, clock: Callable[[], float] = time.time):
+        self.backend = backend
+        self.lease_seconds = lease_seconds
+        self.retry_seconds = lease_seconds / 2 # How often a standby instance tries to take a lease
+        self.owner = owner or get_instance_id()
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.held: Set[str] = set()
+        self.stopping = threading.Event()
+        self.heartbeat: Optional[threading.Thread] = None
+
+    def acquire(self, account: str) -> bool:
+        """ True when this instance holds the lease of the account and should poll it """
+        try:
+            acquired = self.backend.acquire(account, self.owner, self.lease_seconds, self.clock())
+        except Exception as error: # pylint: disable=broad-except
+            # Without the store nobody can be sure to hold the lease, standing by is the safe side
+            LOGGER.warning('Could not reach the coordination store: %s', error)
+            acquired = False
+        with self.lock:
+            if acquired and account not in self.held:
+                LOGGER.info('Took the lease of %s as %s', account, self.owner)
+                METRICS.increment('lease_acquisitions_total', account=account)
+                self.held.add(account)
+            elif not acquired and account in self.held:
+                LOGGER.warning('Lost the lease of %s', account)
+                self.held.discard(account)
+        METRICS.set_gauge('lease_held', int(acquired), account=account)
+        return acquired
+
+    def release(self, account: str):
+        """ Gives the account to the other instances right away """
+        with self.lock:
+            if account not in self.held:
+                return
+            self.held.discard(account)
+        METRICS.set_gauge('lease_held', 0, account=account)
+        try:
+            self.backend.release(account, self.owner)
+        except Exception as error: # pylint: disable=broad-except
+            LOGGER.warning('Could not release the lease of %s, it expires on its own: %s', account, error)
+
+    def holds(self, account: str) -> bool:
+        """ True when this instance held the lease at its last renewal """
+        with self.lock:
+            return account in self.held
+
+    def publish_result(self, account: str, available_dates: List[str]) -> bool:
+        """ Shares the result of a check, False when the lease was lost and the result must be dropped """
+        now = self.clock()
+        return self.backend.publish_result(account, self.owner, {
+            'owner': self.owner, 'checked_at': now, 'available_dates': list(available_dates)}, now)
+
+    def get_result(self, account: str) -> Optional[dict]:
+        """ The last result of the account, whichever instance made it """
+        return self.backend.get_result(account)
+
+    def claim_notification(self, key: str) -> str:
+        """ Whether this instance should send the notification, CLAIM_GRANTED, CLAIM_SENT or CLAIM_BUSY """
+        return self.backend.claim_notification(key, self.owner, self.lease_seconds, self.clock())
+
+    def confirm_notification(self, key: str):
+        """ Marks the notification as sent for every instance """
+        self.backend.confirm_notification(key, self.clock())
+
+    def _renew(self):
+        while not self.stopping.wait(self.lease_seconds / 3):
+            with self.lock:
+                held = list(self.held)
+            for account in held:
+                self.acquire(account)
+            try:
+                self.backend.cleanup(self.clock())
+            except Exception as error: # pylint: disable=broad-except
+                LOGGER.debug('Could not clean up the coordination store: %s', error)
+
+    def start(self):
+        """ Starts the heartbeat that renews the leases """
+        if self.heartbeat is None:
+            self.stopping.clear()
+            self.heartbeat = threading.Thread(target=self._renew, name='coordination-heartbeat', daemon=True)
+            self.heartbeat.start()
+
+    def stop(self):
+        """ Stops the heartbeat and hands the leases over """
+        if self.heartbeat is not None:
+            self.stopping.set()
+            self.heartbeat.join()
+            self.heartbeat = None
+        with self.lock:
+            held = list(self.held)
+        for account in held:
+            self.release(account)
+        self.backend.close()
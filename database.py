@@ -1,14 +1,168 @@
 """
     Handles all Database related operations
 """
-from typing import Any
+from contextlib import contextmanager
+from typing import Any, Iterator, List, Optional, Tuple
 import os
 import logging
 import sqlite3
+import tempfile
+import threading
+import time
 import yaml
 
 from appdirs import AppDirs
 
+# Schema changes, applied in order. PRAGMA user_version records how many have been applied.
+MIGRATIONS = [
+    # 1: notification_history used id SERIAL, which SQLite does not treat as a rowid alias,
+    # so it is rebuilt with an INTEGER PRIMARY KEY and an index for the ORDER BY sent_date_time
+    [
+        '''CREATE TABLE IF NOT EXISTS notification_history (id SERIAL PRIMARY KEY, sent_date_time TEXT, message TEXT)''',
+        '''CREATE TABLE notification_history_v1 (id INTEGER PRIMARY KEY, sent_date_time TEXT, message TEXT)''',
+        '''INSERT INTO notification_history_v1 (sent_date_time, message)
+            SELECT sent_date_time, message FROM notification_history ORDER BY rowid''',
+        '''DROP TABLE notification_history''',
+        '''ALTER TABLE notification_history_v1 RENAME TO notification_history''',
+        '''CREATE INDEX notification_history_sent_date_time ON notification_history (sent_date_time)''',
+    ],
+    # 2: Result of every slot check, see SlotCheckHistory
+    [
+        '''CREATE TABLE slot_check (
+            id INTEGER PRIMARY KEY,
+            checked_at INTEGER NOT NULL,
+            account TEXT NOT NULL,
+            duration_ms INTEGER NOT NULL,
+            open_dates INTEGER NOT NULL)''',
+        '''CREATE INDEX slot_check_account_checked_at ON slot_check (account, checked_at)''',
+        '''CREATE TABLE slot_check_date (
+            check_id INTEGER NOT NULL REFERENCES slot_check (id) ON DELETE CASCADE,
+            date TEXT NOT NULL,
+            window_count INTEGER NOT NULL,
+            disabled_count INTEGER NOT NULL,
+            flags INTEGER NOT NULL,
+            PRIMARY KEY (check_id, date)) WITHOUT ROWID''',
+        '''CREATE TABLE slot_check_hourly (
+            account TEXT NOT NULL,
+            hour INTEGER NOT NULL,
+            checks INTEGER NOT NULL,
+            open_checks INTEGER NOT NULL,
+            open_windows INTEGER NOT NULL,
+            duration_ms INTEGER NOT NULL,
+            PRIMARY KEY (account, hour)) WITHOUT ROWID''',
+        '''CREATE TABLE slot_opening_profile (
+            account TEXT NOT NULL,
+            day_of_week INTEGER NOT NULL,
+            hour_of_day INTEGER NOT NULL,
+            checks INTEGER NOT NULL,
+            open_checks INTEGER NOT NULL,
+            openings INTEGER NOT NULL,
+            PRIMARY KEY (account, day_of_week, hour_of_day)) WITHOUT ROWID''',
+    ],
+    # 3: Notifications waiting to be delivered, see notifications.NotificationOutbox
+    [
+        '''CREATE TABLE notification_outbox (
+            id INTEGER PRIMARY KEY,
+            idempotency_key TEXT NOT NULL UNIQUE,
+            account TEXT NOT NULL,
+            message TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at REAL NOT NULL,
+            delivered_at REAL,
+            failed INTEGER NOT NULL DEFAULT 0,
+            last_error TEXT)''',
+        '''CREATE INDEX notification_outbox_pending ON notification_outbox (next_attempt_at)
+            WHERE delivered_at IS NULL AND failed = 0''',
+    ],
+    # 4: The retention deletes go by time across accounts, the indexes above lead with the account
+    [
+        '''CREATE INDEX slot_check_checked_at ON slot_check (checked_at)''',
+        '''CREATE INDEX slot_check_hourly_hour ON slot_check_hourly (hour)''',
+    ],
+]
+
+
+class DatabaseConnection:
+    """
+        A single long lived SQLite connection shared by every store.
+
+        The connection runs in autocommit mode, writes that belong together go through transaction().
+        Access is serialized with a lock since the finder pool uses several threads.
+    """
+
+    LOGGER = logging.getLogger(__name__)
+
+    PRAGMAS = [
+        'PRAGMA journal_mode = WAL',
+        'PRAGMA synchronous = NORMAL', # Safe with WAL, only the last transactions can be lost on power loss
+        'PRAGMA temp_store = MEMORY',
+        'PRAGMA busy_timeout = 5000',
+        'PRAGMA foreign_keys = ON',
+    ]
+
+    def __init__(self, db_file: str):
+        self.db_file = db_file
+        self.lock = threading.RLock()
+        self._connection: Optional[sqlite3.Connection] = None
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        """ Opens the connection on first use """
+        with self.lock:
+            if self._connection is None:
+                self._connection = sqlite3.connect(self.db_file, isolation_level=None,
+                                                   check_same_thread=False)
+                for pragma in self.PRAGMAS:
+                    self._connection.execute(pragma)
+            return self._connection
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        """ Runs the statements of the block in one transaction """
+        with self.lock:
+            connection = self.connection
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                yield connection
+            except BaseException:
+                connection.execute('ROLLBACK')
+                raise
+            connection.execute('COMMIT')
+
+    def execute(self, statement: str, parameters: tuple = ()) -> sqlite3.Cursor:
+        """ Runs a single statement in its own transaction """
+        with self.lock:
+            return self.connection.execute(statement, parameters)
+
+    def stream(self, statement: str, parameters: tuple = (), batch_size: int = 100) -> Iterator[tuple]:
+        """ Yields the rows of a query in batches instead of loading them all at once """
+        with self.lock:
+            cursor = self.connection.execute(statement, parameters)
+        while True:
+            with self.lock:
+                rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            yield from rows
+
+    def migrate(self):
+        """ Applies the migrations that have not been applied yet """
+        with self.transaction() as connection:
+            version = connection.execute('PRAGMA user_version').fetchone()[0]
+            for index, statements in enumerate(MIGRATIONS[version:], start=version + 1):
+                self.LOGGER.info('Migrating the database to version %s', index)
+                for statement in statements:
+                    connection.execute(statement)
+                connection.execute(f'PRAGMA user_version = {index}')
+
+    def close(self):
+        """ Closes the connection, it is opened again on the next use """
+        with self.lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
 
 class UserConfiguration:
     """
@@ -17,6 +171,7 @@ class UserConfiguration:
 
     DEFAULT_SLEEP_TIME_SECONDS = 300
 
+    BROWSER_PROFILES_DIR_NAME = 'browser_profiles'
     DATABASE_NAME = 'slot_finder.db'
     CONFIG_FILE_NAME = 'slot_finder.yml'
 
@@ -25,12 +180,43 @@ class UserConfiguration:
 
     MAIN_CONFIG_KEY = 'main'
     REFRESH_TIME_SECONDS_KEY = 'refresh_rate_seconds'
+    PAGE_READY_TIMEOUT_SECONDS_KEY = 'page_ready_timeout_seconds'
+    EXTRACTION_MODE_KEY = 'extraction_mode'
+    MAX_CONCURRENT_CHECKS_KEY = 'max_concurrent_checks'
+    HTTP_FETCH_KEY = 'http_fetch'
+    INCREMENTAL_PARSE_KEY = 'incremental_parse'
+    METRICS_TEXTFILE_KEY = 'metrics_textfile'
+    METRICS_PORT_KEY = 'metrics_port'
+    PERSISTENT_BROWSER_PROFILE_KEY = 'persistent_browser_profile'
+    DEBUGGER_ADDRESS_KEY = 'debugger_address'
+    PARSE_WORKERS_KEY = 'parse_workers'
+    PARSE_PROCESSES_KEY = 'parse_processes'
+    MAX_PENDING_SNAPSHOTS_KEY = 'max_pending_snapshots'
+    HORIZON_DAYS_KEY = 'horizon_days'
+    CONTROL_PORT_KEY = 'control_port'
+    CONTROL_SOCKET_KEY = 'control_socket'
+    RECORD_SNAPSHOTS_KEY = 'record_snapshots'
+    SNAPSHOT_ARCHIVE_KEY = 'snapshot_archive'
+    RECYCLE_BROWSER_CHECKS_KEY = 'recycle_browser_checks'
+    MAX_BROWSER_MEMORY_KEY = 'max_browser_memory_mb'
+    MAX_MEMORY_KEY = 'max_memory_mb'
+
+    POLLING_CONFIG_SECTION = 'polling'
+    POLLING_POLICY_KEY = 'policy'
+    POLLING_MIN_SECONDS_KEY = 'min_refresh_seconds'
+    POLLING_MAX_SECONDS_KEY = 'max_refresh_seconds'
+    POLLING_DAILY_BUDGET_KEY = 'daily_check_budget'
+
+    ACCOUNTS_CONFIG_SECTION = 'accounts'
+    PREFERENCES_CONFIG_SECTION = 'preferences'
+    COORDINATION_CONFIG_SECTION = 'coordination'
+    COORDINATION_LEASE_SECONDS_KEY = 'lease_seconds'
 
     LOGGER = logging.getLogger(__name__)
 
-    CREATE_TABLE_NOTIFICATION_HISTORY = '''
-        CREATE TABLE IF NOT EXISTS notification_history (id SERIAL PRIMARY KEY, sent_date_time TEXT, message TEXT)
-    '''
+    # The C loader is a lot faster, it is only available when PyYAML was built against libyaml
+    YAML_LOADER = getattr(yaml, 'CFullLoader', yaml.FullLoader)
+    YAML_DUMPER = getattr(yaml, 'CDumper', yaml.Dumper)
 
     INSERT_NOTIFICATION_HISTORY = '''
         INSERT INTO notification_history (sent_date_time, message) VALUES (DateTime('now'),?)
@@ -48,24 +234,68 @@ class UserConfiguration:
         self.dirs = AppDirs("SlotFinder", "Bryan")
         self.db_file = os.path.join(self.dirs.user_data_dir, self.DATABASE_NAME)
         self.config_file = os.path.join(self.dirs.user_config_dir, self.CONFIG_FILE_NAME)
+        self.database = DatabaseConnection(self.db_file)
+        self.slot_history = SlotCheckHistory(self.database)
+        self._config: dict = {}
+        self._config_stamp: Optional[Tuple[int, int]] = None
+        self._config_lock = threading.RLock()
+
+    def _get_config_file_stamp(self) -> Optional[Tuple[int, int]]:
+        """ The modification time and size of the configuration file, None if it does not exist """
+        try:
+            stat = os.stat(self.config_file)
+        except FileNotFoundError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def _load_config(self) -> dict:
+        """
+            Returns the parsed configuration file.
+            The file is only parsed again when its modification time or size changed.
+        """
+        with self._config_lock:
+            stamp = self._get_config_file_stamp()
+            if stamp is not None and stamp == self._config_stamp:
+                return self._config
+            config_file = None
+            if stamp is not None:
+                with open(self.config_file, 'r') as config:
+                    config_file = yaml.load(config, Loader=self.YAML_LOADER)
+            self._config = config_file or {}
+            # A section written without any key under it, like "main:", is loaded as None
+            for section in (self.MAIN_CONFIG_KEY, self.NOTIFICATION_CONFIG_SECTION):
+                if section in self._config and self._config[section] is None:
+                    self._config[section] = {}
+            self._config_stamp = stamp
+            return self._config
 
     def update_yml_file(self, new_dict):
-        config_file = {}
-        with open(self.config_file, 'r') as config:
-            config_file = yaml.load(config, Loader=yaml.FullLoader)
-
-        if config_file:
-            config_file = {**config_file, **new_dict}
-        else:
-            config_file = new_dict
-        
-        with open(self.config_file, 'w') as config:
-            yaml.dump(config_file, config)
-        
-
-    def _connect(self):
-        """ Open the connection to the DB """
-        return sqlite3.connect(self.db_file)
+        """
+            Merges the sections of new_dict into the configuration file.
+            The file is written to a temporary file and renamed over the old one, so a reader
+            never sees a partially written file.
+        """
+        with self._config_lock:
+            config_file = dict(self._load_config())
+            for section, values in new_dict.items():
+                if isinstance(values, dict) and isinstance(config_file.get(section), dict):
+                    config_file[section] = {**config_file[section], **values}
+                else:
+                    config_file[section] = values
+
+            config_dir = os.path.dirname(self.config_file)
+            file_descriptor, temp_file = tempfile.mkstemp(dir=config_dir, prefix='.', suffix='.yml')
+            try:
+                with os.fdopen(file_descriptor, 'w') as config:
+                    yaml.dump(config_file, config, Dumper=self.YAML_DUMPER)
+                if os.path.exists(self.config_file):
+                    os.chmod(temp_file, os.stat(self.config_file).st_mode)
+                os.replace(temp_file, self.config_file)
+            except BaseException:
+                os.unlink(temp_file)
+                raise
+            self._config = config_file
+            self._config_stamp = self._get_config_file_stamp()
 
     def setup(self):
         """
@@ -75,15 +305,11 @@ class UserConfiguration:
             os.makedirs(self.dirs.user_data_dir)
 
         self.LOGGER.info('Connected to DB file at %s', self.db_file)
-        connection = self._connect()
-
-        cursor = connection.cursor()
-
-        cursor.execute(self.CREATE_TABLE_NOTIFICATION_HISTORY)
-
-        connection.commit()
+        self.database.migrate()
 
         # Touch the file so we can make sure it exists
+        if not os.path.exists(self.dirs.user_config_dir):
+            os.makedirs(self.dirs.user_config_dir)
         with open(self.config_file, 'a'):
             pass
 
@@ -97,21 +323,20 @@ class UserConfiguration:
             Returns the notification subscription url that was generated before,
             or an empty string
         """
-        with open(self.config_file, 'r') as config:
-            config_file = yaml.load(config, Loader=yaml.FullLoader)
+        config_file = self._load_config()
 
-            if not config_file:
-                self.LOGGER.info('No configuration file set')
-                return ''
+        if not config_file:
+            self.LOGGER.info('No configuration file set')
+            return ''
 
-            if self.NOTIFICATION_CONFIG_SECTION not in config_file:
-                self.LOGGER.warning('No notification url set in yaml file')
-                return ''
-            if self.NOTIFICATION_SUB_KEY not in config_file[self.NOTIFICATION_CONFIG_SECTION]:
-                self.LOGGER.warning('No notification url set in yaml file')
-                return ''
+        if self.NOTIFICATION_CONFIG_SECTION not in config_file:
+            self.LOGGER.warning('No notification url set in yaml file')
+            return ''
+        if self.NOTIFICATION_SUB_KEY not in config_file[self.NOTIFICATION_CONFIG_SECTION]:
+            self.LOGGER.warning('No notification url set in yaml file')
+            return ''
 
-            return config_file[self.NOTIFICATION_CONFIG_SECTION][self.NOTIFICATION_SUB_KEY]
+        return config_file[self.NOTIFICATION_CONFIG_SECTION][self.NOTIFICATION_SUB_KEY]
 
     def set_refresh_time_seconds(self, refresh_time_seconds: int):
         """ Set the refresh time in the configuration file """
@@ -120,45 +345,362 @@ class UserConfiguration:
 
     def get_refresh_time_seconds(self) -> int:
         """ Retrieve the configured refresh time """
-        with open(self.config_file, 'r') as config:
-            config_file = yaml.load(config, Loader=yaml.FullLoader)
+        config_file = self._load_config()
+
+        if not config_file:
+            self.LOGGER.info('No configuration file set')
+            return self.DEFAULT_SLEEP_TIME_SECONDS
+
+        if self.MAIN_CONFIG_KEY not in config_file:
+            self.LOGGER.warning('No main section set in yaml file')
+            return self.DEFAULT_SLEEP_TIME_SECONDS
+        if self.REFRESH_TIME_SECONDS_KEY not in config_file[self.MAIN_CONFIG_KEY]:
+            self.LOGGER.warning('No refresh section set in yaml file')
+            return self.DEFAULT_SLEEP_TIME_SECONDS
+
+        return config_file[self.MAIN_CONFIG_KEY][self.REFRESH_TIME_SECONDS_KEY]
+
+    def _get_main_setting(self, key: str, default: Any) -> Any:
+        """ Retrieve an optional setting of the main section """
+        config_file = self._load_config()
+
+        if self.MAIN_CONFIG_KEY not in config_file:
+            return default
+        return config_file[self.MAIN_CONFIG_KEY].get(key, default)
+
+    def get_page_ready_timeout_seconds(self, default: float) -> float:
+        """ Retrieve the longest time to wait for the slot page to load """
+        return self._get_main_setting(self.PAGE_READY_TIMEOUT_SECONDS_KEY, default)
+
+    def get_extraction_mode(self, default: str) -> str:
+        """ Retrieve how the slots are extracted from the page: soup, script or cross-check """
+        return self._get_main_setting(self.EXTRACTION_MODE_KEY, default)
+
+    def get_max_concurrent_checks(self, default: int) -> int:
+        """ Retrieve how many accounts can be checked at the same time """
+        return self._get_main_setting(self.MAX_CONCURRENT_CHECKS_KEY, default)
 
-            if not config_file:
-                self.LOGGER.info('No configuration file set')
-                return self.DEFAULT_SLEEP_TIME_SECONDS
+    def get_http_fetch_enabled(self) -> bool:
+        """ Retrieve whether the slot page is fetched over HTTP with the browser cookies """
+        return bool(self._get_main_setting(self.HTTP_FETCH_KEY, False))
 
-            if self.MAIN_CONFIG_KEY not in config_file:
-                self.LOGGER.warning('No main section set in yaml file')
-                return self.DEFAULT_SLEEP_TIME_SECONDS
-            if self.REFRESH_TIME_SECONDS_KEY not in config_file[self.MAIN_CONFIG_KEY]:
-                self.LOGGER.warning('No refresh section set in yaml file')
-                return self.DEFAULT_SLEEP_TIME_SECONDS
+    def get_incremental_parse_enabled(self) -> bool:
+        """ Retrieve whether only the slot containers that changed are parsed again """
+        return bool(self._get_main_setting(self.INCREMENTAL_PARSE_KEY, False))
+
+    def get_metrics_textfile(self) -> str:
+        """ Retrieve the path the Prometheus metrics are written to after every check, empty when unset """
+        return self._get_main_setting(self.METRICS_TEXTFILE_KEY, '')
+
+    def get_metrics_port(self) -> int:
+        """ Retrieve the local port the metrics are served on, 0 when unset """
+        return self._get_main_setting(self.METRICS_PORT_KEY, 0)
+
+    def get_browser_profile_dir(self, account: str) -> str:
+        """
+            Retrieve the Chrome profile directory kept for an account between runs, so a restart
+            does not have to log in again. Empty when persistent_browser_profile is turned off.
+        """
+        if not self._get_main_setting(self.PERSISTENT_BROWSER_PROFILE_KEY, True):
+            return ''
+        return os.path.join(self.dirs.user_data_dir, self.BROWSER_PROFILES_DIR_NAME, account)
+
+    def get_debugger_address(self) -> str:
+        """ Retrieve the host:port of a running Chrome to attach to, empty when unset """
+        return self._get_main_setting(self.DEBUGGER_ADDRESS_KEY, '')
+
+    def get_horizon_days(self, default: int) -> int:
+        """ Retrieve the number of days checked for open slots, starting today """
+        return self._get_main_setting(self.HORIZON_DAYS_KEY, default)
+
+    def get_parse_workers(self) -> int:
+        """ Retrieve the size of the parse pool of the pipelined checks, 0 parses on the browser threads """
+        return self._get_main_setting(self.PARSE_WORKERS_KEY, 0)
+
+    def get_parse_processes_enabled(self) -> bool:
+        """ Retrieve whether the parse pool uses processes instead of threads """
+        return bool(self._get_main_setting(self.PARSE_PROCESSES_KEY, False))
+
+    def get_max_pending_snapshots(self, default: int) -> int:
+        """ Retrieve how many captured pages can wait for the parser before the browsers are held back """
+        return self._get_main_setting(self.MAX_PENDING_SNAPSHOTS_KEY, default)
+
+    def get_control_port(self) -> int:
+        """ Retrieve the local port of the control API of the daemon, 0 to use the control socket """
+        return self._get_main_setting(self.CONTROL_PORT_KEY, 0)
+
+    def get_control_socket(self) -> str:
+        """ Retrieve the Unix socket of the control API of the daemon, in the user data dir by default """
+        return self._get_main_setting(self.CONTROL_SOCKET_KEY, '') or os.path.join(self.dirs.user_data_dir, 'control.sock')
+
+    def get_snapshot_recording(self) -> str:
+        """ Retrieve what is archived of every captured page: page, slots or nothing when unset """
+        return self._get_main_setting(self.RECORD_SNAPSHOTS_KEY, '') or ''
+
+    def get_snapshot_archive_dir(self) -> str:
+        """ Retrieve the directory of the snapshot archive, in the user data dir by default """
+        return self._get_main_setting(self.SNAPSHOT_ARCHIVE_KEY, '') or os.path.join(self.dirs.user_data_dir, 'snapshots')
+
+    def get_recycle_browser_checks(self) -> int:
+        """ Retrieve how many checks a browser makes before it is replaced by a new one, 0 for no limit """
+        return self._get_main_setting(self.RECYCLE_BROWSER_CHECKS_KEY, 0)
+
+    def get_max_browser_memory_mb(self) -> int:
+        """ Retrieve the memory of a driver and its browser over which they are replaced, 0 for no limit """
+        return self._get_main_setting(self.MAX_BROWSER_MEMORY_KEY, 0)
+
+    def get_max_memory_mb(self) -> int:
+        """ Retrieve the memory of the slot finder itself over which it collects garbage and warns, 0 for no limit """
+        return self._get_main_setting(self.MAX_MEMORY_KEY, 0)
+
+    def get_polling_settings(self) -> dict:
+        """
+            Retrieve the polling section of the configuration file: policy (fixed or adaptive),
+            min_refresh_seconds, max_refresh_seconds and daily_check_budget
+        """
+        return self._load_config().get(self.POLLING_CONFIG_SECTION) or {}
+
+    def get_coordination_settings(self) -> dict:
+        """
+            Retrieve the coordination section of the configuration file: backend (sqlite or redis),
+            path of the shared database or url of the redis server and lease_seconds
+        """
+        return self._load_config().get(self.COORDINATION_CONFIG_SECTION) or {}
 
-            return config_file[self.MAIN_CONFIG_KEY][self.REFRESH_TIME_SECONDS_KEY]
+    def get_account_profiles(self) -> List[dict]:
+        """
+            Retrieve the accounts section of the configuration file, a list of
+            mappings with a name and optionally a user_data_dir and a debugger_address
+        """
+        return self._load_config().get(self.ACCOUNTS_CONFIG_SECTION) or []
 
+    def get_preference_rules(self) -> List[dict]:
+        """
+            Retrieve the preferences section of the configuration file, a list of rules with
+            optionally a name, days, delivery, from, until and min_windows
+        """
+        return self._load_config().get(self.PREFERENCES_CONFIG_SECTION) or []
 
     def insert_notification_history(self, message: str):
         """ Insert notification history into the DB """
-        connection = self._connect()
-        cursor = connection.cursor()
         # YYYY-MM-DD HH:MM:SS.SSS
-        cursor.execute(self.INSERT_NOTIFICATION_HISTORY, (message, ))
-        connection.commit()
-        connection.close()
+        self.database.execute(self.INSERT_NOTIFICATION_HISTORY, (message, ))
+
+    def iter_notifications(self, limit: int) -> Iterator[Tuple[str, str]]:
+        """ Stream the last N notifications, most recent first """
+        return self.database.stream(self.GET_N_LAST_NOTIFICATION_HISTORY, (limit,))
 
     def get_all_n_notifications(self, limit: int) -> Any:
         """ Retrieve the last N notifications """
-        connection = self._connect()
-        cursor = connection.cursor()
-        cursor.execute(self.GET_N_LAST_NOTIFICATION_HISTORY, (limit,))
-        notifications = cursor.fetchall()
-        connection.close()
-        return notifications
+        return list(self.iter_notifications(limit))
 
     def delete_all_notifications(self):
         """ Clears the notification history table """
-        connection = self._connect()
-        cursor = connection.cursor()
-        cursor.execute(self.CLEAR_NOTIFICATION_HISTORY_TABLE)
-        connection.commit()
-        connection.close()
+        self.database.execute(self.CLEAR_NOTIFICATION_HISTORY_TABLE)
+
+
+class SlotCheckRecord:
+    """ The result of one slot check, as it is buffered before being written """
+
+    def __init__(self, checked_at: float, account: str, duration_seconds: float, dates: list):
+        self.checked_at = checked_at
+        self.account = account
+        self.duration_seconds = duration_seconds
+        self.dates = dates # slot_extraction.DateSlots of every date on the page
+
+    @property
+    def open_dates(self) -> int:
+        """ Number of dates with at least one open window """
+        return sum(1 for slots in self.dates if slots.has_open_slots)
+
+    @property
+    def open_windows(self) -> int:
+        """ Number of open windows over all the dates """
+        return sum(slots.window_count - slots.disabled_count for slots in self.dates
+                   if slots.has_open_slots)
+
+
+class SlotCheckHistory:
+    """
+        Time series of every slot check.
+
+        Raw checks are kept for RAW_RETENTION_DAYS, hourly rollups for HOURLY_RETENTION_DAYS.
+        The opening profile, per account, day of week and hour of day, is updated as the checks
+        are written and kept forever, so questions over months of data never scan raw rows.
+        Writes are buffered and flushed in one transaction.
+    """
+
+    LOGGER = logging.getLogger(__name__)
+
+    FLAG_FOUND = 1
+    FLAG_ALERT = 2
+    FLAG_OPEN = 4
+
+    BATCH_SIZE = 20
+    FLUSH_INTERVAL_SECONDS = 600
+    RAW_RETENTION_DAYS = 30
+    HOURLY_RETENTION_DAYS = 400
+
+    INSERT_SLOT_CHECK = '''
+        INSERT INTO slot_check (checked_at, account, duration_ms, open_dates) VALUES (?, ?, ?, ?)
+    '''
+
+    INSERT_SLOT_CHECK_DATE = '''
+        INSERT OR REPLACE INTO slot_check_date (check_id, date, window_count, disabled_count, flags)
+        VALUES (?, ?, ?, ?, ?)
+    '''
+
+    UPSERT_SLOT_CHECK_HOURLY = '''
+        INSERT INTO slot_check_hourly (account, hour, checks, open_checks, open_windows, duration_ms)
+        VALUES (?, ?, 1, ?, ?, ?)
+        ON CONFLICT (account, hour) DO UPDATE SET
+            checks = checks + 1,
+            open_checks = open_checks + excluded.open_checks,
+            open_windows = open_windows + excluded.open_windows,
+            duration_ms = duration_ms + excluded.duration_ms
+    '''
+
+    UPSERT_SLOT_OPENING_PROFILE = '''
+        INSERT INTO slot_opening_profile (account, day_of_week, hour_of_day, checks, open_checks, openings)
+        VALUES (?, ?, ?, 1, ?, ?)
+        ON CONFLICT (account, day_of_week, hour_of_day) DO UPDATE SET
+            checks = checks + 1,
+            open_checks = open_checks + excluded.open_checks,
+            openings = openings + excluded.openings
+    '''
+
+    DELETE_OLD_SLOT_CHECKS = '''
+        DELETE FROM slot_check WHERE checked_at < ?
+    '''
+
+    DELETE_OLD_SLOT_CHECK_HOURLY = '''
+        DELETE FROM slot_check_hourly WHERE hour < ?
+    '''
+
+    GET_OPENING_PROFILE = '''
+        SELECT day_of_week, hour_of_day, checks, open_checks, openings FROM slot_opening_profile
+        WHERE account = ? ORDER BY day_of_week, hour_of_day
+    '''
+
+    GET_HOURLY = '''
+        SELECT hour, checks, open_checks, open_windows, duration_ms FROM slot_check_hourly
+        WHERE account = ? AND hour >= ? ORDER BY hour
+    '''
+
+    GET_CHECKS = '''
+        SELECT id, checked_at, duration_ms, open_dates FROM slot_check
+        WHERE account = ? AND checked_at >= ? ORDER BY checked_at
+    '''
+
+    GET_LAST_OPEN_DATES = '''
+        SELECT open_dates FROM slot_check WHERE account = ? ORDER BY checked_at DESC LIMIT 1
+    '''
+
+    GET_CHECK_TIMES = '''
+        SELECT checked_at FROM slot_check WHERE checked_at >= ? ORDER BY checked_at
+    '''
+
+    GET_ACCOUNTS = '''
+        SELECT DISTINCT account FROM slot_opening_profile ORDER BY account
+    '''
+
+    def __init__(self, database: DatabaseConnection, clock=time.time):
+        self.database = database
+        self.clock = clock
+        self.pending: List[SlotCheckRecord] = []
+        self.last_flush = clock()
+        # account -> whether the previous check had open slots, read from the last stored check after a restart
+        self.previously_open: dict = {}
+        self.pending_lock = threading.Lock()
+
+    def record(self, record: SlotCheckRecord):
+        """ Buffers the result of a check, flushing when the batch is full or old enough """
+        with self.pending_lock:
+            self.pending.append(record)
+            should_flush = (len(self.pending) >= self.BATCH_SIZE or
+                            self.clock() - self.last_flush >= self.FLUSH_INTERVAL_SECONDS)
+        if should_flush:
+            self.flush()
+
+    def flush(self):
+        """ Writes the buffered checks and applies the retention rules """
+        with self.pending_lock:
+            pending, self.pending = self.pending, []
+            self.last_flush = self.clock()
+        if not pending:
+            return
+
+        now = self.clock()
+        with self.database.transaction() as connection:
+            for record in pending:
+                self._write(connection, record)
+            connection.execute(self.DELETE_OLD_SLOT_CHECKS, (int(now - self.RAW_RETENTION_DAYS * 86400),))
+            connection.execute(self.DELETE_OLD_SLOT_CHECK_HOURLY,
+                               (int(now // 3600) - self.HOURLY_RETENTION_DAYS * 24,))
+        self.LOGGER.debug('Wrote %s slot checks', len(pending))
+
+    def _write(self, connection: sqlite3.Connection, record: SlotCheckRecord):
+        """ Writes one check, its dates and the rollups """
+        duration_ms = int(record.duration_seconds * 1000)
+        open_dates = record.open_dates
+        is_open = open_dates > 0
+        # An opening is a check with open slots right after one without
+        opening = is_open and not self._was_open(connection, record.account)
+        self.previously_open[record.account] = is_open
+        check_id = connection.execute(self.INSERT_SLOT_CHECK, (
+            int(record.checked_at), record.account, duration_ms, open_dates)).lastrowid
+        connection.executemany(self.INSERT_SLOT_CHECK_DATE, [
+            (check_id, slots.date, slots.window_count, slots.disabled_count, self._get_flags(slots))
+            for slots in record.dates])
+
+        connection.execute(self.UPSERT_SLOT_CHECK_HOURLY, (
+            record.account, int(record.checked_at // 3600), int(is_open), record.open_windows, duration_ms))
+
+        local_time = time.localtime(record.checked_at)
+        connection.execute(self.UPSERT_SLOT_OPENING_PROFILE, (
+            record.account, local_time.tm_wday, local_time.tm_hour, int(is_open), int(opening)))
+
+    def _was_open(self, connection: sqlite3.Connection, account: str) -> bool:
+        """ Whether the previous check of the account had open slots """
+        if account not in self.previously_open:
+            row = connection.execute(self.GET_LAST_OPEN_DATES, (account,)).fetchone()
+            self.previously_open[account] = bool(row and row[0])
+        return self.previously_open[account]
+
+    def _get_flags(self, slots) -> int:
+        flags = 0
+        if slots.found:
+            flags |= self.FLAG_FOUND
+        if slots.alert:
+            flags |= self.FLAG_ALERT
+        if slots.has_open_slots:
+            flags |= self.FLAG_OPEN
+        return flags
+
+    def get_opening_profile(self, account: str) -> List[Tuple[int, int, int, int, int]]:
+        """
+            Returns (day_of_week, hour_of_day, checks, open_checks, openings) for the account,
+            day_of_week is 0 for Monday and the hour is in local time
+        """
+        self.flush()
+        return self.database.execute(self.GET_OPENING_PROFILE, (account,)).fetchall()
+
+    def get_hourly(self, account: str, since: float) -> List[Tuple[int, int, int, int, int]]:
+        """ Returns (hour, checks, open_checks, open_windows, duration_ms) since the timestamp """
+        self.flush()
+        return self.database.execute(self.GET_HOURLY, (account, int(since // 3600))).fetchall()
+
+    def iter_checks(self, account: str, since: float) -> Iterator[Tuple[int, int, int, int]]:
+        """ Streams the raw (id, checked_at, duration_ms, open_dates) checks since the timestamp """
+        self.flush()
+        return self.database.stream(self.GET_CHECKS, (account, int(since)))
+
+    def get_check_times(self, since: float) -> List[int]:
+        """ Returns the times of the checks of every account since the timestamp """
+        self.flush()
+        return [row[0] for row in self.database.execute(self.GET_CHECK_TIMES, (int(since),)).fetchall()]
+
+    def get_accounts(self) -> List[str]:
+        """ Returns the accounts that have recorded checks """
+        self.flush()
+        return [row[0] for row in self.database.execute(self.GET_ACCOUNTS).fetchall()]
@@ -0,0 +1,320 @@
+"""
+    Drives several slot finders, one per account or address profile, from a single scheduler
+"""
+import time
+import heapq
+import queue
+import logging
+import threading
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, Optional, Set, Tuple
+
+from metrics import METRICS
+
+if TYPE_CHECKING:
+    from coordination import Coordinator
+    from pipeline import SlotPipeline
+    from slot_finder import AmazonSlotFinder
+
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_ACCOUNT_NAME = 'default'
+
+
+class AccountProfile:
+    """ An account or delivery address that is monitored with its own browser """
+
+    NAME_KEY = 'name'
+    USER_DATA_DIR_KEY = 'user_data_dir'
+    DEBUGGER_ADDRESS_KEY = 'debugger_address'
+
+    def __init__(self, name: str, user_data_dir: Optional[str] = None, debugger_address: Optional[str] = None):
+        self.name = name
+        self.user_data_dir = user_data_dir
+        self.debugger_address = debugger_address
+
+    @classmethod
+    def from_dict(cls, profile: dict) -> 'AccountProfile':
+        """ Builds a profile from an entry of the accounts section of the config file """
+        return cls(str(profile[cls.NAME_KEY]), profile.get(cls.USER_DATA_DIR_KEY),
+                   profile.get(cls.DEBUGGER_ADDRESS_KEY))
+
+
+ResultHandler = Callable[[str, List[str], float], None]
+ErrorHandler = Callable[[str, Exception], None]
+
+
+class FinderPool:
+    """
+        Checks every finder on its own schedule with a bounded number of worker threads.
+
+        The first checks are staggered over one refresh interval so the browsers do not all
+        render at the same time. reserve moves the next check of an account to a number of
+        seconds from now and returns the seconds to actually wait, later when the rate budget
+        is spent. Results are handed to on_result, with the time the check took,
+        on the scheduling thread, which keeps the notification path single threaded.
+
+        With a pipeline the workers only capture the page, the snapshot is parsed by the pipeline
+        and the next check of the account is scheduled as soon as its browser is free.
+
+        pause, resume, check_now and pull_in can be called from any thread while the pool runs,
+        they are queued and applied by the scheduling thread, which they wake up.
+
+        With a coordinator an account is only checked while this instance holds its lease, the
+        other instances try again every retry_seconds and take over when the holder goes away.
+    """
+
+    DEFAULT_MAX_WORKERS = 2
+
+    def __init__(self, finders: Dict[str, 'AmazonSlotFinder'], on_result: ResultHandler,
+                 refresh_seconds: Callable[[str], float], max_workers: int = DEFAULT_MAX_WORKERS,
+                 on_error: Optional[ErrorHandler] = None,
+                 clock: Callable[[], float] = time.monotonic,
+                 pipeline: Optional['SlotPipeline'] = None, coordinator: Optional['Coordinator'] = None,
+                 reserve: Optional[Callable[[str, float], float]] = None):
+        self.finders = finders
+        self.pipeline = pipeline
+        self.coordinator = coordinator
+        self.on_result = on_result
+        self.on_error = on_error
+        self.refresh_seconds = refresh_seconds
+        self.reserve = reserve or (lambda name, seconds: seconds)
+        self.max_workers = max(1, min(max_workers, len(finders)))
+        self.clock = clock
+        self.max_cycles: Optional[int] = None
+        self.schedule: List[Tuple[float, str]] = []
+        self.cycles: Dict[str, int] = {name: 0 for name in finders}
+        self.running: Dict[Future, str] = {}
+        self.parsing: Dict[Future, Tuple[str, int, float]] = {} # name, sequence and capture seconds
+        self.paused: Set[str] = set()
+        self.standing_by: Set[str] = set() # Accounts polled by another instance, their page goes stale
+        self.last_results: Dict[str, dict] = {}
+        self.last_errors: Dict[str, dict] = {}
+        self.commands: 'queue.SimpleQueue[Callable[[], None]]' = queue.SimpleQueue()
+        self.wake_lock = threading.Lock()
+        self.wake: Future = Future() # Completed to interrupt the wait of the scheduling thread
+
+    def login_all(self):
+        """ Logs in every finder, one at a time since the login waits on the console """
+        for name, finder in self.finders.items():
+            print(f'Logging in account {name}')
+            finder.login()
+
+    def _stagger(self):
+        """ Spreads the first check of every finder over one refresh interval """
+        start = self.clock()
+        self.schedule = [(start + self.reserve(name, index * self.refresh_seconds(name) / len(self.finders)), name)
+                         for index, name in enumerate(self.finders)]
+        heapq.heapify(self.schedule)
+
+    def _check(self, name: str, taken_over: bool = False) -> Tuple[Any, float]:
+        """
+            Runs one check of a finder, refreshing the page for every check but the first.
+            An account taken over from another instance is refreshed on its first check too, its
+            page was loaded at login. With a pipeline only the snapshot of the page is taken.
+        """
+        start = time.monotonic()
+        finder = self.finders[name]
+        account = finder.account
+        refresh = bool(self.cycles[name]) or taken_over
+        if self.pipeline:
+            with METRICS.span('capture', account=account):
+                result = finder.capture(refresh=refresh)
+        else:
+            with METRICS.span('cycle', account=account):
+                result = finder.check(refresh=refresh)
+        return result, time.monotonic() - start
+
+    def _handle(self, name: str, future: Future):
+        """ Passes a finished check to the handlers, or to the pipeline, and schedules the next one """
+        self.cycles[name] += 1
+        account = self.finders[name].account
+        METRICS.increment('cycles_total', account=account)
+        try:
+            result, duration_seconds = future.result()
+        except Exception as error: # pylint: disable=broad-except
+            self._fail(name, error)
+        else:
+            if self.pipeline:
+                # May block until the parser catches up, which holds back the next captures
+                parsed = self.pipeline.submit(result)
+                self.parsing[parsed] = (name, result.sequence, duration_seconds)
+            else:
+                self._report(name, result, duration_seconds)
+        if name in self.paused:
+            return # Paused while the check was running
+        if self.max_cycles is None or self.cycles[name] < self.max_cycles:
+            heapq.heappush(self.schedule, (self.clock() + self.refresh_seconds(name), name))
+
+    def _handle_parsed(self, future: Future):
+        """ Passes a parsed snapshot to the result handler """
+        name, _, capture_seconds = self.parsing.pop(future)
+        try:
+            result = future.result()
+        except Exception as error: # pylint: disable=broad-except
+            self._fail(name, error)
+            return
+        METRICS.observe('parse', result.parse_seconds, account=self.finders[name].account)
+        self.finders[name].slot_index = result.slot_index
+        self._report(name, result.available_dates, capture_seconds + result.parse_seconds)
+
+    def _report(self, name: str, available_dates: List[str], duration_seconds: float):
+        METRICS.set_gauge('open_dates', len(available_dates), account=self.finders[name].account)
+        self.last_results[name] = {'checked_at': time.time(), 'available_dates': list(available_dates),
+                                   'duration_seconds': duration_seconds}
+        self.on_result(name, available_dates, duration_seconds)
+
+    def _fail(self, name: str, error: Exception):
+        self.last_errors[name] = {'failed_at': time.time(), 'error': f'{type(error).__name__}: {error}'}
+        METRICS.increment('cycle_errors_total', account=self.finders[name].account)
+        LOGGER.error('Slot check failed for %s', name, exc_info=error)
+        if self.on_error:
+            self.on_error(name, error)
+
+    def _get_names(self, name: Optional[str]) -> List[str]:
+        """ The given account, or every account when it is None """
+        if name is None:
+            return list(self.finders)
+        if name not in self.finders:
+            raise KeyError(name)
+        return [name]
+
+    def _send(self, command: Callable[[], None]):
+        """ Queues a command for the scheduling thread and wakes it up """
+        self.commands.put(command)
+        with self.wake_lock:
+            if not self.wake.done():
+                self.wake.set_result(None)
+
+    def _unschedule(self, names: List[str]):
+        self.schedule = [entry for entry in self.schedule if entry[1] not in names]
+        heapq.heapify(self.schedule)
+
+    def pause(self, name: Optional[str] = None) -> List[str]:
+        """ Stops scheduling the checks of an account, or of every account, a running check still finishes """
+        names = self._get_names(name)
+
+        def command():
+            self.paused.update(names)
+            self._unschedule(names)
+            if self.coordinator:
+                for paused_name in names:
+                    self.coordinator.release(paused_name) # Another instance takes over
+        self._send(command)
+        return names
+
+    def resume(self, name: Optional[str] = None) -> List[str]:
+        """
+            Schedules the paused accounts again, checking them right away.
+            An account paused during a check is scheduled again when the check finishes.
+        """
+        names = self._get_names(name)
+
+        def command():
+            resumed = [name for name in names if name in self.paused]
+            self.paused.difference_update(resumed)
+            self._unschedule(resumed)
+            running = set(self.running.values())
+            for resumed_name in resumed:
+                if resumed_name not in running:
+                    self._push(resumed_name, 0)
+        self._send(command)
+        return names
+
+    def check_now(self, name: Optional[str] = None) -> List[str]:
+        """
+            Moves the next check of an account, or of every account, to now, or as soon as the rate
+            budget allows. Paused accounts and accounts that are being checked are left alone.
+        """
+        names = self._get_names(name)
+
+        def command():
+            running = set(self.running.values())
+            waiting = {entry[1] for entry in self.schedule}
+            due = [name for name in names if name in waiting and name not in running]
+            self._unschedule(due)
+            for due_name in due:
+                self._push(due_name, 0)
+        self._send(command)
+        return names
+
+    def pull_in(self, seconds: float):
+        """ Brings the waiting checks forward so none waits longer than seconds from now, after a new interval """
+        def command():
+            latest = self.clock() + seconds
+            later = [name for due, name in self.schedule if due > latest]
+            self._unschedule(later)
+            for name in later:
+                self._push(name, seconds)
+        self._send(command)
+
+    def _push(self, name: str, seconds: float):
+        """ Schedules the next check of an account seconds from now, or later when the rate budget is spent """
+        heapq.heappush(self.schedule, (self.clock() + self.reserve(name, seconds), name))
+
+    def get_status(self) -> Dict[str, dict]:
+        """ The state of every account: paused, running, cycles, seconds to the next check and last result """
+        now = self.clock()
+        schedule = dict((name, due) for due, name in list(self.schedule))
+        running = set(list(self.running.values()))
+        return {name: {
+            'paused': name in self.paused,
+            'running': name in running,
+            'cycles': self.cycles[name],
+            'next_check_seconds': round(max(0.0, schedule[name] - now), 1) if name in schedule else None,
+            'last_result': self.last_results.get(name),
+            'last_error': self.last_errors.get(name),
+            'driver_rss_bytes': getattr(self.finders[name], 'driver_rss_bytes', None),
+            'lease_held': self.coordinator.holds(name) if self.coordinator else None,
+        } for name in self.finders}
+
+    def _run_commands(self):
+        with self.wake_lock:
+            if self.wake.done():
+                self.wake = Future()
+        while True:
+            try:
+                command = self.commands.get_nowait()
+            except queue.Empty:
+                return
+            command()
+
+    def run(self, max_cycles: Optional[int] = None):
+        """
+            Runs the checks until interrupted.
+            When max_cycles is set every finder is checked that many times and the method returns.
+        """
+        self.max_cycles = max_cycles
+        self._stagger()
+        running = self.running
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while True:
+                self._run_commands()
+                while (self.schedule and len(running) < self.max_workers
+                       and self.schedule[0][0] <= self.clock()):
+                    _, name = heapq.heappop(self.schedule)
+                    if self.coordinator and not self.coordinator.acquire(name):
+                        # Another instance polls the account, stand by in case it goes away
+                        self.standing_by.add(name)
+                        heapq.heappush(self.schedule, (self.clock() + self.coordinator.retry_seconds, name))
+                        continue
+                    taken_over = name in self.standing_by
+                    self.standing_by.discard(name)
+                    running[executor.submit(self._check, name, taken_over)] = name
+
+                if not (self.schedule or running or self.parsing) and max_cycles is not None:
+                    break
+                timeout = None
+                if self.schedule and len(running) < self.max_workers:
+                    timeout = max(0.0, self.schedule[0][0] - self.clock())
+
+                # Paused accounts leave nothing to wait for, only a command can wake the loop then
+                done, _ = wait(list(running) + list(self.parsing) + [self.wake], timeout=timeout,
+                               return_when=FIRST_COMPLETED)
+                # Results of the same account can finish together, hand them over in capture order
+                for future in sorted((future for future in done if future in self.parsing),
+                                     key=lambda future: self.parsing[future][1]):
+                    self._handle_parsed(future)
+                for future in done:
+                    if future in running:
+                        self._handle(running.pop(future), future)
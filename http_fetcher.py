@@ -0,0 +1,111 @@
+"""
+    Fetches the slot page over plain HTTP with the cookies of a logged in browser session
+"""
+import logging
+from typing import NoReturn, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+LOGGER = logging.getLogger(__name__)
+
+
+class SessionExpiredError(Exception):
+    """ Error for a browser session that can no longer be used to fetch the slot page """
+
+    def __init__(self, message):
+        super().__init__(message)
+        self.message = message
+
+
+class HttpSlotFetcher:
+    """
+        Requests the ship option page with a pooled requests session instead of rendering it in the browser.
+
+        The cookies and user agent are copied from the driver once the user has logged in.
+        When Amazon sends us back to the sign in page, or the page has no slot containers,
+        the session is considered expired and the caller goes back to the browser.
+
+        Only the document of the first page of dates is requested. The next pages are loaded by
+        the scripts of the page when the next button is clicked, so a fetcher whose page does not
+        cover the dates to check is disabled and the browser is used for every check.
+    """
+
+    TIMEOUT_SECONDS = 30
+    POOL_SIZE = 2
+    SIGN_IN_PATH = '/ap/signin'
+    SLOT_CONTAINER_MARKER = 'slot-container-'
+    USER_AGENT_SCRIPT = 'return navigator.userAgent'
+
+    def __init__(self, url: str, timeout_seconds: float = TIMEOUT_SECONDS):
+        self.url = url
+        self.timeout_seconds = timeout_seconds
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.POOL_SIZE)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.active = False # Only usable once the cookies of a logged in browser were loaded
+        self.fetches = 0
+        self.expirations = 0
+        self.disabled_reason: Optional[str] = None
+
+    @property
+    def disabled(self) -> bool:
+        """ True once the fetched page was found not to be enough for the checks """
+        return self.disabled_reason is not None
+
+    def load_session(self, driver):
+        """ Copies the cookies and user agent of the browser into the HTTP session """
+        if self.disabled:
+            LOGGER.debug('HTTP fetch is disabled, not copying the browser session')
+            return
+        self.session.cookies.clear()
+        for cookie in driver.get_cookies():
+            self.session.cookies.set(cookie['name'], cookie['value'],
+                                     domain=cookie.get('domain', ''), path=cookie.get('path', '/'))
+        try:
+            user_agent: Optional[str] = driver.execute_script(self.USER_AGENT_SCRIPT)
+        except Exception as error: # pylint: disable=broad-except
+            LOGGER.debug('Could not read the browser user agent: %s', error)
+            user_agent = None
+        if user_agent:
+            self.session.headers['User-Agent'] = user_agent
+        self.active = True
+        LOGGER.debug('Loaded %s cookies from the browser session', len(self.session.cookies))
+
+    def expire(self, reason: str) -> NoReturn:
+        """ Marks the session as unusable until the cookies are loaded again """
+        self.active = False
+        self.expirations += 1
+        raise SessionExpiredError(reason)
+
+    def disable(self, reason: str):
+        """ Stops fetching for good, the browser is used for every check from now on """
+        self.active = False
+        self.disabled_reason = reason
+        LOGGER.warning('HTTP fetch disabled, checking in the browser only: %s', reason)
+
+    def fetch(self) -> str:
+        """ Returns the source of the slot page, raises SessionExpiredError when it cannot be used """
+        if self.disabled:
+            raise SessionExpiredError(f'HTTP fetch is disabled: {self.disabled_reason}')
+        if not self.active:
+            raise SessionExpiredError('No browser session has been loaded')
+        try:
+            response = self.session.get(self.url, timeout=self.timeout_seconds)
+        except requests.RequestException as error:
+            LOGGER.warning('Could not fetch the slot page: %s', error)
+            self.expire(f'Request failed: {error}')
+
+        self.fetches += 1
+        if response.status_code in (401, 403) or self.SIGN_IN_PATH in response.url:
+            self.expire(f'Session was rejected with status {response.status_code} at {response.url}')
+        if response.status_code != 200:
+            self.expire(f'Unexpected status {response.status_code}')
+        if self.SLOT_CONTAINER_MARKER not in response.text:
+            self.expire('The page does not contain any slot containers')
+        return response.text
+
+    def close(self):
+        """ Releases the pooled connections """
+        self.session.close()
@@ -5,88 +5,424 @@ import time
 import datetime
 import logging
 import argparse
+import calendar
+import functools
 import sys
 import os
-from appdirs import AppDirs
+import json
+from typing import TYPE_CHECKING, List, Optional
 
-from slot_finder import ChromeAmazonSlotFinder
-from notifications import NotificationService
-from database import UserConfiguration
+from database import SlotCheckRecord, UserConfiguration
+from polling_scheduler import (AdaptivePolicy, FixedPolicy, PollingScheduler, RateBudget, RecordedProfile,
+                               get_open_periods, simulate)
 
+# The browser, parser and notification modules take a few hundred milliseconds to import,
+# they are imported by the commands that use them so the config and history commands start fast
+# pylint: disable=import-outside-toplevel
+if TYPE_CHECKING:
+    from coordination import Coordinator
+    from finder_pool import AccountProfile, FinderPool
+    from notifications import NotificationOutbox
+    from slot_finder import AmazonSlotFinder, ChromeAmazonSlotFinder
+    from slot_preferences import SlotPreferences
+    from snapshot_archive import SnapshotRecorder
 
 EXECUTION_DATE_TIME_FORMAT = '%m-%d-%Y %H:%M:%S'
+SLOT_OPENINGS_SHOWN = 10
+PROFILE_FILE_NAME = 'slot_finder.prof'
+PROFILE_ENTRIES_SHOWN = 25
+
+# Control commands of a running daemon: method, path and the name of their optional argument
+CONTROL_COMMANDS = {
+    'status': ('GET', '/status', None),
+    'results': ('GET', '/results', None),
+    'history': ('GET', '/history', 'account'),
+    'pause': ('POST', '/pause', 'account'),
+    'resume': ('POST', '/resume', 'account'),
+    'check': ('POST', '/check', 'account'),
+    'interval': ('POST', '/interval', 'minutes'),
+    'notification-url': ('POST', '/notification-url', 'url'),
+}
+
+POLLING_POLICY_FIXED = 'fixed'
+POLLING_POLICY_ADAPTIVE = 'adaptive'
+DEFAULT_MIN_REFRESH_SECONDS = 120
+DEFAULT_MAX_REFRESH_SECONDS = 1800
+DEFAULT_DAILY_CHECK_BUDGET = 288 # One check every 5 minutes on average
 
 LOGGER = logging.getLogger(__name__)
-USER_CONFIGURATION = UserConfiguration()
+
+
+@functools.lru_cache(maxsize=None)
+def get_user_configuration() -> UserConfiguration:
+    """ The configuration of the user, created on first use so importing the module has no side effects """
+    return UserConfiguration()
 
 
 def send_notification(message: str):
     """ Send a user notification """
-    url = USER_CONFIGURATION.get_notification_subscription_url()
+    from notifications import NotificationService
+
+    url = get_user_configuration().get_notification_subscription_url()
 
     if not url:
         configure_user_notifications()
-        url = USER_CONFIGURATION.get_notification_subscription_url()
+        url = get_user_configuration().get_notification_subscription_url()
 
 
-    notification_service = NotificationService(url)
+    notification_service = NotificationService(url, get_user_configuration())
     notification_service.send(message)
 
-def run_slot_check():
-    """ Runs the main loop for checking delivery slots"""
-    if not USER_CONFIGURATION.get_notification_subscription_url():
+def create_finder(profile: 'AccountProfile', preferences: 'SlotPreferences',
+                  recorder: Optional['SnapshotRecorder'] = None) -> 'ChromeAmazonSlotFinder':
+    """ Create the browser backed slot finder for an account profile """
+    from finder_pool import DEFAULT_ACCOUNT_NAME
+    from http_fetcher import HttpSlotFetcher
+    from memory_usage import MemoryLimits
+    from page_readiness import PageReadiness
+    from slot_extraction import EXTRACTION_MODES, EXTRACTION_SOUP
+    from slot_finder import AmazonSlotFinder, ChromeAmazonSlotFinder
+
+    timeout_seconds = get_user_configuration().get_page_ready_timeout_seconds(PageReadiness.DEFAULT_TIMEOUT_SECONDS)
+    extraction = get_user_configuration().get_extraction_mode(EXTRACTION_SOUP)
+    if extraction not in EXTRACTION_MODES:
+        LOGGER.warning('Unknown extraction mode %s, using %s', extraction, EXTRACTION_SOUP)
+        extraction = EXTRACTION_SOUP
+    account = '' if profile.name == DEFAULT_ACCOUNT_NAME else profile.name
+    http_fetcher = None
+    if get_user_configuration().get_http_fetch_enabled():
+        http_fetcher = HttpSlotFetcher(AmazonSlotFinder.SLOT_PAGE_URL)
+    # Keep the login between runs in a profile of our own unless the account brings its own
+    user_data_dir = profile.user_data_dir or get_user_configuration().get_browser_profile_dir(profile.name)
+    return ChromeAmazonSlotFinder(readiness=PageReadiness(timeout_seconds), extraction=extraction,
+                                  account=account, user_data_dir=user_data_dir or None,
+                                  http_fetcher=http_fetcher,
+                                  incremental=get_user_configuration().get_incremental_parse_enabled(),
+                                  debugger_address=profile.debugger_address, preferences=preferences,
+                                  horizon_days=get_user_configuration().get_horizon_days(
+                                      AmazonSlotFinder.DEFAULT_HORIZON_DAYS),
+                                  recorder=recorder,
+                                  memory_limits=MemoryLimits(get_user_configuration().get_recycle_browser_checks(),
+                                                             get_user_configuration().get_max_browser_memory_mb(),
+                                                             get_user_configuration().get_max_memory_mb()))
+
+def create_snapshot_recorder() -> Optional['SnapshotRecorder']:
+    """ Create the recorder of the captured pages when recording is turned on """
+    from snapshot_archive import RECORD_MODES, SnapshotArchive, SnapshotRecorder
+
+    mode = get_user_configuration().get_snapshot_recording()
+    if not mode:
+        return None
+    if mode not in RECORD_MODES:
+        LOGGER.warning('Unknown snapshot recording %s, recording nothing', mode)
+        return None
+    archive_dir = get_user_configuration().get_snapshot_archive_dir()
+    LOGGER.info('Recording the %s of every check to %s', mode, archive_dir)
+    return SnapshotRecorder(SnapshotArchive(archive_dir), mode)
+
+def record_slot_check(account: str, finder: 'AmazonSlotFinder', duration_seconds: float):
+    """ Keep the per date result of a slot check in the slot history """
+    record = SlotCheckRecord(time.time(), account, duration_seconds, list(finder.slot_index.dates.values()))
+    get_user_configuration().slot_history.record(record)
+
+def report_available_dates(account: str, available_dates: List[str], outbox: 'NotificationOutbox',
+                           previous_dates: Optional[List[str]] = None):
+    """
+        Print the result of a slot check and notify the user when the open slots
+        differ from the previous check, which previous_dates gives when another instance made it
+    """
+    from finder_pool import DEFAULT_ACCOUNT_NAME
+
+    # The single account setup keeps the untagged messages
+    tag = '' if account == DEFAULT_ACCOUNT_NAME else f'[{account}] '
+    #pylint:disable-msg=C0301
+    print(f'{datetime.datetime.now().strftime(EXECUTION_DATE_TIME_FORMAT)} - {tag}Checking time slots')
+    # An empty result is passed too, the outbox has to know the slots closed to notify when they open again
+    outbox.notify_changes(account, available_dates, f'{tag}Time Slots Available: {",".join(available_dates)}',
+                          previous_dates)
+    if len(available_dates) == 0:
+        LOGGER.debug('%sNo time slots available', tag)
+        print(f'{tag}No time slots available')
+    else:
+        print(f'{tag}Time slots available')
+        LOGGER.debug('%sTime slots available', tag)
+        for date in available_dates:
+            LOGGER.debug('%sSlot - %s', tag, date)
+            print(f'{tag}Slot - {date}')
+
+def create_polling_policy(policy_name: str):
+    """ Create the polling policy with the given name from the polling settings """
+    if policy_name == POLLING_POLICY_ADAPTIVE:
+        settings = get_user_configuration().get_polling_settings()
+        return AdaptivePolicy(get_user_configuration().slot_history.get_opening_profile,
+                              settings.get(UserConfiguration.POLLING_MIN_SECONDS_KEY, DEFAULT_MIN_REFRESH_SECONDS),
+                              settings.get(UserConfiguration.POLLING_MAX_SECONDS_KEY, DEFAULT_MAX_REFRESH_SECONDS))
+    return FixedPolicy(get_user_configuration().get_refresh_time_seconds)
+
+def create_polling_scheduler(policy_name: str) -> PollingScheduler:
+    """ Create the scheduler of the slot checks, with the configured daily budget """
+    settings = get_user_configuration().get_polling_settings()
+    daily_budget = settings.get(UserConfiguration.POLLING_DAILY_BUDGET_KEY, DEFAULT_DAILY_CHECK_BUDGET)
+    return PollingScheduler(create_polling_policy(policy_name), RateBudget(daily_budget, 86400))
+
+def get_polling_policy_name() -> str:
+    """ The configured polling policy, fixed if it is not set or unknown """
+    policy_name = get_user_configuration().get_polling_settings().get(UserConfiguration.POLLING_POLICY_KEY, POLLING_POLICY_FIXED)
+    if policy_name not in (POLLING_POLICY_FIXED, POLLING_POLICY_ADAPTIVE):
+        LOGGER.warning('Unknown polling policy %s, using %s', policy_name, POLLING_POLICY_FIXED)
+        return POLLING_POLICY_FIXED
+    return policy_name
+
+def simulate_polling(account: str):
+    """ Replay the recorded checks to compare how many openings every polling policy would have caught """
+    history = get_user_configuration().slot_history
+    accounts = [account] if account else history.get_accounts()
+    if not accounts:
+        print('No slot check history!')
+        return
+
+    for current_account in accounts:
+        checks = [(check[1], check[3] > 0) for check in history.iter_checks(current_account, 0)]
+        if len(checks) < 2:
+            print(f'Not enough slot check history for {current_account}')
+            continue
+        periods = get_open_periods(checks)
+        start, end = checks[0][0], checks[-1][0]
+        print(f'{current_account}: {len(checks)} recorded checks, {len(periods)} openings '
+              f'over {get_minutes_from_seconds(end - start) / 60:.1f} hours')
+        for policy_name in (POLLING_POLICY_FIXED, POLLING_POLICY_ADAPTIVE):
+            scheduler = create_polling_scheduler(policy_name)
+            if isinstance(scheduler.policy, AdaptivePolicy):
+                # The stored profile includes the openings the replay is scored on
+                scheduler.policy.profile_source = RecordedProfile(checks, lambda scheduler=scheduler: scheduler.clock())
+            result = simulate(policy_name, scheduler, current_account, periods, start, end)
+            print(f'  {result.name:<9} {result.checks} checks, caught {result.caught} of {result.openings} openings, '
+                  f'{get_minutes_from_seconds(result.delay_seconds):.1f} minutes average delay')
+
+def create_coordinator() -> Optional['Coordinator']:
+    """ Create the coordinator shared with the other instances when the coordination section is set """
+    from coordination import DEFAULT_LEASE_SECONDS, Coordinator, create_backend
+
+    settings = get_user_configuration().get_coordination_settings()
+    if not settings:
+        return None
+    coordinator = Coordinator(create_backend(settings),
+                              settings.get(UserConfiguration.COORDINATION_LEASE_SECONDS_KEY, DEFAULT_LEASE_SECONDS))
+    print(f'Coordinating with the other instances as {coordinator.owner}')
+    return coordinator
+
+def replay_snapshots(account: str):
+    """ Run the detection over the archived snapshots with the current preferences and report the throughput """
+    from snapshot_archive import SnapshotArchive, replay
+    from slot_preferences import SlotPreferences
+
+    archive = SnapshotArchive(get_user_configuration().get_snapshot_archive_dir())
+    preferences = SlotPreferences.from_config(get_user_configuration().get_preference_rules())
+    report = replay(archive, preferences, account or None, get_user_configuration().get_parse_workers() or None)
+    if not report.results:
+        print(f'No archived snapshots in {archive.path}')
+        return
+
+    for result in report.results:
+        checked_at = datetime.datetime.fromtimestamp(result.captured_at).strftime(EXECUTION_DATE_TIME_FORMAT)
+        tag = f'[{result.account}] ' if result.account else ''
+        if result.error:
+            print(f'{checked_at} {tag}Error - {result.error}')
+        else:
+            print(f'{checked_at} {tag}{result.dates_found} dates, open: {",".join(result.available_dates) or "none"}')
+    print(f'Replayed {len(report.results)} snapshots in {report.wall_seconds:.2f} seconds on {report.workers} workers, '
+          f'{report.snapshots_per_second:.1f} snapshots per second, {report.errors} errors')
+
+def run_slot_check(profile_cycles: int = 0, daemon: bool = False):
+    """
+        Runs the main loop for checking delivery slots.
+        When profile_cycles is set, every account is checked that many times under cProfile and the loop stops.
+        As a daemon the loop is controlled through the control API and the refresh rate is read once.
+    """
+    from finder_pool import DEFAULT_ACCOUNT_NAME, AccountProfile, FinderPool
+    from metrics import METRICS
+    from notifications import NotificationOutbox
+    from pipeline import SlotPipeline
+    from slot_preferences import SlotPreferences
+
+    if not get_user_configuration().get_notification_subscription_url():
         configure_user_notifications()
 
-    parser = ChromeAmazonSlotFinder()
-    parser.login()
-
-    while True:
-        #pylint:disable-msg=C0301
-        print(f'{datetime.datetime.now().strftime(EXECUTION_DATE_TIME_FORMAT)} - Checking time slots')
-        LOGGER.debug('Checking time slots')
-        available_dates = parser.get_available_dates()
-        if len(available_dates) == 0:
-            LOGGER.debug('No time slots available')
-            print('No time slots available')
+    profiles = [AccountProfile.from_dict(profile) for profile in get_user_configuration().get_account_profiles()]
+    if not profiles:
+        profiles = [AccountProfile(DEFAULT_ACCOUNT_NAME,
+                                   debugger_address=get_user_configuration().get_debugger_address() or None)]
+
+    preferences = SlotPreferences.from_config(get_user_configuration().get_preference_rules())
+    recorder = create_snapshot_recorder()
+    finders = {profile.name: create_finder(profile, preferences, recorder) for profile in profiles}
+    max_workers = get_user_configuration().get_max_concurrent_checks(FinderPool.DEFAULT_MAX_WORKERS)
+
+    # Profiling measures this instance alone, a standby instance would never finish its cycles
+    coordinator = None if profile_cycles else create_coordinator()
+    outbox = NotificationOutbox(get_user_configuration(), coordinator=coordinator)
+
+    metrics_textfile = get_user_configuration().get_metrics_textfile()
+    metrics_port = get_user_configuration().get_metrics_port()
+    if metrics_port:
+        METRICS.serve(metrics_port)
+
+    def handle_result(account: str, available_dates: List[str], duration_seconds: float):
+        record_slot_check(account, finders[account], duration_seconds)
+        previous_dates = None
+        if coordinator:
+            shared = coordinator.get_result(account)
+            if not coordinator.publish_result(account, available_dates):
+                LOGGER.warning('Lost the lease of %s during the check, the new holder reports it', account)
+                return
+            if shared is not None and shared['owner'] != coordinator.owner:
+                previous_dates = shared['available_dates'] # The previous check was made by another instance
+        report_available_dates(account, available_dates, outbox, previous_dates)
+        if metrics_textfile:
+            METRICS.write_textfile(metrics_textfile)
+
+    pipeline = None
+    parse_workers = get_user_configuration().get_parse_workers()
+    if parse_workers:
+        parse_processes = get_user_configuration().get_parse_processes_enabled()
+        if parse_processes and get_user_configuration().get_incremental_parse_enabled():
+            LOGGER.warning('incremental_parse has no effect with parse_processes, the worker processes parse every page in full')
+        pipeline = SlotPipeline(parse_workers,
+                                get_user_configuration().get_max_pending_snapshots(SlotPipeline.DEFAULT_MAX_PENDING),
+                                parse_processes)
+
+    scheduler = create_polling_scheduler(get_polling_policy_name())
+    # The checks made before a restart still count against the budget
+    history = get_user_configuration().slot_history
+    scheduler.budget.load(history.get_check_times(scheduler.clock() - scheduler.budget.period_seconds))
+    pool = FinderPool(finders, handle_result, scheduler.next_interval, max_workers=max_workers, pipeline=pipeline,
+                      coordinator=coordinator, reserve=scheduler.reserve)
+    pool.login_all()
+    outbox.start()
+    if coordinator:
+        coordinator.start()
+    control_server = None
+    try:
+        if daemon:
+            import control_api
+
+            if isinstance(scheduler.policy, FixedPolicy):
+                scheduler.policy.set_refresh_seconds(get_user_configuration().get_refresh_time_seconds())
+            port, socket_path = control_api.get_control_address(get_user_configuration())
+            # Fails when another daemon serves the same address, everything started so far is stopped
+            control_server = control_api.serve(control_api.ControlApi(pool, get_user_configuration(), scheduler.policy, outbox),
+                                               port, socket_path)
+            print(f'Control API listening on {socket_path or f"port {port}"}')
+        if profile_cycles:
+            profile_slot_check(pool, profile_cycles)
         else:
-            print('Time slots available')
-            send_notification(f'Time Slots Available: {",".join(available_dates)}')
-            LOGGER.debug('Time slots available')
-            for date in available_dates:
-                LOGGER.debug('Slot - %s', date)
-                print(f'Slot - {date}')
-        time.sleep(UserConfiguration.get_refresh_time_seconds())
-        parser.refresh_page()
+            pool.run()
+    finally:
+        if control_server:
+            control_api.close(control_server)
+        if pipeline:
+            pipeline.close()
+        outbox.stop()
+        if coordinator:
+            coordinator.stop()
+        get_user_configuration().slot_history.flush()
+
+def profile_slot_check(pool: 'FinderPool', cycles: int):
+    """ Run the given number of cycles per account under cProfile and dump the statistics """
+    import cProfile
+    import pstats
+
+    profile_file = os.path.join(get_user_configuration().dirs.user_data_dir, PROFILE_FILE_NAME)
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        pool.run(max_cycles=cycles)
+    finally:
+        profiler.disable()
+        profiler.dump_stats(profile_file)
+    print(f'Profile of {cycles} cycles written to {profile_file}')
+    pstats.Stats(profile_file).sort_stats('cumulative').print_stats(PROFILE_ENTRIES_SHOWN)
+
+def send_control_command(command: List[str]):
+    """ Send a command to the control API of a running daemon and print the answer """
+    import control_api
+
+    name, *arguments = command
+    if name not in CONTROL_COMMANDS or len(arguments) > 1:
+        print(f'Unknown control command {" ".join(command)}, use one of: '
+              f'{", ".join(f"{key} [{argument}]" if argument else key for key, (_, _, argument) in CONTROL_COMMANDS.items())}')
+        return
+    method, path, argument_name = CONTROL_COMMANDS[name]
+    request_arguments = {}
+    if arguments and argument_name == 'minutes':
+        request_arguments['seconds'] = get_seconds_from_minutes(int(arguments[0]))
+    elif arguments:
+        request_arguments[argument_name] = arguments[0]
+
+    port, socket_path = control_api.get_control_address(get_user_configuration())
+    try:
+        status, response = control_api.send_request(method, path, request_arguments, port, socket_path)
+    except OSError as error:
+        LOGGER.debug('Control request failed', exc_info=error)
+        print(f'No daemon answered on {socket_path or f"port {port}"}: {error}')
+        return
+    if status != 200:
+        print(f'Error: {response.get("error")}')
+    else:
+        print(json.dumps(response, indent=2))
 
 def configure_user_notifications():
     """ Configure the notification service url """
+    from notifications import NotificationService
+
     print('Retrieving notification url...')
     url = NotificationService.get_new_subscription_url()
-    USER_CONFIGURATION.set_notification_subscription(url)
+    get_user_configuration().set_notification_subscription(url)
     print(f'Please open this url to subscribe to notifications {url}')
 
 def dump_all_notifications(limit: int):
     """ Dump the N most recent notifications """
-    notifications = USER_CONFIGURATION.get_all_n_notifications(limit)
-    # Aren't you happy I know list comprehensions
-    #pylint:disable-msg=C0301
-    # Let this monstrosity grow
-    LOGGER.debug(f'Dumping the past {limit} notifications: {[",".join(notification) for notification in notifications]}')
-    if not notifications:
+    LOGGER.debug('Dumping the past %s notifications', limit)
+    count = 0
+    for user_notification in get_user_configuration().iter_notifications(limit):
+        LOGGER.debug('%s', ','.join(user_notification))
+        print(f'{user_notification[0]} - {user_notification[1]}')
+        count += 1
+    if not count:
         print('No notification history!')
-    else:
-        for user_notification in notifications:
-            print(f'{user_notification[0]} - {user_notification[1]}')
+
+def show_slot_openings(account: str):
+    """ Print the days and hours where slots opened the most for an account """
+    history = get_user_configuration().slot_history
+    accounts = [account] if account else history.get_accounts()
+    if not accounts:
+        print('No slot check history!')
+        return
+
+    for current_account in accounts:
+        profile = history.get_opening_profile(current_account)
+        if not profile:
+            print(f'No slot check history for {current_account}')
+            continue
+        total_checks = sum(row[2] for row in profile)
+        print(f'{current_account}: {total_checks} checks')
+        # Busiest hours first, the hours that never had open slots are left out
+        ranked = sorted((row for row in profile if row[3]), key=lambda row: (row[4], row[3] / row[2]), reverse=True)
+        if not ranked:
+            print('  Slots have never been open')
+        for day_of_week, hour_of_day, checks, open_checks, openings in ranked[:SLOT_OPENINGS_SHOWN]:
+            print(f'  {calendar.day_name[day_of_week]:<9} {hour_of_day:02d}:00 - '
+                  f'{openings} openings, open in {open_checks} of {checks} checks')
 
 def delete_notifications():
     """ Delete the local notification history """
     print('Deleting all past notifications')
     LOGGER.debug('Delete all past notifications')
-    USER_CONFIGURATION.delete_all_notifications()
+    get_user_configuration().delete_all_notifications()
 
 def view_current_refresh_rate():
     """ Print out the current refresh rate """
-    current_refresh_time_seconds = USER_CONFIGURATION.get_refresh_time_seconds()
+    current_refresh_time_seconds = get_user_configuration().get_refresh_time_seconds()
     print(f'Current Refresh Time: {get_minutes_from_seconds(current_refresh_time_seconds)} minutes')
 
 def set_new_refresh_rate(refresh_rate_as_seconds: int):
@@ -100,11 +436,11 @@ def set_new_refresh_rate(refresh_rate_as_seconds: int):
     else:
         print(f'Setting refresh rate to {refresh_rate_in_minutes} minutes')
         LOGGER.debug('Setting refresh rate to %s minutes', refresh_rate_in_minutes)
-        USER_CONFIGURATION.set_refresh_time_seconds(refresh_rate_as_seconds)
+        get_user_configuration().set_refresh_time_seconds(refresh_rate_as_seconds)
 
 def show_current_notification_url():
     """ Print out the current notification url """
-    url = USER_CONFIGURATION.get_notification_subscription_url()
+    url = get_user_configuration().get_notification_subscription_url()
     if url:
         print(f'Notification URL {url}')
     else:
@@ -120,8 +456,6 @@ def get_minutes_from_seconds(seconds: int) -> int:
 
 def main(argv):
     """ Main application entry point """
-    USER_CONFIGURATION.setup()
-
     parser = argparse.ArgumentParser(description='Find open delivery slots')
     #pylint:disable-msg=C0301
     parser.add_argument("-l", "--log-level", help="Set the log level to TRACE, DEBUG, INFO, WARN, ERROR", type=str)
@@ -132,6 +466,12 @@ def main(argv):
     parser.add_argument("-nu", "--notifications-url", help="View the notifications url", action="store_true")
     parser.add_argument("-cn", "--clear-notifications", help="Clears all notifications from the local history", action="store_true")
     parser.add_argument("-r", "--refresh-rate", help="Set/View the refresh rate in minutes", nargs="?", const=-1, type=int)
+    parser.add_argument("-sp", "--simulate-polling", help="Replay the slot history to compare the polling policies, for one account or all of them", nargs="?", const='', type=str, metavar="ACCOUNT")
+    parser.add_argument("-pc", "--profile-cycles", help="Profile N check cycles per account with cProfile, then exit", type=int, metavar="N")
+    parser.add_argument("-d", "--daemon", help="Run the slot checks as a daemon controlled through the control API", action="store_true")
+    parser.add_argument("-ctl", "--control", help="Send a command to the running daemon: status, results, history, pause, resume, check, interval or notification-url", nargs="+", type=str, metavar="COMMAND")
+    parser.add_argument("-rs", "--replay-snapshots", help="Run the detection over the archived snapshots, of one account or all of them", nargs="?", const='', type=str, metavar="ACCOUNT")
+    parser.add_argument("-so", "--slot-openings", help="Show when slots usually open, for one account or all of them", nargs="?", const='', type=str, metavar="ACCOUNT")
     args = parser.parse_args()
 
     loglevel = 'WARN'
@@ -141,7 +481,14 @@ def main(argv):
     delete_all_notifications = False
     show_notification_url = False
     set_refresh_rate = False
+    slot_openings = False
+    slot_openings_account = ''
+    polling_simulation = False
+    polling_simulation_account = ''
     view_refresh_rate = False
+    control_command: List[str] = []
+    snapshot_replay = False
+    snapshot_replay_account = ''
     refresh_rate_as_seconds = UserConfiguration.DEFAULT_SLEEP_TIME_SECONDS
     limit = 0
 
@@ -158,6 +505,17 @@ def main(argv):
         delete_all_notifications = True
     elif args.notifications_url:
         show_notification_url = True
+    elif args.simulate_polling is not None:
+        polling_simulation = True
+        polling_simulation_account = args.simulate_polling
+    elif args.slot_openings is not None:
+        slot_openings = True
+        slot_openings_account = args.slot_openings
+    elif args.control:
+        control_command = args.control
+    elif args.replay_snapshots is not None:
+        snapshot_replay = True
+        snapshot_replay_account = args.replay_snapshots
     elif args.refresh_rate:
         input_rate_as_seconds = get_seconds_from_minutes(args.refresh_rate)
         if input_rate_as_seconds < UserConfiguration.DEFAULT_SLEEP_TIME_SECONDS:
@@ -166,14 +524,15 @@ def main(argv):
             set_refresh_rate = True
             refresh_rate_as_seconds = input_rate_as_seconds
 
+    get_user_configuration().setup()
+
     numeric_level = getattr(logging, loglevel.upper().strip(), None)
     if not isinstance(numeric_level, int):
         raise ValueError('Invalid log level: %s' % loglevel)
-    dirs = AppDirs("SlotFinder", "Bryan")
     logging.basicConfig(format='%(asctime)s %(module)s %(levelname)s: %(message)s',
                         datefmt=EXECUTION_DATE_TIME_FORMAT,
                         level=numeric_level,
-                        filename=os.path.join(dirs.user_data_dir, 'slot_finder.log'))
+                        filename=os.path.join(get_user_configuration().dirs.user_data_dir, 'slot_finder.log'))
 
     if configure_notifications:
         configure_user_notifications()
@@ -190,8 +549,16 @@ def main(argv):
         set_new_refresh_rate(refresh_rate_as_seconds)
     elif show_notification_url:
         show_current_notification_url()
+    elif slot_openings:
+        show_slot_openings(slot_openings_account)
+    elif polling_simulation:
+        simulate_polling(polling_simulation_account)
+    elif control_command:
+        send_control_command(control_command)
+    elif snapshot_replay:
+        replay_snapshots(snapshot_replay_account)
     else:
-        run_slot_check()
+        run_slot_check(args.profile_cycles or 0, args.daemon)
 
 if __name__ == "__main__":
     main(sys.argv[1:])
@@ -0,0 +1,116 @@
+"""
+    Resident memory of this process and of the browser processes, read from /proc on Linux
+    and with psutil elsewhere when it is installed
+"""
+import os
+import gc
+import logging
+from typing import Dict, List, Optional
+
+from metrics import METRICS
+
+LOGGER = logging.getLogger(__name__)
+
+PROC_DIR = '/proc'
+MEGABYTE = 1024 * 1024
+
+
+class MemoryLimits:
+    """ When the browser of a finder is replaced by a new one, and the memory the process should stay under """
+
+    def __init__(self, recycle_checks: int = 0, max_driver_mb: int = 0, max_python_mb: int = 0):
+        self.recycle_checks = recycle_checks # Checks made by one browser before it is replaced, 0 for no limit
+        self.max_driver_mb = max_driver_mb # Resident memory of the driver and its browser, 0 for no limit
+        self.max_python_mb = max_python_mb
+
+    def get_recycle_reason(self, checks: int, driver_rss: Optional[int]) -> str:
+        """ Why the browser should be replaced before the next check, empty when it should not """
+        if self.recycle_checks and checks >= self.recycle_checks:
+            return 'checks'
+        if self.max_driver_mb and driver_rss is not None and driver_rss > self.max_driver_mb * MEGABYTE:
+            return 'memory'
+        return ''
+
+
+def _get_psutil():
+    try:
+        import psutil  # pylint: disable=import-outside-toplevel
+    except ImportError:
+        return None
+    return psutil
+
+
+def get_rss_bytes(pid: Optional[int] = None) -> Optional[int]:
+    """ Resident memory of a process, this one by default, None when it cannot be read """
+    pid = pid or os.getpid()
+    try:
+        with open(os.path.join(PROC_DIR, str(pid), 'statm')) as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError, AttributeError):
+        pass
+    psutil = _get_psutil()
+    if psutil is None:
+        return None
+    try:
+        return psutil.Process(pid).memory_info().rss
+    except psutil.Error:
+        return None
+
+
+def _get_children(pid: int) -> Optional[List[int]]:
+    """ Every descendant of a process, None when the process table cannot be read """
+    if os.path.isdir(PROC_DIR):
+        parents: Dict[int, List[int]] = {}
+        for entry in os.listdir(PROC_DIR):
+            if not entry.isdigit():
+                continue
+            try:
+                with open(os.path.join(PROC_DIR, entry, 'stat')) as stat:
+                    # The command name in parentheses can contain spaces, the parent follows the state
+                    parent = int(stat.read().rpartition(')')[2].split()[1])
+            except (OSError, ValueError, IndexError):
+                continue # Exited while the table was read
+            parents.setdefault(parent, []).append(int(entry))
+        children, pending = [], [pid]
+        while pending:
+            for child in parents.get(pending.pop(), []):
+                children.append(child)
+                pending.append(child)
+        return children
+
+    psutil = _get_psutil()
+    if psutil is None:
+        return None
+    try:
+        return [child.pid for child in psutil.Process(pid).children(recursive=True)]
+    except psutil.Error:
+        return None
+
+
+def get_process_tree_rss_bytes(pid: Optional[int]) -> Optional[int]:
+    """ Resident memory of a process and its descendants, such as a driver and the browser it started """
+    if not pid:
+        return None
+    total = get_rss_bytes(pid)
+    if total is None:
+        return None
+    for child in _get_children(pid) or []:
+        total += get_rss_bytes(child) or 0
+    return total
+
+
+def update_python_memory(limits: Optional[MemoryLimits] = None) -> Optional[int]:
+    """
+        Sets the resident memory gauge of this process. Over the limit the garbage collector is run
+        and a warning is logged when that did not bring it back under.
+    """
+    rss = get_rss_bytes()
+    if rss is None:
+        return None
+    if limits and limits.max_python_mb and rss > limits.max_python_mb * MEGABYTE:
+        gc.collect()
+        rss = get_rss_bytes() or rss
+        if rss > limits.max_python_mb * MEGABYTE:
+            LOGGER.warning('The process uses %.0f MB, more than the %s MB limit', rss / MEGABYTE, limits.max_python_mb)
+    METRICS.set_gauge('python_rss_bytes', rss)
+    return rss
@@ -0,0 +1,167 @@
+"""
+    Timing spans and counters of the check cycles, exported in the Prometheus text format
+"""
+import os
+import json
+import time
+import logging
+import tempfile
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer, ThreadingHTTPServer
+from typing import Dict, Iterator, List, Optional, Tuple
+
+LOGGER = logging.getLogger(__name__)
+
+METRIC_PREFIX = 'slot_finder'
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class PhaseTiming:
+    """ Count, sum and maximum of the durations of a phase """
+
+    def __init__(self):
+        self.count = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+        self.last_seconds = 0.0
+
+    def add(self, seconds: float):
+        """ Records one duration """
+        self.count += 1
+        self.total_seconds += seconds
+        self.max_seconds = max(self.max_seconds, seconds)
+        self.last_seconds = seconds
+
+
+class Metrics:
+    """
+        Registry of the phase timings, counters and gauges of the process.
+
+        Every span is also written as a JSON line on the metrics logger so a run can be analysed
+        from the log file alone.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.timings: Dict[Tuple[str, Labels], PhaseTiming] = {}
+        self.counters: Dict[Tuple[str, Labels], float] = {}
+        self.gauges: Dict[Tuple[str, Labels], float] = {}
+
+    @staticmethod
+    def _labels(labels: Dict[str, str]) -> Labels:
+        return tuple(sorted((key, str(value)) for key, value in labels.items() if value is not None))
+
+    @contextmanager
+    def span(self, phase: str, **labels) -> Iterator[None]:
+        """ Times the block as a phase, failures are counted as errors of the phase """
+        start = time.perf_counter()
+        error: Optional[BaseException] = None
+        try:
+            yield
+        except BaseException as raised:
+            error = raised
+            raise
+        finally:
+            self.observe(phase, time.perf_counter() - start, error, **labels)
+
+    def observe(self, phase: str, seconds: float, error: Optional[BaseException] = None, **labels):
+        """ Records a phase timed elsewhere, such as in a worker process """
+        key = (phase, self._labels(labels))
+        with self.lock:
+            self.timings.setdefault(key, PhaseTiming()).add(seconds)
+        if error is not None:
+            self.increment('phase_errors_total', phase=phase, **labels)
+        if LOGGER.isEnabledFor(logging.INFO):
+            LOGGER.info(json.dumps({'phase': phase, 'seconds': round(seconds, 6),
+                                    'error': type(error).__name__ if error else None, **labels}))
+
+    def increment(self, name: str, amount: float = 1, **labels):
+        """ Adds to a counter """
+        key = (name, self._labels(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def set_gauge(self, name: str, value: float, **labels):
+        """ Sets a gauge to the current value """
+        with self.lock:
+            self.gauges[(name, self._labels(labels))] = value
+
+    def get_timing(self, phase: str, **labels) -> Optional[PhaseTiming]:
+        """ The timing of a phase, None if it never ran """
+        return self.timings.get((phase, self._labels(labels)))
+
+    @staticmethod
+    def _format_labels(labels: Labels) -> str:
+        if not labels:
+            return ''
+        escaped = (value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+        return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + '}'
+
+    def render_prometheus(self) -> str:
+        """ Every metric in the Prometheus text exposition format """
+        lines: List[str] = []
+        with self.lock:
+            timings = sorted(self.timings.items())
+            counters = sorted(self.counters.items())
+            gauges = sorted(self.gauges.items())
+
+        lines.append(f'# HELP {METRIC_PREFIX}_phase_seconds Time spent in every phase of the check cycle')
+        lines.append(f'# TYPE {METRIC_PREFIX}_phase_seconds summary')
+        for (phase, labels), timing in timings:
+            label_text = self._format_labels((('phase', phase),) + labels)
+            lines.append(f'{METRIC_PREFIX}_phase_seconds_count{label_text} {timing.count}')
+            lines.append(f'{METRIC_PREFIX}_phase_seconds_sum{label_text} {timing.total_seconds:.6f}')
+        lines.append(f'# TYPE {METRIC_PREFIX}_phase_seconds_max gauge')
+        for (phase, labels), timing in timings:
+            label_text = self._format_labels((('phase', phase),) + labels)
+            lines.append(f'{METRIC_PREFIX}_phase_seconds_max{label_text} {timing.max_seconds:.6f}')
+
+        for metric_type, values in (('counter', counters), ('gauge', gauges)):
+            typed = set()
+            for (name, labels), value in values:
+                if name not in typed:
+                    lines.append(f'# TYPE {METRIC_PREFIX}_{name} {metric_type}')
+                    typed.add(name)
+                lines.append(f'{METRIC_PREFIX}_{name}{self._format_labels(labels)} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def write_textfile(self, path: str):
+        """ Writes the metrics for the node exporter textfile collector, replacing the file atomically """
+        file_descriptor, temp_file = tempfile.mkstemp(dir=os.path.dirname(path) or '.', suffix='.prom')
+        try:
+            with os.fdopen(file_descriptor, 'w') as metrics_file:
+                metrics_file.write(self.render_prometheus())
+            os.replace(temp_file, path)
+        except BaseException:
+            os.unlink(temp_file)
+            raise
+
+    def serve(self, port: int, host: str = '127.0.0.1') -> HTTPServer:
+        """ Serves /metrics on a local port from a background thread """
+        metrics = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            """ Answers every GET with the metrics """
+
+            def do_GET(self): # pylint: disable=invalid-name
+                """ Returns the metrics text """
+                body = metrics.render_prometheus().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args): # pylint: disable=redefined-builtin
+                LOGGER.debug('Metrics request: ' + format, *args)
+
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+        threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+        LOGGER.info('Serving metrics on http://%s:%s/metrics', host, server.server_address[1])
+        return server
+
+
+# Shared by every module of the process
+METRICS = Metrics()
@@ -1,25 +1,34 @@
 """
     Handles interacting with the notification service
 """
+import time
+import hashlib
 import logging
+import threading
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Tuple
 
 from notify_run import Notify
 
 from database import UserConfiguration
+from metrics import METRICS
+
+if TYPE_CHECKING:
+    from coordination import Coordinator
 
 class NotificationService:
     """ Send notifications and handles retrieving service urls """
 
     LOGGER = logging.getLogger(__name__)
 
-    def __init__(self, endpoint_url: str):
+    def __init__(self, endpoint_url: str, user_configuration: Optional[UserConfiguration] = None):
         self.notify = Notify(endpoint=endpoint_url)
-        self.user_configuration = UserConfiguration()
+        self.user_configuration = user_configuration or UserConfiguration()
 
     def send(self, notification: str):
         """ Send a notification to the service endpoint """
         self.LOGGER.debug(f'Sending Notification: {notification}')
-        self.notify.send(notification)
+        with METRICS.span('notify_send'):
+            self.notify.send(notification)
         self.user_configuration.insert_notification_history(notification)
 
     @staticmethod
@@ -28,3 +37,196 @@ class NotificationService:
         service_url = Notify().register().endpoint
         NotificationService.LOGGER.debug(f'Retrieved new service URL: {service_url}')
         return service_url
+
+
+class NotificationOutbox:
+    """
+        Durable queue of notifications, delivered by a background thread.
+
+        Messages are written to the notification_outbox table before anything is sent, so a slow
+        or failing endpoint never blocks the slot checks and nothing is lost on a restart.
+        Failed deliveries are retried with an exponential backoff. Every message has an
+        idempotency key, a message that is queued twice with the same key is only sent once.
+        With a coordinator the key is claimed in the shared store before sending, so a message
+        queued by several instances is only sent by one of them.
+    """
+
+    LOGGER = logging.getLogger(__name__)
+
+    BASE_RETRY_SECONDS = 15
+    MAX_RETRY_SECONDS = 900
+    MAX_ATTEMPTS = 8
+    BATCH_SIZE = 10
+    # A restart that sees the same open slots within this window does not notify again
+    DEDUPLICATION_WINDOW_SECONDS = 3600
+
+    INSERT_OUTBOX = '''
+        INSERT OR IGNORE INTO notification_outbox (idempotency_key, account, message, created_at, next_attempt_at)
+        VALUES (?, ?, ?, ?, ?)
+    '''
+
+    GET_DUE_OUTBOX = '''
+        SELECT id, idempotency_key, message, attempts FROM notification_outbox
+        WHERE delivered_at IS NULL AND failed = 0 AND next_attempt_at <= ?
+        ORDER BY next_attempt_at LIMIT ?
+    '''
+
+    GET_NEXT_ATTEMPT = '''
+        SELECT MIN(next_attempt_at) FROM notification_outbox WHERE delivered_at IS NULL AND failed = 0
+    '''
+
+    MARK_DELIVERED = '''
+        UPDATE notification_outbox SET delivered_at = ?, attempts = attempts + 1, last_error = NULL WHERE id = ?
+    '''
+
+    MARK_RETRY = '''
+        UPDATE notification_outbox SET attempts = ?, next_attempt_at = ?, failed = ?, last_error = ? WHERE id = ?
+    '''
+
+    def __init__(self, user_configuration: UserConfiguration,
+                 clock: Callable[[], float] = time.time, coordinator: Optional['Coordinator'] = None):
+        self.user_configuration = user_configuration
+        self.coordinator = coordinator
+        self.database = user_configuration.database
+        self.clock = clock
+        self.open_dates: Dict[str, Tuple[str, ...]] = {} # Last open dates seen for every account
+        self.services: Dict[str, NotificationService] = {}
+        self.wake_up = threading.Event()
+        self.stopping = threading.Event()
+        self.worker: Optional[threading.Thread] = None
+
+    @staticmethod
+    def get_idempotency_key(account: str, message: str, bucket: int) -> str:
+        """ The key that identifies a message of an account within a deduplication window """
+        return hashlib.sha256(f'{account}\n{message}\n{bucket}'.encode('utf-8')).hexdigest()
+
+    def enqueue(self, message: str, account: str = '', idempotency_key: Optional[str] = None) -> bool:
+        """ Queues a message for delivery, returns False if the key was already queued """
+        now = self.clock()
+        if idempotency_key is None:
+            bucket = int(now // self.DEDUPLICATION_WINDOW_SECONDS)
+            idempotency_key = self.get_idempotency_key(account, message, bucket)
+        cursor = self.database.execute(self.INSERT_OUTBOX, (idempotency_key, account, message, now, now))
+        if not cursor.rowcount:
+            self.LOGGER.debug('Notification already queued: %s', message)
+            return False
+        self.wake_up.set()
+        return True
+
+    def notify_changes(self, account: str, available_dates: List[str], message: str,
+                       previous_dates: Optional[List[str]] = None) -> bool:
+        """
+            Queues the message only when the open dates of the account differ from the previous check.
+            Every result has to be passed, empty ones included, nothing is queued for those.
+            previous_dates is the result of the previous check when another instance made it.
+            Returns True when a notification was queued.
+        """
+        current = tuple(sorted(available_dates))
+        if previous_dates is not None:
+            self.open_dates[account] = tuple(sorted(previous_dates))
+        previous = self.open_dates.get(account)
+        self.open_dates[account] = current
+        if not current:
+            return False # Recorded all the same, so dates that open again are notified again
+        if current == previous:
+            return False
+        if previous is None:
+            # First check since the start, the windowed key keeps a restart from notifying twice
+            return self.enqueue(message, account)
+        key = self.get_idempotency_key(account, message, int(self.clock() * 1000))
+        return self.enqueue(message, account, key)
+
+    def _get_service(self) -> Optional[NotificationService]:
+        url = self.user_configuration.get_notification_subscription_url()
+        if not url:
+            return None
+        if url not in self.services:
+            self.services[url] = NotificationService(url, self.user_configuration)
+        return self.services[url]
+
+    def get_retry_delay(self, attempts: int) -> float:
+        """ Exponential backoff for the given number of failed attempts """
+        return min(self.MAX_RETRY_SECONDS, self.BASE_RETRY_SECONDS * 2 ** (attempts - 1))
+
+    def deliver_due(self) -> int:
+        """ Sends the messages that are due, returns the number delivered """
+        service = self._get_service()
+        if service is None:
+            self.LOGGER.warning('No notification url set, notifications stay queued')
+            return 0
+
+        delivered = 0
+        rows = self.database.execute(self.GET_DUE_OUTBOX, (self.clock(), self.BATCH_SIZE)).fetchall()
+        for outbox_id, idempotency_key, message, attempts in rows:
+            if self.coordinator and not self._claim(outbox_id, idempotency_key, attempts):
+                continue
+            try:
+                service.send(message)
+            except Exception as error: # pylint: disable=broad-except
+                attempts += 1
+                failed = attempts >= self.MAX_ATTEMPTS
+                METRICS.increment('notification_failures_total')
+                self.LOGGER.warning('Could not send notification (attempt %s): %s', attempts, error)
+                if failed:
+                    self.LOGGER.error('Giving up on notification: %s', message)
+                self.database.execute(self.MARK_RETRY, (
+                    attempts, self.clock() + self.get_retry_delay(attempts), int(failed), str(error), outbox_id))
+            else:
+                self.database.execute(self.MARK_DELIVERED, (self.clock(), outbox_id))
+                if self.coordinator:
+                    self.coordinator.confirm_notification(idempotency_key)
+                METRICS.increment('notifications_delivered_total')
+                delivered += 1
+        return delivered
+
+    def _claim(self, outbox_id: int, idempotency_key: str, attempts: int) -> bool:
+        """ Claims the message in the shared store, returns False when another instance sends it """
+        from coordination import CLAIM_BUSY, CLAIM_SENT # pylint: disable=import-outside-toplevel
+
+        claim = self.coordinator.claim_notification(idempotency_key)
+        if claim == CLAIM_SENT:
+            self.LOGGER.debug('Notification sent by another instance: %s', outbox_id)
+            self.database.execute(self.MARK_DELIVERED, (self.clock(), outbox_id))
+            return False
+        if claim == CLAIM_BUSY:
+            # Checked again once the claim of the other instance expired, in case it died before sending
+            self.database.execute(self.MARK_RETRY, (
+                attempts, self.clock() + self.coordinator.lease_seconds, 0, 'Claimed by another instance', outbox_id))
+            return False
+        return True
+
+    def _get_wait_seconds(self) -> Optional[float]:
+        """ Time until the next queued message is due, None when nothing is queued """
+        next_attempt = self.database.execute(self.GET_NEXT_ATTEMPT).fetchone()[0]
+        if next_attempt is None:
+            return None
+        return max(0.0, next_attempt - self.clock())
+
+    def _run(self):
+        while not self.stopping.is_set():
+            try:
+                self.deliver_due()
+                wait_seconds = self._get_wait_seconds()
+                if wait_seconds is not None and self._get_service() is None:
+                    # The messages stay due until a url is set, setting one wakes the loop up
+                    wait_seconds = max(wait_seconds, self.BASE_RETRY_SECONDS)
+            except Exception: # pylint: disable=broad-except
+                self.LOGGER.exception('Notification delivery failed')
+                wait_seconds = self.BASE_RETRY_SECONDS
+            self.wake_up.wait(wait_seconds)
+            self.wake_up.clear()
+
+    def start(self):
+        """ Starts the delivery thread """
+        if self.worker is None:
+            self.stopping.clear()
+            self.worker = threading.Thread(target=self._run, name='notification-outbox', daemon=True)
+            self.worker.start()
+
+    def stop(self, timeout_seconds: float = 10):
+        """ Stops the delivery thread, undelivered messages are sent on the next start """
+        if self.worker is not None:
+            self.stopping.set()
+            self.wake_up.set()
+            self.worker.join(timeout_seconds)
+            self.worker = None
@@ -0,0 +1,120 @@
+"""
+    Waits for the slot containers on the page instead of sleeping a fixed amount of time
+"""
+import time
+import logging
+from collections import deque
+from typing import Callable, Deque, Dict, Optional, Tuple
+
+LOGGER = logging.getLogger(__name__)
+
+# One round trip that returns the id and size of every slot container on the page
+SLOT_SIGNATURE_SCRIPT = '''
+    return Array.prototype.map.call(
+        document.querySelectorAll('[id^="slot-container-2"]'),
+        function (container) { return container.id + ':' + container.innerHTML.length; });
+'''
+
+Signature = Tuple[str, ...]
+
+
+class PageReadiness:
+    """
+        Polls the browser until the slot containers are present and have stopped changing.
+
+        The time every wait took is kept, the timeout of the next wait is derived from it
+        so a page that is usually ready in a second does not get the full timeout.
+    """
+
+    DEFAULT_TIMEOUT_SECONDS = 30
+    MIN_TIMEOUT_SECONDS = 5
+    POLL_INTERVAL_SECONDS = 0.25
+    STABLE_POLLS = 2 # Number of identical polls in a row before the page is considered loaded
+    FALLBACK_SLEEP_SECONDS = 10
+    TIMEOUT_MULTIPLIER = 3
+    HISTORY_SIZE = 20
+
+    def __init__(self, timeout_seconds: float = DEFAULT_TIMEOUT_SECONDS,
+                 poll_interval_seconds: float = POLL_INTERVAL_SECONDS,
+                 stable_polls: int = STABLE_POLLS,
+                 clock: Callable[[], float] = time.monotonic,
+                 sleep: Callable[[float], None] = time.sleep):
+        self.timeout_seconds = timeout_seconds
+        self.poll_interval_seconds = poll_interval_seconds
+        self.stable_polls = stable_polls
+        self.clock = clock
+        self.sleep = sleep
+        self.durations: Deque[float] = deque(maxlen=self.HISTORY_SIZE)
+        self.timeouts = 0
+        self.fallbacks = 0
+
+    def current_timeout(self) -> float:
+        """ The timeout for the next wait, adapted from the recent wait times """
+        if not self.durations:
+            return self.timeout_seconds
+        adapted = max(self.durations) * self.TIMEOUT_MULTIPLIER
+        return min(self.timeout_seconds, max(self.MIN_TIMEOUT_SECONDS, adapted))
+
+    @staticmethod
+    def get_signature(driver) -> Signature:
+        """ Returns the ids and sizes of the slot containers currently on the page """
+        return tuple(driver.execute_script(SLOT_SIGNATURE_SCRIPT) or ())
+
+    def capture(self, driver) -> Optional[Signature]:
+        """ Captures the current containers before an action that replaces them, None if unavailable """
+        try:
+            return self.get_signature(driver)
+        except Exception as error: # pylint: disable=broad-except
+            LOGGER.debug('Could not capture the slot containers: %s', error)
+            return None
+
+    def wait_until_ready(self, driver, previous: Optional[Signature] = None) -> bool:
+        """
+            Blocks until the slot containers are present and stable.
+            When previous is given the containers must also differ from it, which is used
+            after clicking a button that swaps the containers in place.
+            Returns False if the page never became ready and the caller continues with what is there.
+        """
+        start = self.clock()
+        deadline = start + self.current_timeout()
+        last: Optional[Signature] = None
+        stable_count = 0
+        while True:
+            try:
+                signature = self.get_signature(driver)
+            except Exception as error: # pylint: disable=broad-except
+                LOGGER.warning('Could not query the page for slot containers, falling back to sleeping: %s', error)
+                self.fallbacks += 1
+                self.sleep(self.FALLBACK_SLEEP_SECONDS)
+                return False
+
+            if signature and signature != previous:
+                stable_count = stable_count + 1 if signature == last else 1
+            else:
+                stable_count = 0
+            last = signature
+
+            if stable_count >= self.stable_polls:
+                elapsed = self.clock() - start
+                self.durations.append(elapsed)
+                LOGGER.debug('Page ready after %.2f seconds with %s slot containers', elapsed, len(signature))
+                return True
+
+            if self.clock() >= deadline:
+                self.timeouts += 1
+                # Start over from the configured timeout, the page got slower than what was recorded
+                self.durations.clear()
+                LOGGER.warning('Page was not ready after %.2f seconds', self.clock() - start)
+                return False
+            self.sleep(self.poll_interval_seconds)
+
+    def get_stats(self) -> Dict[str, float]:
+        """ Statistics about the recent waits """
+        return {
+            'waits': len(self.durations),
+            'last_seconds': self.durations[-1] if self.durations else 0.0,
+            'average_seconds': sum(self.durations) / len(self.durations) if self.durations else 0.0,
+            'timeout_seconds': self.current_timeout(),
+            'timeouts': self.timeouts,
+            'fallbacks': self.fallbacks,
+        }
@@ -0,0 +1,181 @@
+"""
+    Parse stage of the slot checks, run in a pool so the browsers never wait on the parser
+"""
+import os
+import time
+import logging
+import threading
+import itertools
+from collections import deque
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Deque, Dict, List, Optional, Sequence, Tuple
+
+from metrics import METRICS
+from slot_extraction import DEFAULT_PARSER, DateSlots, IncrementalSlotExtractor, SlotIndex
+from slot_preferences import SlotPreferences
+
+LOGGER = logging.getLogger(__name__)
+
+
+# Page source, None when the extraction script was enough, and result of SLOT_EXTRACTION_SCRIPT,
+# None when it was not run
+CapturedPage = Tuple[Optional[str], Optional[dict]]
+
+
+class PageSnapshot:
+    """ What the fetch stage captured of every page of dates, everything the parse stage needs """
+
+    def __init__(self, account: str, date_range: List[str], pages: Sequence[CapturedPage] = (),
+                 parser: str = DEFAULT_PARSER, strain: bool = False,
+                 preferences: Optional[SlotPreferences] = None, incremental: bool = False):
+        self.account = account
+        self.date_range = date_range
+        self.pages = list(pages)
+        self.parser = parser
+        self.strain = strain
+        self.preferences = preferences or SlotPreferences() # The windows the user wants
+        self.incremental = incremental # Only parse the containers that changed since the previous snapshot
+        self.sequence = 0 # Set by the pipeline, orders the results
+        self.captured_at = time.time()
+
+
+class SnapshotResult:
+    """ The slot index of a snapshot and the dates of its range with open slots """
+
+    def __init__(self, account: str, sequence: int, available_dates: List[str], slot_index: SlotIndex,
+                 parse_seconds: float):
+        self.account = account
+        self.sequence = sequence
+        self.available_dates = available_dates
+        self.slot_index = slot_index
+        self.parse_seconds = parse_seconds
+
+
+def build_slot_index(snapshot: PageSnapshot,
+                     extractor: Optional[IncrementalSlotExtractor] = None) -> SlotIndex:
+    """ Indexes the slots of every page of a snapshot, a date shown on several pages is taken from the first """
+    dates: Dict[str, DateSlots] = {}
+    for source, script_result in snapshot.pages:
+        for date, slots in _build_page_index(snapshot, source, script_result, extractor).dates.items():
+            dates.setdefault(date, slots)
+    if extractor is not None:
+        for name, value in extractor.get_stats().items():
+            METRICS.set_gauge(f'incremental_{name}', value, account=snapshot.account)
+    return SlotIndex(dates)
+
+
+def _build_page_index(snapshot: PageSnapshot, source: Optional[str], script_result: Optional[dict],
+                      extractor: Optional[IncrementalSlotExtractor]) -> SlotIndex:
+    """
+        Indexes one page. The page source wins over the script result, when
+        both were captured they are compared and the differences are logged.
+    """
+    script_index = None
+    if script_result is not None:
+        script_index = SlotIndex.from_script_result(script_result)
+    if source is None:
+        return script_index if script_index is not None else SlotIndex({})
+
+    if extractor is not None:
+        slot_index = extractor.extract(source)
+    else:
+        slot_index = SlotIndex.from_html(source, snapshot.parser, snapshot.strain)
+
+    if script_index is not None:
+        differences = slot_index.differences(script_index)
+        if differences:
+            LOGGER.warning('Script extraction differs from Beautiful Soup for %s', differences)
+        else:
+            LOGGER.debug('Script extraction matches Beautiful Soup')
+    return slot_index
+
+
+def detect_snapshot(snapshot: PageSnapshot,
+                    extractor: Optional[IncrementalSlotExtractor] = None) -> SnapshotResult:
+    """ Parses a snapshot and finds the open dates, runs in the pool workers """
+    start = time.perf_counter()
+    slot_index = build_slot_index(snapshot, extractor)
+    available_dates = snapshot.preferences.get_available_dates(slot_index, snapshot.date_range)
+    return SnapshotResult(snapshot.account, snapshot.sequence, available_dates, slot_index,
+                          time.perf_counter() - start)
+
+
+class SlotPipeline:
+    """
+        Parses the snapshots submitted by the fetch stage on a pool of threads or processes.
+
+        At most max_pending snapshots are queued or being parsed, submit blocks beyond that so
+        the browsers are held back when the parser falls behind instead of piling up pages.
+        The future returned for a snapshot completes only once the futures of every earlier
+        snapshot of the same account have, so the results of an account are seen in capture order.
+
+        The thread workers share an incremental extractor per account for the snapshots that ask
+        for one. Worker processes keep no state between pages, they always parse in full.
+    """
+
+    DEFAULT_MAX_PENDING = 4
+
+    def __init__(self, workers: Optional[int] = None, max_pending: int = DEFAULT_MAX_PENDING,
+                 use_processes: bool = False):
+        self.workers = max(1, workers or os.cpu_count() or 1)
+        self.max_pending = max(1, max_pending)
+        self.use_processes = use_processes
+        self.extractors: Dict[str, IncrementalSlotExtractor] = {}
+        self.executor: Executor
+        if use_processes:
+            self.executor = ProcessPoolExecutor(max_workers=self.workers)
+        else:
+            self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='parse')
+        self.pending = threading.BoundedSemaphore(self.max_pending)
+        # Reentrant, the callbacks of a result run while it holds the lock and may submit again
+        self.lock = threading.RLock()
+        self.sequence = itertools.count(1)
+        self.waiting: Dict[str, Deque[Tuple[Future, Future]]] = {} # Parse and result futures per account
+        self.submitted = 0
+        self.blocked_seconds = 0.0 # Time the fetch stage spent waiting for room in the queue
+
+    def submit(self, snapshot: PageSnapshot) -> 'Future[SnapshotResult]':
+        """ Queues a snapshot for parsing, blocking while max_pending snapshots are in flight """
+        start = time.perf_counter()
+        self.pending.acquire()
+        waited = time.perf_counter() - start
+        with self.lock:
+            self.blocked_seconds += waited
+            self.submitted += 1
+            snapshot.sequence = next(self.sequence)
+            try:
+                parsed = self.executor.submit(detect_snapshot, snapshot, self._get_extractor(snapshot))
+            except BaseException:
+                self.pending.release()
+                raise
+            ordered: Future = Future()
+            self.waiting.setdefault(snapshot.account, deque()).append((parsed, ordered))
+        if waited > 1:
+            LOGGER.debug('Waited %.2f seconds for the parse queue', waited)
+
+        parsed.add_done_callback(lambda _: self.pending.release())
+        parsed.add_done_callback(lambda _: self._resolve(snapshot.account))
+        return ordered
+
+    def _get_extractor(self, snapshot: PageSnapshot) -> Optional[IncrementalSlotExtractor]:
+        """ The incremental extractor of the account of the snapshot, None when it is parsed in full """
+        if not snapshot.incremental or self.use_processes:
+            return None
+        if snapshot.account not in self.extractors:
+            self.extractors[snapshot.account] = IncrementalSlotExtractor(snapshot.parser)
+        return self.extractors[snapshot.account]
+
+    def _resolve(self, account: str):
+        """ Completes the results of the account that are parsed and have no earlier result pending """
+        with self.lock:
+            waiting = self.waiting[account]
+            while waiting and waiting[0][0].done():
+                parsed, ordered = waiting.popleft()
+                if parsed.exception() is not None:
+                    ordered.set_exception(parsed.exception())
+                else:
+                    ordered.set_result(parsed.result())
+
+    def close(self):
+        """ Waits for the queued snapshots and stops the workers """
+        self.executor.shutdown(wait=True)
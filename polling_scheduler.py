@@ -0,0 +1,251 @@
+"""
+    Decides how long to wait before the next slot check
+"""
+import time
+import bisect
+import logging
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+LOGGER = logging.getLogger(__name__)
+
+# (day_of_week, hour_of_day, checks, open_checks, openings), as returned by SlotCheckHistory.get_opening_profile
+ProfileRow = Tuple[int, int, int, int, int]
+
+
+class FixedPolicy:
+    """ Checks at the same interval around the clock """
+
+    def __init__(self, refresh_seconds: Callable[[], float]):
+        self.refresh_seconds = refresh_seconds
+
+    def get_interval(self, account: str, timestamp: float) -> float: # pylint: disable=unused-argument
+        """ Seconds to wait after a check made at timestamp """
+        return self.refresh_seconds()
+
+    def set_refresh_seconds(self, seconds: float):
+        """ Holds the interval in memory instead of reading it from the source at every check """
+        self.refresh_seconds = lambda: seconds
+
+
+class AdaptivePolicy:
+    """
+        Checks often in the hours of the week where slots opened before and rarely elsewhere.
+
+        Every hour of the week gets a score, the rate of openings per check smoothed towards
+        the average of the account so an hour with a handful of checks does not dominate.
+        The interval is interpolated between min and max seconds with the score relative to
+        the best hour of the account. The profile of an account is loaded again once a day.
+    """
+
+    PRIOR_CHECKS = 10 # Weight of the account average in the score of an hour
+    RELEARN_SECONDS = 86400
+
+    def __init__(self, profile_source: Callable[[str], Sequence[ProfileRow]],
+                 min_seconds: float, max_seconds: float):
+        self.profile_source = profile_source
+        self.min_seconds = min_seconds
+        self.max_seconds = max_seconds
+        self.scores: Dict[str, Dict[Tuple[int, int], float]] = {}
+        self.learned_at: Dict[str, float] = {}
+
+    def _get_scores(self, account: str, timestamp: float) -> Dict[Tuple[int, int], float]:
+        if timestamp - self.learned_at.get(account, float('-inf')) >= self.RELEARN_SECONDS:
+            self.scores[account] = self._score(self.profile_source(account))
+            self.learned_at[account] = timestamp
+            LOGGER.debug('Learned the polling profile of %s from %s hours', account, len(self.scores[account]))
+        return self.scores[account]
+
+    def _score(self, rows: Sequence[ProfileRow]) -> Dict[Tuple[int, int], float]:
+        total_checks = sum(row[2] for row in rows)
+        if not total_checks:
+            return {}
+        average = sum(row[4] for row in rows) / total_checks
+        rates = {(day, hour): (openings + average * self.PRIOR_CHECKS) / (checks + self.PRIOR_CHECKS)
+                 for day, hour, checks, _, openings in rows}
+        best = max(rates.values())
+        if not best:
+            return {}
+        return {key: rate / best for key, rate in rates.items()}
+
+    def get_interval(self, account: str, timestamp: float) -> float:
+        """ Seconds to wait after a check made at timestamp """
+        scores = self._get_scores(account, timestamp)
+        if not scores:
+            # Nothing learned yet, spread the checks evenly
+            return (self.min_seconds + self.max_seconds) / 2
+        interval = self._get_hour_interval(scores, timestamp)
+        # Do not sleep past the start of an hour that needs more frequent checks
+        next_hour = (timestamp // 3600 + 1) * 3600
+        while next_hour < timestamp + interval:
+            if self._get_hour_interval(scores, next_hour) < interval:
+                return next_hour - timestamp
+            next_hour += 3600
+        return interval
+
+    def _get_hour_interval(self, scores: Dict[Tuple[int, int], float], timestamp: float) -> float:
+        local_time = time.localtime(timestamp)
+        score = scores.get((local_time.tm_wday, local_time.tm_hour), 0.0)
+        return self.max_seconds - (self.max_seconds - self.min_seconds) * score
+
+
+class RateBudget:
+    """ Reserves check times so no more than max_checks fall in any period_seconds long window """
+
+    def __init__(self, max_checks: int, period_seconds: float):
+        self.max_checks = max_checks
+        self.period_seconds = period_seconds
+        self.reserved: List[float] = []
+
+    def _count(self, start: float, end: float) -> int:
+        """ Number of reservations in (start, end] """
+        return bisect.bisect_right(self.reserved, end) - bisect.bisect_right(self.reserved, start)
+
+    def _fits(self, timestamp: float) -> bool:
+        """ True when every window that would contain the timestamp has room left """
+        ends = [timestamp] + [reserved for reserved in self.reserved
+                              if timestamp < reserved < timestamp + self.period_seconds]
+        return all(self._count(end - self.period_seconds, end) < self.max_checks for end in ends)
+
+    def reserve(self, timestamp: float, now: float) -> float:
+        """ Reserves the first time at or after timestamp that stays within the budget """
+        del self.reserved[:bisect.bisect_right(self.reserved, now - self.period_seconds)]
+        while not self._fits(timestamp):
+            # Move just past the point where the oldest reservation of the window expires
+            window_start = bisect.bisect_right(self.reserved, timestamp - self.period_seconds)
+            timestamp = self.reserved[window_start] + self.period_seconds + 0.001
+        bisect.insort(self.reserved, timestamp)
+        return timestamp
+
+    def release(self, timestamp: float):
+        """ Gives back a reservation that will not be used """
+        index = bisect.bisect_left(self.reserved, timestamp)
+        if index < len(self.reserved) and self.reserved[index] == timestamp:
+            del self.reserved[index]
+
+    def load(self, timestamps: Iterable[float]):
+        """ Counts checks that were made before the budget was created, such as the recorded ones """
+        for timestamp in timestamps:
+            bisect.insort(self.reserved, timestamp)
+
+
+class PollingScheduler:
+    """
+        Combines a policy with the global rate budget shared by every account.
+        The time reserved for the next check of every account is kept, so moving the check gives
+        its reservation back.
+    """
+
+    def __init__(self, policy, budget: Optional[RateBudget] = None,
+                 clock: Callable[[], float] = time.time):
+        self.policy = policy
+        self.budget = budget
+        self.clock = clock
+        self.pending: Dict[str, float] = {} # Reserved time of the next check of every account
+
+    def next_interval(self, account: str) -> float:
+        """ Seconds until the next check of the account """
+        now = self.clock()
+        return self._reserve(account, now + self.policy.get_interval(account, now), now)
+
+    def reserve(self, account: str, seconds: float) -> float:
+        """
+            Moves the next check of the account to seconds from now, or later when the budget is spent.
+            Returns the seconds to wait.
+        """
+        now = self.clock()
+        pending = self.pending.get(account)
+        # A reservation that is due already belongs to a check that was made
+        if self.budget is not None and pending is not None and pending > now:
+            self.budget.release(pending)
+        return self._reserve(account, now + seconds, now)
+
+    def _reserve(self, account: str, wanted: float, now: float) -> float:
+        if self.budget is None:
+            return wanted - now
+        allowed = self.budget.reserve(wanted, now)
+        self.pending[account] = allowed
+        if allowed > wanted:
+            LOGGER.debug('Check of %s delayed %.0f seconds by the rate budget', account, allowed - wanted)
+        return allowed - now
+
+
+class SimulationResult:
+    """ What a policy would have caught over the recorded checks """
+
+    def __init__(self, name: str, checks: int, openings: int, caught: int, delay_seconds: float):
+        self.name = name
+        self.checks = checks
+        self.openings = openings
+        self.caught = caught
+        self.delay_seconds = delay_seconds # Average time from opening to detection over the caught ones
+
+
+def get_open_periods(checks: Iterable[Tuple[float, bool]]) -> List[Tuple[float, float]]:
+    """
+        Turns recorded (checked_at, has_open_slots) checks, in time order, into (start, end) periods
+        where slots were open. A period ends at the first check that found no open slot.
+    """
+    periods = []
+    start = None
+    last = None
+    for checked_at, is_open in checks:
+        if is_open and start is None:
+            start = checked_at
+        elif not is_open and start is not None:
+            periods.append((start, checked_at))
+            start = None
+        last = checked_at
+    if start is not None and last is not None:
+        periods.append((start, last + 1))
+    return periods
+
+
+class RecordedProfile:
+    """
+        Opening profile of the recorded checks made before the time of the clock, as the profile
+        source of a replayed adaptive policy. The policy only learns from the past, as it would have
+        live, instead of from the openings it is evaluated on.
+    """
+
+    def __init__(self, checks: Sequence[Tuple[float, bool]], clock: Callable[[], float]):
+        self.clock = clock
+        self.times = [checked_at for checked_at, _ in checks]
+        # (day_of_week, hour_of_day, is_open, opening) of every check, an opening follows a check without
+        self.hours: List[Tuple[int, int, bool, bool]] = []
+        previously_open = False
+        for checked_at, is_open in checks:
+            local_time = time.localtime(checked_at)
+            self.hours.append((local_time.tm_wday, local_time.tm_hour, is_open, is_open and not previously_open))
+            previously_open = is_open
+
+    def __call__(self, account: str) -> List[ProfileRow]: # pylint: disable=unused-argument
+        counts: Dict[Tuple[int, int], List[int]] = {}
+        for day, hour, is_open, opening in self.hours[:bisect.bisect_left(self.times, self.clock())]:
+            count = counts.setdefault((day, hour), [0, 0, 0])
+            count[0] += 1
+            count[1] += is_open
+            count[2] += opening
+        return [(day, hour, checks, open_checks, openings)
+                for (day, hour), (checks, open_checks, openings) in sorted(counts.items())]
+
+
+def simulate(name: str, scheduler: PollingScheduler, account: str,
+             periods: List[Tuple[float, float]], start: float, end: float) -> SimulationResult:
+    """ Replays the schedule of a policy between start and end against the recorded open periods """
+    now = [start]
+    scheduler.clock = lambda: now[0]
+    checks = 0
+    caught = 0
+    delays = 0.0
+    period_index = 0
+    while now[0] < end:
+        checks += 1
+        # Skip the periods that closed before this check, they were missed
+        while period_index < len(periods) and periods[period_index][1] <= now[0]:
+            period_index += 1
+        if period_index < len(periods) and periods[period_index][0] <= now[0]:
+            caught += 1
+            delays += now[0] - periods[period_index][0]
+            period_index += 1
+        now[0] += scheduler.next_interval(account)
+    return SimulationResult(name, checks, len(periods), caught, delays / caught if caught else 0.0)
@@ -0,0 +1,455 @@
+"""
+    Single pass extraction of the delivery slot containers on the ship option page
+"""
+import re
+import hashlib
+import datetime
+import logging
+import threading
+from typing import Dict, List, Optional, Sequence, Set, Tuple
+
+from bs4 import BeautifulSoup, SoupStrainer
+
+LOGGER = logging.getLogger(__name__)
+
+DEFAULT_PARSER = 'html.parser'
+SLOT_CONTAINER_PATTERN = re.compile(r'^slot-container-(\d{4}-\d{2}-\d{2})$')
+# Opening tag of a slot container in the raw page source
+SLOT_CONTAINER_TAG_PATTERN = re.compile(
+    r'<([a-zA-Z][a-zA-Z0-9]*)\b[^>]*?\sid\s*=\s*["\']slot-container-(\d{4}-\d{2}-\d{2})["\'][^>]*>')
+ALERT_CLASS = 'a-box a-alert a-alert-info'
+DISABLED_CLASS = 'disabledRadioBox'
+WINDOW_TEXT_CLASS = 'ufss-slot-time-window-text'
+ATTENDED = 'ATTENDED'
+UNATTENDED = 'UNATTENDED'
+DELIVERY_TYPES = (ATTENDED, UNATTENDED)
+# 8:00 AM, 10 p.m., 14:30
+TIME_PATTERN = re.compile(r'(\d{1,2})(?::(\d{2}))?\s*(?:([AaPp])\.?\s*[Mm]\.?)?')
+
+EXTRACTION_SOUP = 'soup'
+EXTRACTION_SCRIPT = 'script'
+EXTRACTION_CROSS_CHECK = 'cross-check'
+EXTRACTION_MODES = [EXTRACTION_SOUP, EXTRACTION_SCRIPT, EXTRACTION_CROSS_CHECK]
+
+# Runs in the page and returns the same summary DateSlots.from_container builds, keyed by date:
+# {"2020-04-02": {"found": true, "alert": false, "windows": [true, false], "disabled": 1,
+#                 "slots": [["UNATTENDED", true, "8:00 AM - 10:00 AM"], ...]}}
+# found is false for a date that has a container without an unattended box group,
+# slots has the windows of every delivery type.
+SLOT_EXTRACTION_SCRIPT = '''
+    var pattern = /^slot-container-(\\d{4}-\\d{2}-\\d{2})$/;
+    var result = {};
+    var getBoxGroup = function (container, date, type) {
+        var typeContainer = container.querySelector('div[id="slot-container-' + type + '"]');
+        if (!typeContainer || typeContainer.querySelector('div[class="ALERT_CLASS"]')) {
+            return null;
+        }
+        return typeContainer.querySelector('div[id="root-' + date + '-' + type + '-box-group"]');
+    };
+    var getWindows = function (group) {
+        var windows = [];
+        for (var j = 0; group && j < group.children.length; j++) {
+            var child = group.children[j];
+            if (child.tagName === 'DIV') {
+                var disabled = child.classList.contains('DISABLED_CLASS') ||
+                    child.querySelector('div.DISABLED_CLASS') !== null;
+                var text = child.querySelector('.WINDOW_TEXT_CLASS') || child;
+                windows.push([!disabled, text.textContent.replace(/\\s+/g, ' ').trim()]);
+            }
+        }
+        return windows;
+    };
+    var containers = document.querySelectorAll('[id^="slot-container-2"]');
+    for (var i = 0; i < containers.length; i++) {
+        var match = pattern.exec(containers[i].id);
+        if (!match || result.hasOwnProperty(match[1])) {
+            continue;
+        }
+        var date = match[1];
+        var slots = [];
+        ['ATTENDED', 'UNATTENDED'].forEach(function (type) {
+            getWindows(getBoxGroup(containers[i], date, type)).forEach(function (window) {
+                slots.push([type, window[0], window[1]]);
+            });
+        });
+        var summary = {found: false, alert: false, windows: [], disabled: 0, slots: slots};
+        result[date] = summary;
+        var unattended = containers[i].querySelector('div[id="slot-container-UNATTENDED"]');
+        if (!unattended) {
+            continue;
+        }
+        if (unattended.querySelector('div[class="ALERT_CLASS"]')) {
+            summary.found = summary.alert = true;
+            continue;
+        }
+        var group = unattended.querySelector('div[id="root-' + date + '-UNATTENDED-box-group"]');
+        if (!group) {
+            continue;
+        }
+        summary.found = true;
+        summary.windows = getWindows(group).map(function (window) { return window[0]; });
+        summary.disabled = group.querySelectorAll('div.DISABLED_CLASS').length;
+    }
+    return result;
+'''.replace('ALERT_CLASS', ALERT_CLASS).replace('DISABLED_CLASS', DISABLED_CLASS).replace(
+    'WINDOW_TEXT_CLASS', WINDOW_TEXT_CLASS)
+
+
+def get_signature_dates(signature: Sequence[str]) -> Set[str]:
+    """ The dates of a page from its PageReadiness signature, entries are "{container id}:{size}" """
+    dates = set()
+    for entry in signature:
+        match = SLOT_CONTAINER_PATTERN.match(entry.rsplit(':', 1)[0])
+        if match:
+            dates.add(match.group(1))
+    return dates
+
+
+def get_source_dates(source: str) -> Set[str]:
+    """ The dates that have a slot container in the page source, found without parsing it """
+    return {match.group(2) for match in SLOT_CONTAINER_TAG_PATTERN.finditer(source)}
+
+
+def get_available_parsers() -> List[str]:
+    """ Returns the parser backends that can be used in this environment """
+    parsers = [DEFAULT_PARSER]
+    try:
+        import lxml  # pylint: disable=import-outside-toplevel,unused-import
+        parsers.append('lxml')
+    except ImportError:
+        pass
+    return parsers
+
+
+def parse_minutes(text: str) -> Tuple[int, int]:
+    """
+        Start and end of a window label such as "8:00 AM - 10:00 AM", in minutes after midnight.
+        A start without AM or PM takes the one of the end. (-1, -1) when the label has no times.
+    """
+    times = TIME_PATTERN.findall(text)[:2]
+    if len(times) < 2:
+        return -1, -1
+    (start_hour, start_minute, start_meridiem), (end_hour, end_minute, end_meridiem) = times
+    end = _to_minutes(int(end_hour), int(end_minute or 0), end_meridiem)
+    start = _to_minutes(int(start_hour), int(start_minute or 0), start_meridiem or end_meridiem)
+    if start > end and not start_meridiem and end_meridiem:
+        # 11 - 1 PM starts in the morning, 22:00 - 00:00 ends at midnight
+        start = _to_minutes(int(start_hour), int(start_minute or 0), 'a')
+    if end <= start:
+        end += 24 * 60 # Ends at or after midnight
+    return start, end
+
+
+def _to_minutes(hour: int, minute: int, meridiem: str) -> int:
+    if meridiem:
+        hour = hour % 12 + (12 if meridiem.lower() == 'p' else 0)
+    return hour * 60 + minute
+
+
+class TimeWindow:
+    """ One delivery window of a date, as it is shown on the page """
+
+    __slots__ = ('delivery_type', 'enabled', 'label', 'start_minutes', 'end_minutes')
+
+    def __init__(self, delivery_type: str, enabled: bool, label: str):
+        self.delivery_type = delivery_type
+        self.enabled = enabled
+        self.label = label
+        self.start_minutes, self.end_minutes = parse_minutes(label)
+
+    @classmethod
+    def from_element(cls, window, delivery_type: str) -> 'TimeWindow':
+        """ Builds the window from a child div of a box group """
+        disabled = DISABLED_CLASS in (window.get('class') or []) or window.find("div", {"class": DISABLED_CLASS})
+        text = window.find(class_=WINDOW_TEXT_CLASS) or window
+        return cls(delivery_type, not disabled, ' '.join(text.get_text().split()))
+
+    def _key(self) -> tuple:
+        return self.delivery_type, self.enabled, self.label
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, TimeWindow):
+            return NotImplemented
+        return self._key() == other._key()
+
+    def __repr__(self) -> str:
+        return f'TimeWindow({self.delivery_type!r}, {self.enabled}, {self.label!r})'
+
+
+class DateSlots:
+    """
+        Summary of the unattended delivery windows of a single date, with every window of
+        every delivery type for the preference rules
+    """
+
+    __slots__ = ('date', 'found', 'alert', 'window_count', 'disabled_count', 'windows')
+
+    def __init__(self, date: str, found: bool = False, alert: bool = False,
+                 window_count: int = 0, disabled_count: int = 0, windows: Sequence[TimeWindow] = ()):
+        self.date = date
+        self.found = found
+        self.alert = alert
+        self.window_count = window_count
+        self.disabled_count = disabled_count
+        self.windows = tuple(windows)
+
+    @property
+    def has_open_slots(self) -> bool:
+        """ True when at least one of the windows for the date can be selected """
+        if not self.found or self.alert:
+            return False
+        return self.window_count != self.disabled_count
+
+    @classmethod
+    def from_container(cls, time_slot, date: str) -> 'DateSlots':
+        """
+            Builds the summary from a slot-container-{date} element.
+            Only the subtree of the container is searched.
+        """
+        if time_slot is None:
+            LOGGER.debug('No Time Slot found for %s', date)
+            return cls(date)
+
+        windows = [TimeWindow.from_element(window, delivery_type) for delivery_type in DELIVERY_TYPES
+                   for window in cls._get_window_elements(time_slot, date, delivery_type)]
+
+        # The open slots of a date are decided on the unattended windows, the preference rules look at all of them
+        time_slot_unattended = time_slot.find("div", {"id": "slot-container-UNATTENDED"})
+        if time_slot_unattended is None:
+            LOGGER.debug('No unattended slot container found for %s', date)
+            return cls(date, windows=windows)
+
+        if time_slot_unattended.find("div", {"class": ALERT_CLASS}):
+            # There is an alert box telling us that there is no time slot available for the given date
+            LOGGER.debug('No available dates for %s', date)
+            return cls(date, found=True, alert=True, windows=windows)
+
+        box_group = time_slot_unattended.find("div", {"id": f'root-{date}-UNATTENDED-box-group'})
+        if box_group is None:
+            LOGGER.debug('No time slot box group found for %s', date)
+            return cls(date, windows=windows)
+
+        window_count = len(box_group.find_all("div", recursive=False))
+        disabled_count = len(box_group.find_all("div", {"class": DISABLED_CLASS}))
+        LOGGER.debug('Number of time slots found: %s ', window_count)
+        LOGGER.debug('Number of disabled time slots found: %s', disabled_count)
+        return cls(date, found=True, window_count=window_count, disabled_count=disabled_count, windows=windows)
+
+    @staticmethod
+    def _get_window_elements(time_slot, date: str, delivery_type: str) -> list:
+        """ The window divs of a delivery type, none when it shows an alert instead """
+        container = time_slot.find("div", {"id": f'slot-container-{delivery_type}'})
+        if container is None or container.find("div", {"class": ALERT_CLASS}):
+            return []
+        box_group = container.find("div", {"id": f'root-{date}-{delivery_type}-box-group'})
+        if box_group is None:
+            return []
+        return box_group.find_all("div", recursive=False)
+
+    @classmethod
+    def from_script_result(cls, date: str, result: Optional[dict]) -> 'DateSlots':
+        """ Builds the summary from one date of the SLOT_EXTRACTION_SCRIPT result """
+        if result is None:
+            return cls(date)
+        windows = [TimeWindow(delivery_type, enabled, label) for delivery_type, enabled, label in result['slots']]
+        if not result['found']:
+            return cls(date, windows=windows)
+        if result['alert']:
+            return cls(date, found=True, alert=True, windows=windows)
+        return cls(date, found=True, window_count=len(result['windows']),
+                   disabled_count=result['disabled'], windows=windows)
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, DateSlots):
+            return NotImplemented
+        return all(getattr(self, name) == getattr(other, name) for name in self.__slots__)
+
+    def __repr__(self) -> str:
+        return (f'DateSlots({self.date!r}, found={self.found}, alert={self.alert}, '
+                f'window_count={self.window_count}, disabled_count={self.disabled_count}, '
+                f'windows={len(self.windows)})')
+
+
+class SlotIndex:
+    """
+        Date keyed index of every slot container on the page.
+
+        The document is walked once to collect the slot-container-{date} elements,
+        every date lookup is then answered from the index.
+    """
+
+    def __init__(self, dates: Dict[str, DateSlots]):
+        self.dates = dates
+
+    @classmethod
+    def from_html(cls, source: str, parser: str = DEFAULT_PARSER,
+                  strain: bool = False) -> 'SlotIndex':
+        """
+            Parses the page source and indexes the slot containers.
+            When strain is set only the slot containers are built into the tree.
+        """
+        parsed_source = cls.parse(source, parser, strain)
+        try:
+            return cls.from_soup(parsed_source)
+        finally:
+            # The tree is full of reference cycles, taking it apart frees it now instead of at the next collection
+            parsed_source.decompose()
+
+    @staticmethod
+    def parse(source: str, parser: str = DEFAULT_PARSER, strain: bool = False) -> BeautifulSoup:
+        """ Parses the page source with the requested backend """
+        if parser not in get_available_parsers():
+            LOGGER.warning('Parser %s is not available, falling back to %s', parser, DEFAULT_PARSER)
+            parser = DEFAULT_PARSER
+        parse_only = SoupStrainer(id=SLOT_CONTAINER_PATTERN) if strain else None
+        return BeautifulSoup(source, parser, parse_only=parse_only)
+
+    @classmethod
+    def from_soup(cls, parsed_source) -> 'SlotIndex':
+        """ Indexes the slot containers of an already parsed page """
+        dates: Dict[str, DateSlots] = {}
+        for container in parsed_source.find_all(id=SLOT_CONTAINER_PATTERN):
+            date = SLOT_CONTAINER_PATTERN.match(container['id']).group(1)
+            # The first container wins, the same as a find() by id
+            if date not in dates:
+                dates[date] = DateSlots.from_container(container, date)
+        return cls(dates)
+
+    @classmethod
+    def from_script_result(cls, result: Dict[str, Optional[dict]]) -> 'SlotIndex':
+        """ Indexes the result of running SLOT_EXTRACTION_SCRIPT in the page """
+        return cls({date: DateSlots.from_script_result(date, slots) for date, slots in result.items()})
+
+    def differences(self, other: 'SlotIndex') -> List[str]:
+        """ Returns the dates that are summarized differently in the two indexes """
+        dates = set(self.dates) | set(other.dates)
+        return sorted(date for date in dates if self.get(date) != other.get(date))
+
+    def get(self, date: str) -> DateSlots:
+        """ Returns the summary for the date, an empty summary if the date is not on the page """
+        slots: Optional[DateSlots] = self.dates.get(date)
+        if slots is None:
+            LOGGER.debug('No Time Slot found for %s', date)
+            return DateSlots(date)
+        return slots
+
+    def has_open_slots(self, date: str) -> bool:
+        """ Determines if there are any open time slots for the date """
+        return self.get(date).has_open_slots
+
+    def get_available_dates(self, date_range: List[str]) -> List[str]:
+        """ Returns the dates of the range that have open slots, in range order """
+        return [date for date in date_range if self.has_open_slots(date)]
+
+
+class IncrementalSlotExtractor:
+    """
+        Builds the slot index from the page source, parsing only the containers that changed.
+
+        The raw source is scanned for the slot containers without building a tree, every container
+        is hashed. When no hash changed the previous summaries are returned as they are, otherwise only
+        the containers with a new hash are parsed. The pages of different dates share the cache.
+        Pages where the containers cannot be delimited are parsed in full.
+        Pages are extracted one at a time, the parse workers of an account share the extractor.
+    """
+
+    def __init__(self, parser: str = DEFAULT_PARSER):
+        self.parser = parser
+        self.lock = threading.Lock()
+        self.fingerprints: Dict[str, bytes] = {}
+        self.dates: Dict[str, DateSlots] = {}
+        self.hits = 0 # Pages where nothing changed
+        self.misses = 0 # Pages where at least one container changed
+        self.dates_reused = 0
+        self.dates_parsed = 0
+        self.full_parses = 0
+
+    @staticmethod
+    def find_regions(source: str) -> Optional[Dict[str, str]]:
+        """
+            Returns the html of every slot container keyed by date, the first container of a date wins.
+            None when a container is not closed.
+        """
+        regions: Dict[str, str] = {}
+        position = 0
+        while True:
+            match = SLOT_CONTAINER_TAG_PATTERN.search(source, position)
+            if match is None:
+                return regions
+            tag, date = match.group(1), match.group(2)
+            tags = re.compile(f'<(/?){tag}\\b[^>]*>', re.IGNORECASE)
+            depth = 1
+            end = match.end()
+            while depth:
+                tag_match = tags.search(source, end)
+                if tag_match is None:
+                    return None
+                depth += -1 if tag_match.group(1) else 1
+                end = tag_match.end()
+            if date not in regions:
+                regions[date] = source[match.start():end]
+            position = end
+
+    def _full_parse(self, source: str) -> SlotIndex:
+        self.full_parses += 1
+        self.misses += 1
+        index = SlotIndex.from_html(source, self.parser)
+        for date in index.dates:
+            self.fingerprints.pop(date, None)
+        self.dates.update(index.dates)
+        self.dates_parsed += len(index.dates)
+        return index
+
+    def extract(self, source: str) -> SlotIndex:
+        """ Returns the slot index of the page source """
+        with self.lock:
+            return self._extract(source)
+
+    def _extract(self, source: str) -> SlotIndex:
+        regions = self.find_regions(source)
+        if not regions:
+            LOGGER.debug('Could not delimit the slot containers, parsing the whole page')
+            return self._full_parse(source)
+
+        fingerprints = {date: hashlib.blake2b(region.encode('utf-8'), digest_size=16).digest()
+                        for date, region in regions.items()}
+        # Every page of dates is compared with what was last seen of its own dates
+        if all(self.fingerprints.get(date) == fingerprint and date in self.dates
+               for date, fingerprint in fingerprints.items()):
+            self.hits += 1
+            self.dates_reused += len(fingerprints)
+            return SlotIndex({date: self.dates[date] for date in fingerprints})
+
+        self.misses += 1
+        dates: Dict[str, DateSlots] = {}
+        for date, region in regions.items():
+            if self.fingerprints.get(date) == fingerprints[date] and date in self.dates:
+                dates[date] = self.dates[date]
+                self.dates_reused += 1
+                continue
+            LOGGER.debug('Slot container of %s changed', date)
+            parsed_region = SlotIndex.parse(region, self.parser)
+            dates[date] = DateSlots.from_container(parsed_region.find(id=f'slot-container-{date}'), date)
+            parsed_region.decompose()
+            self.dates_parsed += 1
+        self.fingerprints.update(fingerprints)
+        self.dates.update(dates)
+        self._forget_past_dates()
+        return SlotIndex(dates)
+
+    def _forget_past_dates(self):
+        """ Drops the dates before today, they are never shown again """
+        today = datetime.date.today().isoformat()
+        for date in [date for date in self.dates if date < today]:
+            del self.dates[date]
+            self.fingerprints.pop(date, None)
+
+    def get_stats(self) -> Dict[str, int]:
+        """ Counters of the pages and dates that were reused or parsed """
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'dates_reused': self.dates_reused,
+            'dates_parsed': self.dates_parsed,
+            'full_parses': self.full_parses,
+        }
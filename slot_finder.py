@@ -1,25 +1,39 @@
 """
     Module for slot finding related classes and functions
 """
-from abc import ABC
+from abc import ABC, abstractmethod
 import os
 import time
 import datetime
 import platform
-from typing import List
+from typing import Callable, List, Optional, Set, TypeVar
 import logging
 
 
 from selenium import webdriver
-from bs4 import BeautifulSoup
+from selenium.common.exceptions import NoSuchElementException, WebDriverException
+
+from http_fetcher import HttpSlotFetcher, SessionExpiredError
+from memory_usage import MemoryLimits, get_process_tree_rss_bytes, update_python_memory
+from metrics import METRICS
+from page_readiness import PageReadiness, Signature
+from pipeline import CapturedPage, PageSnapshot, build_slot_index
+from slot_preferences import SlotPreferences
+from snapshot_archive import SnapshotRecorder
+from slot_extraction import (DEFAULT_PARSER, EXTRACTION_SCRIPT,
+                             EXTRACTION_SOUP, SLOT_EXTRACTION_SCRIPT, DateSlots,
+                             IncrementalSlotExtractor, SlotIndex, get_signature_dates,
+                             get_source_dates)
 
 LOGGER = logging.getLogger(__name__)
 
+T = TypeVar('T')
+
 class NotLoggedInError(Exception):
     """ Error for a user who has not gone through the login flow """
 
     def __init__(self, message):
-        super().__init__()
+        super().__init__(message)
         self.message = message
 
 class AmazonSlotFinder(ABC):
@@ -29,12 +43,41 @@ class AmazonSlotFinder(ABC):
     DRIVER_PATH = './drivers/'
     #pylint:disable-msg=C0301
     LOGIN_QUERY = 'Please login to Amazon, navigate to the timeslot selection page and press enter to continue'
+    #pylint:disable-msg=C0301
+    LOGIN_LOST_MESSAGE = 'The browser is no longer logged in, login to Amazon and navigate to the timeslot selection page in it, the checks resume from there'
+    #pylint:disable-msg=C0301
+    SLOT_PAGE_URL = 'https://www.amazon.com/gp/buy/shipoptionselect/handlers/display.html?hasWorkingJavascript=1'
+    SLOT_PAGE_PATH = '/gp/buy/shipoptionselect/'
+    SIGN_IN_PATH = '/ap/signin'
+    HEALTH_CHECK_SCRIPT = 'return document.readyState'
+    RECOVERY_ATTEMPTS = 3
+    RECOVERY_BACKOFF_SECONDS = 2
+    DEFAULT_HORIZON_DAYS = 8
+    MAX_PAGES = 10 # Pages of dates captured in one check at most
 
-    def __init__(self, driver):
-        #pylint:disable-msg=C0301
-        self.url = 'https://www.amazon.com/gp/buy/shipoptionselect/handlers/display.html?hasWorkingJavascript=1'
+    def __init__(self, driver, parser: str = DEFAULT_PARSER, strain: bool = False,
+                 readiness: Optional[PageReadiness] = None, extraction: str = EXTRACTION_SOUP,
+                 account: str = '', http_fetcher: Optional[HttpSlotFetcher] = None,
+                 incremental: bool = False, preferences: Optional[SlotPreferences] = None,
+                 horizon_days: int = DEFAULT_HORIZON_DAYS, recorder: Optional[SnapshotRecorder] = None,
+                 memory_limits: Optional[MemoryLimits] = None):
+        self.url = self.SLOT_PAGE_URL
         self.driver = driver
-        self.parsed_source = ''
+        self.parser = parser
+        self.strain = strain # Only build the slot containers into the tree
+        self.slot_index = SlotIndex({})
+        self.readiness = readiness or PageReadiness()
+        self.extraction = extraction
+        self.account = account
+        self.http_fetcher = http_fetcher
+        # Only re-parse the slot containers that changed since the previous cycle
+        self.incremental_extractor = IncrementalSlotExtractor(parser) if incremental else None
+        self.preferences = preferences or SlotPreferences()
+        self.horizon_days = max(1, horizon_days) # Number of days checked, starting today
+        self.recorder = recorder # Archives every captured snapshot when set
+        self.memory_limits = memory_limits or MemoryLimits()
+        self.driver_checks = 0 # Checks made by the current browser
+        self.driver_rss_bytes: Optional[int] = None
         self.logged_in = False # A default assumption that the user will not be logged in
         super().__init__()
 
@@ -60,15 +103,156 @@ class AmazonSlotFinder(ABC):
             return '.linux'
         return ''
 
-    def login(self):
+    def login(self, interactive: bool = True):
         """
             Opens the web page and wait for the user to login.
-            Sets up the webpage so that the correct page is open in the browser instance
+            Sets up the webpage so that the correct page is open in the browser instance.
+            The prompt is skipped when the browser profile still has a logged in session.
+            When not interactive, as for a browser replaced during a check on a pool thread,
+            NotLoggedInError is raised instead of prompting.
         """
-        self.driver.get(self.url)
-        time.sleep(2)
-        input(self.LOGIN_QUERY)
+        if self._resume_session():
+            LOGGER.info('Reusing the logged in browser session%s', f' of {self.account}' if self.account else '')
+        elif not interactive:
+            raise NotLoggedInError(self.LOGIN_LOST_MESSAGE)
+        else:
+            time.sleep(2)
+            if self.account:
+                input(f'[{self.account}] {self.LOGIN_QUERY}')
+            else:
+                input(self.LOGIN_QUERY)
+        self._set_logged_in()
+
+    def _set_logged_in(self):
         self.logged_in = True
+        if self.http_fetcher:
+            self.http_fetcher.load_session(self.driver)
+
+    def _resume_login(self):
+        """
+            Picks the checks up again once the user has logged in and navigated to the slot page in
+            a browser that lost its session. The browser is left alone until then.
+        """
+        if self.SLOT_PAGE_PATH not in self.driver.current_url or not self.readiness.wait_until_ready(self.driver):
+            raise NotLoggedInError(self.LOGIN_LOST_MESSAGE)
+        LOGGER.info('The browser%s is logged in again', f' of {self.account}' if self.account else '')
+        self._set_logged_in()
+
+    def _resume_session(self) -> bool:
+        """
+            Opens the slot page, unless an attached browser is already on it, and returns
+            True when it shows the slot containers instead of the sign in page
+        """
+        if self.SLOT_PAGE_PATH not in self.driver.current_url:
+            self.driver.get(self.url)
+        if self.SIGN_IN_PATH in self.driver.current_url:
+            return False
+        return self.readiness.wait_until_ready(self.driver)
+
+    def is_healthy(self) -> bool:
+        """ Returns False when the browser no longer answers, it crashed or its window was closed """
+        try:
+            self.driver.execute_script(self.HEALTH_CHECK_SCRIPT)
+        except WebDriverException as error:
+            LOGGER.warning('Browser health check failed: %s', error)
+            return False
+        return True
+
+    @abstractmethod
+    def create_driver(self):
+        """ Starts a new browser, implemented by the browser specific finders """
+
+    def can_resume_session(self) -> bool:
+        """ True when a new browser finds the login of the current one, so it can be replaced without a prompt """
+        return False
+
+    def can_recycle(self) -> bool:
+        """ True when replacing the browser keeps the login and gives the memory of the old one back """
+        return self.can_resume_session()
+
+    def get_driver_pid(self) -> Optional[int]:
+        """ The process of the driver, the browser processes are its children """
+        process = getattr(getattr(self.driver, 'service', None), 'process', None)
+        return getattr(process, 'pid', None)
+
+    def recover(self):
+        """
+            Replaces a broken browser with a new one on the same profile.
+            The new browser is logged in again from the profile, NotLoggedInError is raised when the
+            profile lost the session since this runs during a check, where nobody answers a prompt.
+        """
+        METRICS.increment('driver_recoveries_total', account=self.account)
+        self._replace_driver()
+
+    def recycle(self, reason: str):
+        """ Replaces a working browser with a new one on the same profile, to give back the memory it grew to """
+        LOGGER.info('Replacing the browser%s after %s checks (%s)', f' of {self.account}' if self.account else '',
+                    self.driver_checks, reason)
+        METRICS.increment('driver_recycles_total', account=self.account, reason=reason)
+        self._replace_driver()
+
+    def _replace_driver(self):
+        try:
+            self.driver.quit()
+        except Exception as error: # pylint: disable=broad-except
+            LOGGER.debug('Could not quit the browser: %s', error)
+        self.logged_in = False
+        self.driver_checks = 0
+        for attempt in range(1, self.RECOVERY_ATTEMPTS + 1):
+            try:
+                self.driver = self.create_driver()
+                self.login(interactive=False)
+                return
+            except WebDriverException as error:
+                if attempt == self.RECOVERY_ATTEMPTS:
+                    raise
+                LOGGER.warning('Could not start a new browser, attempt %s: %s', attempt, error)
+                time.sleep(self.RECOVERY_BACKOFF_SECONDS * attempt)
+
+    def check(self, refresh: bool = True) -> List[str]:
+        """
+            Runs one slot check, refreshing the page first when refresh is set.
+            A browser that fails the health check or raises a WebDriver error during the check
+            is replaced and the check is run once more on the new browser.
+        """
+        return self._with_recovery(refresh, self.get_available_dates)
+
+    def capture(self, refresh: bool = True) -> PageSnapshot:
+        """ The fetch stage of a pipelined check, recovers the browser the same way as check """
+        return self._with_recovery(refresh, self.capture_snapshot)
+
+    def _update_memory(self) -> str:
+        """ Updates the memory gauges, returns why the browser should be replaced or an empty string """
+        update_python_memory(self.memory_limits)
+        self.driver_rss_bytes = get_process_tree_rss_bytes(self.get_driver_pid())
+        if self.driver_rss_bytes is not None:
+            METRICS.set_gauge('driver_rss_bytes', self.driver_rss_bytes, account=self.account)
+        reason = self.memory_limits.get_recycle_reason(self.driver_checks, self.driver_rss_bytes)
+        if reason and not self.can_recycle():
+            LOGGER.debug('Not replacing the browser (%s), a new one would not keep the login or free the memory', reason)
+            return ''
+        return reason
+
+    def _with_recovery(self, refresh: bool, action: Callable[[], T]) -> T:
+        recycle_reason = self._update_memory()
+        if not self.is_healthy():
+            self.recover()
+            refresh = False # The new browser has just loaded the page
+        elif recycle_reason:
+            self.recycle(recycle_reason)
+            refresh = False
+        elif not self.logged_in:
+            self._resume_login()
+            refresh = False
+        self.driver_checks += 1
+        try:
+            if refresh:
+                self.refresh_page()
+            return action()
+        except WebDriverException as error:
+            LOGGER.warning('Browser failed during the slot check, starting a new one: %s', error)
+        self.recover()
+        return action()
 
     def get_date_range(self) -> List[str]:
         """
@@ -77,7 +261,7 @@ class AmazonSlotFinder(ABC):
         results = []
         current_date_time = datetime.date.today()
         results.append(current_date_time.strftime(self.DATE_FORMAT_STRING))
-        for i in range(1, 8):
+        for i in range(1, self.horizon_days):
             date_time_step = current_date_time + datetime.timedelta(days=i)
             results.append(date_time_step.strftime(self.DATE_FORMAT_STRING))
         return results
@@ -92,82 +276,238 @@ class AmazonSlotFinder(ABC):
             If the number of radio buttons (dates) found is equal to the number of disabled radio buttons, then there are no dates available.
         """
         LOGGER.debug('Checking for time slot for date %s', date)
-        if time_slot is None:
-            LOGGER.debug('No Time Slot found for %s', date)
-            return False
-        # We're going to retrieve the unattended time slots only for now. Quarantine yall
-        time_slot_unattended = time_slot.find(
-            "div", {"id": "slot-container-UNATTENDED"})
+        return DateSlots.from_container(time_slot, date).has_open_slots
 
-        if time_slot_unattended.find("div", {"class": "a-box a-alert a-alert-info"}):
-            # There is an alert box telling us that there is no time slot available for the given date
-            LOGGER.debug('No available dates for %s', date)
-            return False
-
-        list_of_time_slots = time_slot_unattended.find(
-            "div", {"id": f'root-{date}-UNATTENDED-box-group'}).find_all("div", recursive=False)
+    def refresh_page(self):
+        """ Refreshes the current page """
+        if self.http_fetcher and self.http_fetcher.active:
+            LOGGER.debug('Page is fetched over HTTP, skipping the browser refresh')
+            return
+        self._refresh_browser()
 
-        list_of_disabled_time_slots = time_slot_unattended.find(
-            "div", {"id": f'root-{date}-UNATTENDED-box-group'}).find_all("div", {"class": "disabledRadioBox"})
+    def _refresh_browser(self):
+        with METRICS.span('refresh', account=self.account):
+            self.driver.refresh()
+        LOGGER.debug('Waiting for the slot containers after refresh')
+        with METRICS.span('page_ready', account=self.account):
+            self.readiness.wait_until_ready(self.driver)
+        LOGGER.debug('Done waiting after refresh')
 
-        LOGGER.debug('Number of time slots found: %s ', len(list_of_time_slots))
-        LOGGER.debug(
-            'Number of disabled time slots found: %s', len(list_of_disabled_time_slots))
-        return len(list_of_time_slots) != len(list_of_disabled_time_slots)
+    def _get_page_source(self) -> str:
+        """ Takes the source of the web page from selenium """
+        if not self.logged_in:
+            raise NotLoggedInError('User must have gone through the logged in flow')
+        with METRICS.span('page_source', account=self.account):
+            return self.driver.page_source
 
-    def refresh_page(self):
-        """ Refreshes the current page """
-        self.driver.refresh()
-        LOGGER.debug('Sleeping the thread after refresh')
-        time.sleep(10) # There is no way to know when the async calls on the page are done.
-        LOGGER.debug('Thread finished sleeping after refresh')
+    def _run_extraction_script(self) -> Optional[dict]:
+        """
+            Runs the extraction script in the page so only the slot summary crosses the wire.
+            Returns None when the script fails, the page source is then parsed with Beautiful Soup.
+        """
+        if not self.logged_in:
+            raise NotLoggedInError('User must have gone through the logged in flow')
+        try:
+            with METRICS.span('script_extract', account=self.account):
+                result = self.driver.execute_script(SLOT_EXTRACTION_SCRIPT)
+        except Exception as error: # pylint: disable=broad-except
+            LOGGER.warning('Slot extraction script failed, falling back to Beautiful Soup: %s', error)
+            return None
+        if result is None:
+            LOGGER.warning('Slot extraction script returned nothing, falling back to Beautiful Soup')
+        return result
 
-    def _parse_with_beautiful_soup(self):
+    def _fetch_over_http(self) -> Optional[str]:
         """
-            Takes the source of the web page from selenium and parses it in a Beautiful Soup context
+            Returns the slot page fetched over HTTP.
+            Returns None when the browser has to be used, the browser page is then
+            reloaded and its session is copied again for the next cycle.
         """
+        if not self.http_fetcher:
+            return None
         if not self.logged_in:
             raise NotLoggedInError('User must have gone through the logged in flow')
-        source = self.driver.page_source
-        self.parsed_source = BeautifulSoup(source, "html.parser")
-
-    def _load_next_set_of_dates(self):
-        """ Click the next button the page to load the next set of dates """
-        next_button = self.driver.find_element_by_xpath("//*[@id='nextButton-announce']")
-        if next_button:
-            # Should now have loaded 8 dates
-            LOGGER.debug('Clicking on the next button to load more dates')
+
+        if self.http_fetcher.active:
+            try:
+                with METRICS.span('http_fetch', account=self.account):
+                    return self.http_fetcher.fetch()
+            except SessionExpiredError as error:
+                LOGGER.warning('HTTP session expired, falling back to the browser: %s', error.message)
+            self.refresh_page()
+
+        # Copy the browser session again so the next cycle can go back to HTTP
+        self.http_fetcher.load_session(self.driver)
+        return None
+
+    def _load_next_set_of_dates(self, previous: Signature) -> bool:
+        """
+            Click the next button the page to load the next set of dates.
+            Returns False when there is no next button.
+        """
+        try:
+            next_button = self.driver.find_element_by_xpath("//*[@id='nextButton-announce']")
+        except NoSuchElementException:
+            LOGGER.debug('No next button, this is the last page of dates')
+            return False
+        LOGGER.debug('Clicking on the next button to load more dates')
+        with METRICS.span('next_click', account=self.account):
             next_button.click()
-            LOGGER.debug('Sleeping thread after clicking next')
-            time.sleep(10)
-            LOGGER.debug('Done sleeping after clicking next')
+        LOGGER.debug('Waiting for the slot containers after clicking next')
+        with METRICS.span('page_ready', account=self.account):
+            self.readiness.wait_until_ready(self.driver, previous)
+        LOGGER.debug('Done waiting after clicking next')
+        return True
 
-    def get_available_dates(self) -> List[str]:
+    def _capture_page(self) -> CapturedPage:
+        """ Captures the current page with what the configured extraction mode needs """
+        script_result = None
+        if self.extraction != EXTRACTION_SOUP:
+            script_result = self._run_extraction_script()
+        source = None
+        if script_result is None or self.extraction != EXTRACTION_SCRIPT:
+            source = self._get_page_source()
+        return source, script_result
+
+    def _capture_pages(self, date_range: List[str], captured: Optional[Set[str]] = None) -> List[CapturedPage]:
         """
-            Tries to find any dates that have open slots available for delivery
+            Captures the pages of dates in the browser until the date range is covered.
+            Every page is captured once, a page that shows no date that was not seen yet ends the paging.
+            The first page is only paged past when the dates it shows were captured already.
+        """
+        wanted = set(date_range)
+        seen: Set[str] = set(captured or ())
+        pages: List[CapturedPage] = []
+        for page in range(self.MAX_PAGES):
+            signature = self.readiness.capture(self.driver)
+            page_dates = get_signature_dates(signature or ())
+            new_dates = page_dates - seen
+            if page and not new_dates:
+                LOGGER.debug('The next page shows no new dates, stopping after %s pages', page)
+                break
+            if new_dates or signature is None:
+                pages.append(self._capture_page())
+            seen |= page_dates
+            if signature is None or wanted <= seen:
+                break
+            if not self._load_next_set_of_dates(signature):
+                break
+        METRICS.set_gauge('pages_per_check', len(pages), account=self.account)
+        missing = wanted - seen
+        if missing and seen:
+            LOGGER.debug('Dates not shown on any page: %s', sorted(missing))
+        return pages
+
+    def capture_snapshot(self) -> PageSnapshot:
+        """
+            Drives the browser through the pages of dates and captures what the configured extraction
+            mode needs, without parsing it. Beautiful Soup is used when the script fails, and as the
+            reference in cross-check mode.
         """
         date_range = self.get_date_range()
         LOGGER.debug('Date Range - %s', date_range)
 
-        self._load_next_set_of_dates()
-        self._parse_with_beautiful_soup()
+        source = self._fetch_over_http()
+        if source is None:
+            pages = self._capture_pages(date_range)
+        else:
+            pages = [(source, None)]
+            fetched_dates = get_source_dates(source)
+            if not set(date_range) <= fetched_dates:
+                # The other pages are loaded by the next button, only the browser can get to them.
+                # The browser would then load the first page on every cycle anyway, so fetching it does not help
+                self.http_fetcher.disable(f'The fetched page shows {len(fetched_dates & set(date_range))} '
+                                          f'of the {len(date_range)} days to check')
+                self._refresh_browser()
+                pages += self._capture_pages(date_range, fetched_dates)
+        snapshot = PageSnapshot(self.account, date_range, pages, self.parser, self.strain, self.preferences,
+                                self.incremental_extractor is not None)
+        if self.recorder:
+            try:
+                with METRICS.span('record', account=self.account):
+                    self.recorder.record(snapshot)
+            except OSError as error:
+                LOGGER.warning('Could not record the snapshot: %s', error)
+        return snapshot
+
+    def detect(self, snapshot: PageSnapshot) -> List[str]:
+        """ Indexes a snapshot on the calling thread and returns the dates that have open slots """
+        with METRICS.span('parse', account=self.account):
+            self.slot_index = build_slot_index(snapshot, self.incremental_extractor)
 
-        available_dates = []
-        for date in date_range:
-            slot_container_id = f'slot-container-{date}'
-            time_slot = self.parsed_source.find(id=slot_container_id)
-            if AmazonSlotFinder.has_open_slots(time_slot, date):
-                LOGGER.debug('Found an available time slot for %s', date)
-                available_dates.append(date)
+        with METRICS.span('detect', account=self.account):
+            available_dates = []
+            for date in snapshot.date_range:
+                if self.preferences.matches(self.slot_index.get(date)):
+                    LOGGER.debug('Found an available time slot for %s', date)
+                    available_dates.append(date)
         return available_dates
 
+    def get_available_dates(self) -> List[str]:
+        """
+            Tries to find any dates that have open slots available for delivery
+        """
+        return self.detect(self.capture_snapshot())
+
 
 class ChromeAmazonSlotFinder(AmazonSlotFinder):
     """
         Chrome specific slot finder
     """
 
-    def __init__(self):
-        driver_exec = self.get_driver_for_browser_and_os('chrome')
-        driver = webdriver.Chrome(driver_exec)
-        super().__init__(driver)
+    def __init__(self, parser: str = DEFAULT_PARSER, strain: bool = False,
+                 readiness: Optional[PageReadiness] = None, extraction: str = EXTRACTION_SOUP,
+                 account: str = '', user_data_dir: Optional[str] = None,
+                 http_fetcher: Optional[HttpSlotFetcher] = None, incremental: bool = False,
+                 debugger_address: Optional[str] = None, preferences: Optional[SlotPreferences] = None,
+                 horizon_days: int = AmazonSlotFinder.DEFAULT_HORIZON_DAYS,
+                 recorder: Optional[SnapshotRecorder] = None, memory_limits: Optional[MemoryLimits] = None):
+        self.driver_exec = self.get_driver_for_browser_and_os('chrome')
+        self.user_data_dir = user_data_dir
+        # host:port of a Chrome started with --remote-debugging-port, attached to instead of starting one
+        self.debugger_address = debugger_address
+        super().__init__(self.create_driver(), parser, strain, readiness, extraction, account,
+                         http_fetcher, incremental, preferences, horizon_days, recorder, memory_limits)
+
+    def can_resume_session(self) -> bool:
+        """ The login is kept in the profile directory, or in the browser that is attached to """
+        return bool(self.user_data_dir or self.debugger_address)
+
+    def can_recycle(self) -> bool:
+        """
+            A browser on a debugger address is left running when its driver quits, the new driver
+            would attach to the same browser, so only browsers started on a profile are replaced
+        """
+        return bool(self.user_data_dir) and not self.debugger_address
+
+    def get_driver_pid(self) -> Optional[int]:
+        """ The browser on a debugger address is not a child of the driver, its memory is not measured """
+        if self.debugger_address:
+            return None
+        return super().get_driver_pid()
+
+    def create_driver(self):
+        """
+            Attaches to the running browser when a debugger address is set, otherwise starts Chrome
+            on the profile. A browser started for a debugger address is left running when the
+            program exits so the next start can attach to it, already logged in and on the slot page.
+        """
+        if self.debugger_address:
+            options = webdriver.ChromeOptions()
+            options.add_experimental_option('debuggerAddress', self.debugger_address)
+            try:
+                driver = webdriver.Chrome(self.driver_exec, options=options)
+                LOGGER.info('Attached to the browser at %s', self.debugger_address)
+                return driver
+            except WebDriverException as error:
+                LOGGER.warning('Could not attach to the browser at %s, starting a new one: %s',
+                               self.debugger_address, error)
+
+        options = webdriver.ChromeOptions()
+        if self.user_data_dir:
+            # Every account needs its own profile so the logins do not share cookies
+            options.add_argument(f'--user-data-dir={self.user_data_dir}')
+        if self.debugger_address:
+            options.add_argument(f'--remote-debugging-port={self.debugger_address.rsplit(":", 1)[-1]}')
+            options.add_experimental_option('detach', True)
+        return webdriver.Chrome(self.driver_exec, options=options)
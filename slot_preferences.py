@@ -0,0 +1,123 @@
+"""
+    User preference rules for the delivery windows, evaluated against the extracted slot index
+"""
+import datetime
+import logging
+from typing import FrozenSet, List, Optional, Sequence
+
+from slot_extraction import ATTENDED, DELIVERY_TYPES, UNATTENDED, DateSlots, SlotIndex, TimeWindow
+
+LOGGER = logging.getLogger(__name__)
+
+DAY_NAMES = ['mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun']
+DELIVERY_ANY = 'any'
+
+
+def parse_time_of_day(value) -> int:
+    """
+        Minutes after midnight of a HH:MM string, or of a number of hours.
+        YAML reads an unquoted 17:30 as the number 1050, numbers past the hours of a day are refused.
+    """
+    if isinstance(value, (int, float)):
+        if not 0 <= value < 24:
+            hours, minutes = divmod(int(value), 60) if 0 < value < 24 * 60 else (17, 30)
+            raise ValueError(f'{value} is not an hour of the day, write times in quotes like "{hours}:{minutes:02d}"')
+        return int(value * 60)
+    hours, _, minutes = str(value).partition(':')
+    return int(hours) * 60 + int(minutes or 0)
+
+
+class PreferenceRule:
+    """
+        A set of windows the user would take: delivery types, days of the week and a time of day range.
+        A date matches when it has at least min_windows enabled windows within the rule.
+    """
+
+    NAME_KEY = 'name'
+    DAYS_KEY = 'days'
+    DELIVERY_KEY = 'delivery'
+    FROM_KEY = 'from'
+    UNTIL_KEY = 'until'
+    MIN_WINDOWS_KEY = 'min_windows'
+
+    def __init__(self, name: str, delivery_types: FrozenSet[str] = frozenset((UNATTENDED,)),
+                 days: Optional[FrozenSet[int]] = None, start_minutes: Optional[int] = None,
+                 end_minutes: Optional[int] = None, min_windows: int = 1):
+        self.name = name
+        self.delivery_types = delivery_types
+        self.days = days # Days of the week, Monday is 0, None for every day
+        self.start_minutes = start_minutes
+        self.end_minutes = end_minutes
+        self.min_windows = max(1, min_windows)
+
+    @classmethod
+    def from_dict(cls, rule: dict, index: int = 0) -> 'PreferenceRule':
+        """ Builds a rule from an entry of the preferences section of the config file """
+        delivery = rule.get(cls.DELIVERY_KEY, UNATTENDED.lower())
+        if isinstance(delivery, str):
+            delivery = DELIVERY_TYPES if delivery.lower() == DELIVERY_ANY else [delivery]
+        delivery_types = frozenset(str(delivery_type).upper() for delivery_type in delivery)
+        unknown = delivery_types - {ATTENDED, UNATTENDED}
+        if unknown:
+            raise ValueError(f'Unknown delivery type {", ".join(sorted(unknown))}')
+
+        days = None
+        if rule.get(cls.DAYS_KEY):
+            days = frozenset(DAY_NAMES.index(str(day).lower()[:3]) for day in rule[cls.DAYS_KEY])
+
+        name = str(rule.get(cls.NAME_KEY, f'rule {index + 1}'))
+        times = []
+        for key in (cls.FROM_KEY, cls.UNTIL_KEY):
+            try:
+                times.append(parse_time_of_day(rule[key]) if rule.get(key) is not None else None)
+            except ValueError as error:
+                raise ValueError(f'Invalid {key} of the preference {name}: {error}') from error
+        return cls(name, delivery_types, days, times[0], times[1], int(rule.get(cls.MIN_WINDOWS_KEY, 1)))
+
+    def matches_window(self, window: TimeWindow) -> bool:
+        """ True when the window can be selected and falls within the rule """
+        if not window.enabled or window.delivery_type not in self.delivery_types:
+            return False
+        if self.start_minutes is None and self.end_minutes is None:
+            return True
+        if window.start_minutes < 0:
+            return False # A time range was asked for but the window label has no times
+        if self.start_minutes is not None and window.start_minutes < self.start_minutes:
+            return False
+        return self.end_minutes is None or window.end_minutes <= self.end_minutes
+
+    def matches(self, slots: DateSlots, day_of_week: int) -> bool:
+        """ True when the date has enough windows within the rule """
+        if self.days is not None and day_of_week not in self.days:
+            return False
+        return sum(1 for window in slots.windows if self.matches_window(window)) >= self.min_windows
+
+
+class SlotPreferences:
+    """
+        The preference rules of the user, a date is wanted when any rule matches it.
+        Without rules a date is wanted when it has an open unattended window.
+    """
+
+    def __init__(self, rules: Sequence[PreferenceRule] = ()):
+        self.rules = list(rules)
+
+    @classmethod
+    def from_config(cls, rules: List[dict]) -> 'SlotPreferences':
+        """ Builds the preferences from the preferences section of the config file """
+        return cls([PreferenceRule.from_dict(rule, index) for index, rule in enumerate(rules)])
+
+    def matches(self, slots: DateSlots) -> bool:
+        """ True when the date has windows the user wants """
+        if not self.rules:
+            return slots.has_open_slots
+        day_of_week = datetime.date.fromisoformat(slots.date).weekday()
+        for rule in self.rules:
+            if rule.matches(slots, day_of_week):
+                LOGGER.debug('%s matches the preference %s', slots.date, rule.name)
+                return True
+        return False
+
+    def get_available_dates(self, slot_index: SlotIndex, date_range: List[str]) -> List[str]:
+        """ Returns the dates of the range the user wants, in range order """
+        return [date for date in date_range if self.matches(slot_index.get(date))]
@@ -0,0 +1,214 @@
+"""
+    Archive of the captured pages, for replaying the detection offline over months of real pages
+"""
+import os
+import gzip
+import json
+import time
+import hashlib
+import logging
+import tempfile
+import threading
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Iterator, List, Optional, Set
+
+from pipeline import PageSnapshot, detect_snapshot
+from slot_extraction import IncrementalSlotExtractor
+from slot_preferences import SlotPreferences
+
+LOGGER = logging.getLogger(__name__)
+
+RECORD_PAGE = 'page'
+RECORD_SLOTS = 'slots'
+RECORD_MODES = [RECORD_PAGE, RECORD_SLOTS]
+
+# Wraps the recorded slot containers so they parse like the page they came from
+REGIONS_PAGE_TEMPLATE = '<html><body>{}</body></html>'
+
+
+class SnapshotArchive:
+    """
+        Snapshots on disk, deduplicated by content.
+
+        Every page source, slot container and script result is stored once as a gzip file named by
+        the sha256 of its content, so a container that did not change between checks costs nothing.
+        The snapshots are lines of index.jsonl that reference those files.
+    """
+
+    INDEX_FILE_NAME = 'index.jsonl'
+    OBJECTS_DIR_NAME = 'objects'
+    COMPRESS_LEVEL = 6
+
+    def __init__(self, path: str):
+        self.path = path
+        self.index_file = os.path.join(path, self.INDEX_FILE_NAME)
+        self.objects_dir = os.path.join(path, self.OBJECTS_DIR_NAME)
+        self.lock = threading.Lock()
+        self.known: Set[str] = set() # Objects known to be stored, saves a stat per object
+        self.bytes_written = 0
+
+    def _get_object_path(self, key: str) -> str:
+        return os.path.join(self.objects_dir, key[:2], key + '.gz')
+
+    def put(self, content: str) -> str:
+        """ Stores the content unless it is stored already, returns its key """
+        data = content.encode('utf-8')
+        key = hashlib.sha256(data).hexdigest()
+        if key in self.known:
+            return key
+        path = self._get_object_path(key)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            compressed = gzip.compress(data, self.COMPRESS_LEVEL)
+            # Written aside and renamed so a crash never leaves half an object under its key
+            file_descriptor, temp_file = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+            try:
+                with os.fdopen(file_descriptor, 'wb') as object_file:
+                    object_file.write(compressed)
+                os.replace(temp_file, path)
+            except BaseException:
+                os.unlink(temp_file)
+                raise
+            self.bytes_written += len(compressed)
+        self.known.add(key)
+        return key
+
+    def get(self, key: str) -> str:
+        """ The content stored under the key """
+        with gzip.open(self._get_object_path(key), 'rb') as object_file:
+            return object_file.read().decode('utf-8')
+
+    def append(self, entry: dict):
+        """ Adds a snapshot entry to the index """
+        line = json.dumps(entry, separators=(',', ':')) + '\n'
+        with self.lock:
+            os.makedirs(self.path, exist_ok=True)
+            with open(self.index_file, 'a', encoding='utf-8') as index_file:
+                index_file.write(line)
+
+    def iter_entries(self, account: Optional[str] = None) -> Iterator[dict]:
+        """ Streams the snapshot entries in capture order, of one account or of all of them """
+        if not os.path.exists(self.index_file):
+            return
+        with open(self.index_file, encoding='utf-8') as index_file:
+            for number, line in enumerate(index_file, 1):
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    LOGGER.warning('Skipping the unreadable line %s of %s', number, self.index_file)
+                    continue
+                if account is None or entry['account'] == account:
+                    yield entry
+
+    def load(self, entry: dict, preferences: Optional[SlotPreferences] = None) -> PageSnapshot:
+        """ Rebuilds the snapshot of an index entry """
+        pages = []
+        for page in entry['pages']:
+            source = None
+            if page.get('source'):
+                source = self.get(page['source'])
+            elif page.get('regions') is not None:
+                source = REGIONS_PAGE_TEMPLATE.format(''.join(self.get(key) for key in page['regions']))
+            script_result = json.loads(self.get(page['script'])) if page.get('script') else None
+            pages.append((source, script_result))
+        snapshot = PageSnapshot(entry['account'], entry['date_range'], pages, entry['parser'], entry['strain'],
+                                preferences)
+        snapshot.captured_at = entry['captured_at']
+        return snapshot
+
+
+class SnapshotRecorder:
+    """
+        Records every captured snapshot in the archive, the whole page or only its slot containers.
+        A page whose containers cannot be delimited is recorded whole.
+    """
+
+    def __init__(self, archive: SnapshotArchive, mode: str = RECORD_PAGE):
+        self.archive = archive
+        self.mode = mode
+        self.recorded = 0
+
+    def _put_page(self, source: Optional[str]) -> dict:
+        if source is None:
+            return {}
+        if self.mode == RECORD_SLOTS:
+            regions = IncrementalSlotExtractor.find_regions(source)
+            if regions:
+                return {'regions': [self.archive.put(region) for region in regions.values()]}
+        return {'source': self.archive.put(source)}
+
+    def record(self, snapshot: PageSnapshot):
+        """ Writes the snapshot to the archive """
+        pages = []
+        for source, script_result in snapshot.pages:
+            page = self._put_page(source)
+            if script_result is not None:
+                page['script'] = self.archive.put(json.dumps(script_result, sort_keys=True))
+            pages.append(page)
+        self.archive.append({'account': snapshot.account, 'captured_at': snapshot.captured_at,
+                             'date_range': snapshot.date_range, 'parser': snapshot.parser,
+                             'strain': snapshot.strain, 'pages': pages})
+        self.recorded += 1
+
+
+class ReplayResult:
+    """ What the detection found in one archived snapshot """
+
+    def __init__(self, account: str, captured_at: float, available_dates: List[str], dates_found: int,
+                 parse_seconds: float, error: Optional[str] = None):
+        self.account = account
+        self.captured_at = captured_at
+        self.available_dates = available_dates
+        self.dates_found = dates_found
+        self.parse_seconds = parse_seconds
+        self.error = error
+
+
+class ReplayReport:
+    """ The results of a replay in capture order, and its throughput """
+
+    def __init__(self, results: List[ReplayResult], wall_seconds: float, workers: int):
+        self.results = results
+        self.wall_seconds = wall_seconds
+        self.workers = workers
+
+    @property
+    def snapshots_per_second(self) -> float:
+        """ Snapshots replayed per second of wall time """
+        return len(self.results) / self.wall_seconds if self.wall_seconds else 0.0
+
+    @property
+    def errors(self) -> int:
+        """ Snapshots that could not be replayed """
+        return sum(1 for result in self.results if result.error)
+
+
+def replay_entry(archive_path: str, entry: dict, preferences: Optional[SlotPreferences]) -> ReplayResult:
+    """ Loads and detects one snapshot, runs in the replay workers so the pages never cross processes """
+    try:
+        snapshot = SnapshotArchive(archive_path).load(entry, preferences)
+        result = detect_snapshot(snapshot)
+    except Exception as error: # pylint: disable=broad-except
+        return ReplayResult(entry['account'], entry['captured_at'], [], 0, 0.0, f'{type(error).__name__}: {error}')
+    return ReplayResult(entry['account'], entry['captured_at'], result.available_dates,
+                        len(result.slot_index.dates), result.parse_seconds)
+
+
+def replay(archive: SnapshotArchive, preferences: Optional[SlotPreferences] = None,
+           account: Optional[str] = None, workers: Optional[int] = None,
+           use_processes: bool = True) -> ReplayReport:
+    """ Runs the detection over every archived snapshot on a pool of processes, or threads """
+    entries = list(archive.iter_entries(account))
+    workers = max(1, workers or os.cpu_count() or 1)
+    # Large chunks keep the per task overhead of the process pool low, small enough to balance the load
+    chunksize = max(1, len(entries) // (workers * 4))
+    executor: Executor
+    if use_processes:
+        executor = ProcessPoolExecutor(max_workers=workers)
+    else:
+        executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='replay')
+    start = time.perf_counter()
+    with executor:
+        results = list(executor.map(replay_entry, [archive.path] * len(entries), entries,
+                                    [preferences] * len(entries), chunksize=chunksize))
+    return ReplayReport(results, time.perf_counter() - start, workers)
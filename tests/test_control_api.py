@@ -0,0 +1,54 @@
+"""
+    Tests of the Unix socket of the control API
+"""
+import os
+import stat
+import errno
+import socket
+import tempfile
+import unittest
+from types import SimpleNamespace
+
+import control_api
+from polling_scheduler import FixedPolicy
+
+
+@unittest.skipUnless(hasattr(socket, 'AF_UNIX'), 'Unix sockets are not available')
+class ControlSocketTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.socket_path = os.path.join(directory.name, 'control.sock')
+        pool = SimpleNamespace(last_results={'a': {'available_dates': []}}, last_errors={})
+        self.api = control_api.ControlApi(pool, None, FixedPolicy(lambda: 300))
+
+    def serve(self):
+        server = control_api.serve(self.api, socket_path=self.socket_path)
+        self.addCleanup(control_api.close, server)
+        return server
+
+    def test_only_the_owner_can_connect(self):
+        self.serve()
+        self.assertEqual(stat.S_IMODE(os.stat(self.socket_path).st_mode) & 0o077, 0)
+        self.assertEqual(control_api.send_request('GET', '/results', socket_path=self.socket_path),
+                         (200, {'results': {'a': {'available_dates': []}}, 'errors': {}}))
+
+    def test_refuses_the_socket_of_a_running_daemon(self):
+        self.serve()
+        with self.assertRaises(OSError) as raised:
+            control_api.UnixHTTPServer(self.socket_path, control_api.BaseHTTPRequestHandler)
+        self.assertEqual(raised.exception.errno, errno.EADDRINUSE)
+        self.assertTrue(control_api.is_listening(self.socket_path))
+
+    def test_replaces_a_stale_socket(self):
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        stale.bind(self.socket_path)
+        stale.close() # The file stays behind, nothing listens on it
+        self.assertFalse(control_api.is_listening(self.socket_path))
+        self.serve()
+        self.assertTrue(control_api.is_listening(self.socket_path))
+
+
+if __name__ == '__main__':
+    unittest.main()
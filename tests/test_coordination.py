@@ -0,0 +1,162 @@
+"""
+    Tests of the leases and notification claims shared by several instances, on a temporary
+    SQLite file with an injected clock, and on a fake Redis when fakeredis is installed
+"""
+import os
+import tempfile
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+from coordination import (CLAIM_BUSY, CLAIM_GRANTED, CLAIM_SENT, Coordinator, RedisCoordinationBackend,
+                          SqliteCoordinationBackend)
+from finder_pool import FinderPool
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+LEASE_SECONDS = 30
+
+
+class CoordinatorTestCase:
+    """ What every backend must do, with two instances sharing the store """
+
+    def create_backend(self):
+        raise NotImplementedError
+
+    def setUp(self):
+        self.now = 1000.0
+        self.first = Coordinator(self.create_backend(), LEASE_SECONDS, 'first', clock=lambda: self.now)
+        self.second = Coordinator(self.create_backend(), LEASE_SECONDS, 'second', clock=lambda: self.now)
+        self.addCleanup(self.second.stop)
+        self.addCleanup(self.first.stop)
+
+    def test_only_one_instance_holds_a_lease(self):
+        self.assertTrue(self.first.acquire('a'))
+        self.assertFalse(self.second.acquire('a'))
+        self.assertTrue(self.second.acquire('b'))
+        self.assertEqual((self.first.holds('a'), self.second.holds('a')), (True, False))
+
+    def test_renew(self):
+        self.assertTrue(self.first.acquire('a'))
+        self.assertTrue(self.first.acquire('a'))
+        self.assertFalse(self.second.acquire('a'))
+
+    def test_release_hands_over(self):
+        self.first.acquire('a')
+        self.first.release('a')
+        self.assertFalse(self.first.holds('a'))
+        self.assertTrue(self.second.acquire('a'))
+
+    def test_pause_hands_over(self):
+        pool = FinderPool({'a': SimpleNamespace(account='a')}, None, lambda name: 60, coordinator=self.first)
+        self.first.acquire('a')
+        pool.pause('a')
+        pool._run_commands() # pylint: disable=protected-access
+        self.assertTrue(self.second.acquire('a'))
+
+    def test_only_the_holder_publishes(self):
+        self.first.acquire('a')
+        self.assertTrue(self.first.publish_result('a', ['2026-10-18']))
+        self.assertFalse(self.second.publish_result('a', []))
+        self.assertEqual(self.second.get_result('a')['available_dates'], ['2026-10-18'])
+        self.assertEqual(self.second.get_result('a')['owner'], 'first')
+        self.assertIsNone(self.second.get_result('b'))
+
+    def test_notification_claims(self):
+        self.assertEqual(self.first.claim_notification('key'), CLAIM_GRANTED)
+        self.assertEqual(self.second.claim_notification('key'), CLAIM_BUSY)
+        self.assertEqual(self.first.claim_notification('key'), CLAIM_GRANTED) # Retried by the claimer
+        self.first.confirm_notification('key')
+        self.assertEqual(self.second.claim_notification('key'), CLAIM_SENT)
+        self.assertEqual(self.first.claim_notification('key'), CLAIM_SENT)
+
+    def test_stop_releases_the_leases(self):
+        self.first.acquire('a')
+        self.first.acquire('b')
+        self.first.stop()
+        self.assertTrue(self.second.acquire('a'))
+        self.assertTrue(self.second.acquire('b'))
+
+
+class SqliteCoordinationTest(CoordinatorTestCase, unittest.TestCase):
+
+    def create_backend(self):
+        if not hasattr(self, 'path'):
+            directory = tempfile.TemporaryDirectory()
+            self.addCleanup(directory.cleanup)
+            self.path = os.path.join(directory.name, 'coordination.db')
+        return SqliteCoordinationBackend(self.path)
+
+    def test_renew_extends_the_lease(self):
+        self.first.acquire('a')
+        self.now += 20
+        self.assertTrue(self.first.acquire('a'))
+        self.now += 20
+        self.assertFalse(self.second.acquire('a'))
+        self.assertEqual(self.first.backend.get_leases(self.now), {'a': ('first', 1000 + 20 + LEASE_SECONDS)})
+
+    def test_expired_lease_is_taken_over(self):
+        self.first.acquire('a')
+        self.now += LEASE_SECONDS
+        self.assertEqual(self.first.backend.get_leases(self.now), {})
+        self.assertTrue(self.second.acquire('a'))
+        # The old holder finds out at its next renewal and its results are dropped
+        self.assertFalse(self.first.publish_result('a', []))
+        with self.assertLogs('coordination', 'WARNING'):
+            self.assertFalse(self.first.acquire('a'))
+        self.assertFalse(self.first.holds('a'))
+        self.assertTrue(self.second.publish_result('a', []))
+
+    def test_standby_refreshes_the_page_it_takes_over(self):
+        refreshes = []
+        finder = SimpleNamespace(account='a', check=lambda refresh: refreshes.append(refresh) or [])
+
+        def clock():
+            self.now += LEASE_SECONDS / 4 # Every look at the clock lets time pass, the lease of first runs out
+            return self.now
+
+        first = FinderPool({'a': finder}, lambda *_: None, lambda name: 60, clock=clock, coordinator=self.first)
+        first.run(max_cycles=1)
+        # The page was just loaded by the login
+        self.assertEqual(refreshes, [False])
+
+        second = FinderPool({'a': finder}, lambda *_: None, lambda name: 60, clock=clock, coordinator=self.second)
+        second.run(max_cycles=1)
+        self.assertTrue(self.second.holds('a'))
+        self.assertEqual(refreshes, [False, True])
+
+    def test_unconfirmed_claim_is_taken_over(self):
+        self.first.claim_notification('key')
+        self.now += LEASE_SECONDS - 1
+        self.assertEqual(self.second.claim_notification('key'), CLAIM_BUSY)
+        self.now += 1
+        self.assertEqual(self.second.claim_notification('key'), CLAIM_GRANTED)
+        self.assertEqual(self.first.claim_notification('key'), CLAIM_BUSY)
+
+    def test_cleanup(self):
+        self.first.acquire('a')
+        self.first.claim_notification('key')
+        self.now += 8 * 86400
+        self.first.backend.cleanup(self.now)
+        database = self.first.backend.database
+        self.assertEqual(database.execute('SELECT COUNT(*) FROM leases').fetchone()[0], 0)
+        self.assertEqual(database.execute('SELECT COUNT(*) FROM notification_claims').fetchone()[0], 0)
+
+
+@unittest.skipIf(fakeredis is None, 'fakeredis is not installed')
+class RedisCoordinationTest(CoordinatorTestCase, unittest.TestCase):
+    """ Redis keeps the time of the leases itself, the expiry is left to the server """
+
+    def create_backend(self):
+        if not hasattr(self, 'server'):
+            self.server = fakeredis.FakeServer()
+        client = fakeredis.FakeRedis(server=self.server, decode_responses=True)
+        with mock.patch('redis.Redis.from_url', return_value=client):
+            return RedisCoordinationBackend('redis://localhost:6379/0')
+
+
+if __name__ == '__main__':
+    unittest.main()
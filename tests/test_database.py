@@ -0,0 +1,154 @@
+"""
+    Tests of the schema migrations of the shared database connection and of the configuration file
+"""
+import os
+import sqlite3
+import stat
+import tempfile
+import unittest
+from unittest import mock
+
+import yaml
+
+from database import MIGRATIONS, DatabaseConnection, SlotCheckHistory, SlotCheckRecord, UserConfiguration
+from slot_extraction import DateSlots
+
+
+class MigrationTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.database = DatabaseConnection(os.path.join(directory.name, 'slot_finder.db'))
+        self.addCleanup(self.database.close)
+        self.database.migrate()
+
+    def get_plan(self, statement: str) -> str:
+        return ' '.join(row[-1] for row in self.database.execute(f'EXPLAIN QUERY PLAN {statement}', (0,)))
+
+    def test_migrates_to_the_last_version(self):
+        self.assertEqual(self.database.execute('PRAGMA user_version').fetchone()[0], len(MIGRATIONS))
+        self.database.migrate() # Nothing left to apply
+        self.assertEqual(self.database.execute('PRAGMA user_version').fetchone()[0], len(MIGRATIONS))
+
+    def test_migrates_a_database_of_the_first_release(self):
+        db_file = self.database.db_file + '.legacy'
+        legacy = sqlite3.connect(db_file)
+        legacy.execute('CREATE TABLE IF NOT EXISTS notification_history '
+                       '(id SERIAL PRIMARY KEY, sent_date_time TEXT, message TEXT)')
+        rows = [('2020-04-01 10:00:00', 'Slots open on 20200402'), ('2020-04-03 08:30:00', 'Slots open on 20200404'),
+                ('2020-04-05 18:00:00', 'Slots open on 20200405')]
+        legacy.executemany('INSERT INTO notification_history (sent_date_time, message) VALUES (?,?)', rows)
+        legacy.commit()
+        legacy.close()
+
+        database = DatabaseConnection(db_file)
+        self.addCleanup(database.close)
+        database.migrate()
+        self.assertEqual(database.execute('PRAGMA user_version').fetchone()[0], len(MIGRATIONS))
+        migrated = database.execute('SELECT id, sent_date_time, message FROM notification_history ORDER BY id').fetchall()
+        self.assertEqual([row[1:] for row in migrated], rows)
+        # The SERIAL ids were NULL, they are numbered now
+        self.assertEqual([row[0] for row in migrated], [1, 2, 3])
+        self.assertEqual(database.execute(UserConfiguration.GET_N_LAST_NOTIFICATION_HISTORY, (1,)).fetchall(),
+                         [rows[2]])
+
+    def test_retention_deletes_use_an_index(self):
+        self.assertIn('slot_check_checked_at', self.get_plan(SlotCheckHistory.DELETE_OLD_SLOT_CHECKS))
+        self.assertIn('slot_check_hourly_hour', self.get_plan(SlotCheckHistory.DELETE_OLD_SLOT_CHECK_HOURLY))
+
+
+class SlotCheckHistoryTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.database = DatabaseConnection(os.path.join(directory.name, 'slot_finder.db'))
+        self.addCleanup(self.database.close)
+        self.database.migrate()
+        self.now = 1_600_000_000
+
+    def record(self, history: SlotCheckHistory, is_open: bool):
+        self.now += 60
+        slots = DateSlots('20200914', found=True, window_count=4, disabled_count=3 if is_open else 4)
+        history.record(SlotCheckRecord(self.now, 'main', 1.5, [slots]))
+
+    def get_openings(self, history: SlotCheckHistory) -> int:
+        return sum(row[4] for row in history.get_opening_profile('main'))
+
+    def test_openings_carry_over_a_restart(self):
+        history = SlotCheckHistory(self.database, clock=lambda: self.now)
+        self.record(history, False)
+        self.record(history, True)
+        self.record(history, True)
+        self.assertEqual(self.get_openings(history), 1)
+
+        # Still open after the restart, the slots were already open before it
+        restarted = SlotCheckHistory(self.database, clock=lambda: self.now)
+        self.record(restarted, True)
+        self.assertEqual(self.get_openings(restarted), 1)
+        self.record(restarted, False)
+        self.record(restarted, True)
+        self.assertEqual(self.get_openings(restarted), 2)
+
+
+class UserConfigurationTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.uc = UserConfiguration()
+        self.uc.config_file = os.path.join(self.directory, UserConfiguration.CONFIG_FILE_NAME)
+
+    def write_config(self, text: str):
+        with open(self.uc.config_file, 'w') as config:
+            config.write(text)
+
+    def test_empty_sections_use_the_defaults(self):
+        self.write_config('main:\nnotifications:\n')
+        with self.assertLogs('database', 'WARNING'):
+            self.assertEqual(self.uc.get_refresh_time_seconds(), UserConfiguration.DEFAULT_SLEEP_TIME_SECONDS)
+            self.assertEqual(self.uc.get_notification_subscription_url(), '')
+        self.assertFalse(self.uc.get_http_fetch_enabled())
+        self.assertEqual(self.uc.get_parse_workers(), 0)
+
+    def test_file_is_parsed_again_only_when_it_changes(self):
+        self.write_config('main:\n  refresh_rate_seconds: 60\n')
+        with mock.patch('database.yaml.load', wraps=yaml.load) as load:
+            self.assertEqual(self.uc.get_refresh_time_seconds(), 60)
+            self.assertEqual(self.uc.get_refresh_time_seconds(), 60)
+            self.assertEqual(load.call_count, 1)
+
+            # A different size
+            self.write_config('main:\n  refresh_rate_seconds: 120\n')
+            self.assertEqual(self.uc.get_refresh_time_seconds(), 120)
+            self.assertEqual(load.call_count, 2)
+
+            # The same size, only the modification time tells the change
+            self.write_config('main:\n  refresh_rate_seconds: 180\n')
+            modified = os.stat(self.uc.config_file).st_mtime_ns + 1_000_000_000
+            os.utime(self.uc.config_file, ns=(modified, modified))
+            self.assertEqual(self.uc.get_refresh_time_seconds(), 180)
+            self.assertEqual(load.call_count, 3)
+
+    def test_update_replaces_the_file_and_keeps_its_mode(self):
+        self.write_config('main:\n  http_fetch: true\nnotifications:\n  subscription_url: https://notify.run/c/x\n')
+        os.chmod(self.uc.config_file, 0o600)
+        self.uc.set_refresh_time_seconds(90)
+
+        self.assertEqual(stat.S_IMODE(os.stat(self.uc.config_file).st_mode), 0o600)
+        self.assertEqual(os.listdir(self.directory), [UserConfiguration.CONFIG_FILE_NAME])
+        with open(self.uc.config_file, 'r') as config:
+            self.assertEqual(yaml.safe_load(config), {
+                'main': {'http_fetch': True, 'refresh_rate_seconds': 90},
+                'notifications': {'subscription_url': 'https://notify.run/c/x'},
+            })
+        # The cache holds what was written, without parsing the file again
+        with mock.patch('database.yaml.load') as load:
+            self.assertEqual(self.uc.get_refresh_time_seconds(), 90)
+            load.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()
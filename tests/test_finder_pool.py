@@ -0,0 +1,101 @@
+"""
+    Tests of the scheduling of the finder pool, on stub finders
+"""
+import threading
+import unittest
+
+from finder_pool import FinderPool
+
+TIMEOUT_SECONDS = 10
+
+
+class StubFinder:
+    """ Checks until released, counting the checks that run at the same time """
+
+    def __init__(self, account: str, blocking: bool = False):
+        self.account = account
+        self.released = threading.Event()
+        if not blocking:
+            self.released.set()
+        self.started = threading.Semaphore(0)
+        self.lock = threading.Lock()
+        self.active = 0
+        self.max_active = 0
+        self.checks = 0
+
+    def check(self, refresh: bool = True): # pylint: disable=unused-argument
+        with self.lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        self.started.release()
+        self.released.wait(TIMEOUT_SECONDS)
+        with self.lock:
+            self.active -= 1
+            self.checks += 1
+        return []
+
+
+class FinderPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.finders = {'a': StubFinder('a', blocking=True), 'b': StubFinder('b')}
+        self.results = threading.Semaphore(0)
+        self.reservations = []
+        self.pool = FinderPool(self.finders, lambda name, dates, seconds: self.results.release(),
+                               lambda name: 3600, reserve=self.reserve)
+
+    def reserve(self, name: str, seconds: float) -> float:
+        self.reservations.append((name, seconds))
+        return seconds
+
+    def apply_commands(self):
+        """ Waits until the scheduling thread applied the commands sent so far """
+        applied = threading.Event()
+        self.pool._send(applied.set) # pylint: disable=protected-access
+        self.assertTrue(applied.wait(TIMEOUT_SECONDS))
+
+    def get_waiting(self):
+        return sorted(name for _, name in self.pool.schedule)
+
+    def test_resume_during_a_check_does_not_start_another(self):
+        thread = threading.Thread(target=self.pool.run, kwargs={'max_cycles': 10}, daemon=True)
+        thread.start()
+        self.addCleanup(thread.join, TIMEOUT_SECONDS)
+        self.addCleanup(self.pool.pause)
+        self.addCleanup(self.finders['a'].released.set)
+        self.assertTrue(self.finders['a'].started.acquire(timeout=TIMEOUT_SECONDS))
+
+        self.pool.pause('a')
+        self.pool.resume('a')
+        self.apply_commands()
+        self.assertEqual(self.get_waiting(), ['b'])
+        self.pool.check_now('a')
+        self.apply_commands()
+        self.assertEqual(self.get_waiting(), ['b'])
+
+        # The finished check schedules the next one, check_now brings it forward through the budget
+        self.finders['a'].released.set()
+        self.assertTrue(self.results.acquire(timeout=TIMEOUT_SECONDS))
+        self.apply_commands()
+        self.assertEqual(self.get_waiting(), ['a', 'b'])
+        self.pool.check_now('a')
+        self.assertTrue(self.results.acquire(timeout=TIMEOUT_SECONDS))
+        self.assertIn(('a', 0), self.reservations)
+        self.assertEqual((self.finders['a'].checks, self.finders['a'].max_active), (2, 1))
+
+        self.pool.pause() # Nothing left to run, the pool returns
+        thread.join(TIMEOUT_SECONDS)
+        self.assertFalse(thread.is_alive())
+
+    def test_pull_in_goes_through_the_budget(self):
+        now = self.pool.clock()
+        self.pool.schedule = [(now + 30, 'a'), (now + 3000, 'b')]
+        self.pool.pull_in(60)
+        self.pool._run_commands() # pylint: disable=protected-access
+        self.assertEqual(self.reservations, [('b', 60)])
+        self.assertEqual(sorted(self.pool.schedule)[0], (now + 30, 'a'))
+        self.assertLess(sorted(self.pool.schedule)[1][0], now + 61)
+
+
+if __name__ == '__main__':
+    unittest.main()
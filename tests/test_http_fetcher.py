@@ -0,0 +1,178 @@
+"""
+    Tests of the slot page fetched over HTTP against a local server, compared with the page read
+    from the browser
+"""
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from benchmark import FIRST_PAGE_DATES, FakeClock, FakeSlotFinder, FakeWebDriver, build_page, get_dates
+from http_fetcher import HttpSlotFetcher, SessionExpiredError
+from page_readiness import PageReadiness
+from slot_extraction import EXTRACTION_SCRIPT, EXTRACTION_SOUP, SlotIndex
+from slot_finder import AmazonSlotFinder
+
+SESSION_COOKIE = 'session-id=fixture'
+USER_AGENT = 'fixture-browser'
+DATES = get_dates(AmazonSlotFinder.DEFAULT_HORIZON_DAYS)
+DATE_STATES = [(date, 'open' if index % 3 == 1 else 'alert' if index % 3 == 2 else 'disabled')
+               for index, date in enumerate(DATES)]
+PAGE = build_page(DATE_STATES, padding=20)
+# The first page only shows the first dates, the browser clicks next for the others
+PAGED = [build_page(DATE_STATES[:FIRST_PAGE_DATES], padding=20), PAGE]
+
+
+class SlotPageHandler(BaseHTTPRequestHandler):
+    """ Serves the fixture page to the session cookie, sends the others to the sign in page """
+
+    def do_GET(self): # pylint: disable=invalid-name
+        """ The slot page and the sign in page """
+        self.server.requests.append((self.path, self.headers.get('User-Agent')))
+        if self.path.startswith(HttpSlotFetcher.SIGN_IN_PATH):
+            self._send(200, '<html><body><form id="signIn"></form></body></html>')
+        elif self.server.expired or self.headers.get('Cookie') != SESSION_COOKIE:
+            self.send_response(302)
+            self.send_header('Location', HttpSlotFetcher.SIGN_IN_PATH)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+        else:
+            self._send(200, self.server.pages[0])
+
+    def _send(self, status: int, page: str):
+        body = page.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args): # pylint: disable=redefined-builtin
+        pass
+
+
+class SessionWebDriver(FakeWebDriver):
+    """ Fake driver of a logged in browser, with the session cookie and a user agent """
+
+    def get_cookies(self):
+        name, value = SESSION_COOKIE.split('=')
+        return [{'name': name, 'value': value, 'domain': '127.0.0.1', 'path': '/'}]
+
+    def execute_script(self, script: str, *args):
+        if script == HttpSlotFetcher.USER_AGENT_SCRIPT:
+            return USER_AGENT
+        return super().execute_script(script, *args)
+
+
+class HttpSlotFetcherTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), SlotPageHandler)
+        cls.server.daemon_threads = True
+        cls.url = f'http://127.0.0.1:{cls.server.server_address[1]}/gp/buy/shipoptionselect/'
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.server.requests = []
+        self.server.expired = False
+        self.server.pages = [PAGE]
+
+    def create_finder(self, extraction: str = EXTRACTION_SOUP, http: bool = False) -> AmazonSlotFinder:
+        clock = FakeClock()
+        fetcher = HttpSlotFetcher(self.url, timeout_seconds=5) if http else None
+        finder = FakeSlotFinder(SessionWebDriver(self.server.pages), readiness=PageReadiness(clock=clock, sleep=clock.sleep),
+                                extraction=extraction, http_fetcher=fetcher)
+        finder.logged_in = True
+        if fetcher:
+            self.addCleanup(fetcher.close)
+            fetcher.load_session(finder.driver)
+        finder.get_date_range = lambda: DATES # type: ignore
+        return finder
+
+    def test_fetch_copies_the_browser_session(self):
+        fetcher = HttpSlotFetcher(self.url, timeout_seconds=5)
+        self.addCleanup(fetcher.close)
+        fetcher.load_session(SessionWebDriver([PAGE]))
+        self.assertEqual(fetcher.fetch(), PAGE)
+        self.assertEqual(self.server.requests, [('/gp/buy/shipoptionselect/', USER_AGENT)])
+
+    def test_fetch_without_a_session(self):
+        fetcher = HttpSlotFetcher(self.url, timeout_seconds=5)
+        self.addCleanup(fetcher.close)
+        with self.assertRaises(SessionExpiredError):
+            fetcher.fetch()
+        self.assertEqual(self.server.requests, [])
+
+    def test_disabled_fetch_stays_off(self):
+        fetcher = HttpSlotFetcher(self.url, timeout_seconds=5)
+        self.addCleanup(fetcher.close)
+        fetcher.load_session(SessionWebDriver([PAGE]))
+        with self.assertLogs('http_fetcher', 'WARNING'):
+            fetcher.disable('The first page does not cover the dates')
+        fetcher.load_session(SessionWebDriver([PAGE]))
+        self.assertFalse(fetcher.active)
+        with self.assertRaises(SessionExpiredError):
+            fetcher.fetch()
+        self.assertEqual(self.server.requests, [])
+
+    def test_http_extraction_matches_the_browser(self):
+        expected = SlotIndex.from_html(PAGE)
+        http_finder = self.create_finder(http=True)
+        available_dates = http_finder.check()
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual(http_finder.driver.refreshes, 0)
+        self.assertEqual(http_finder.slot_index.dates, expected.dates)
+        for extraction in (EXTRACTION_SOUP, EXTRACTION_SCRIPT):
+            with self.subTest(extraction=extraction):
+                browser_finder = self.create_finder(extraction)
+                self.assertEqual(browser_finder.check(), available_dates)
+                self.assertEqual(browser_finder.driver.refreshes, 1)
+        self.assertEqual(available_dates, DATES[1::3])
+
+    def test_fetch_is_disabled_when_the_first_page_does_not_cover_the_dates(self):
+        self.server.pages = PAGED
+        finder = self.create_finder(http=True)
+        with self.assertLogs('http_fetcher', 'WARNING'):
+            snapshot = finder.capture()
+        # The browser pages to the dates the fetch did not cover
+        self.assertEqual(snapshot.pages, [(PAGED[0], None), (PAGED[1], None)])
+        self.assertEqual(finder.driver.refreshes, 1)
+        self.assertEqual(finder.detect(snapshot), DATES[1::3])
+        self.assertTrue(finder.http_fetcher.disabled)
+
+        # The next cycles are made in the browser only, without fetching the first page again
+        finder.driver.page_index = 0
+        snapshot = finder.capture()
+        self.assertEqual(snapshot.pages, [(PAGED[0], None), (PAGED[1], None)])
+        self.assertEqual(finder.driver.refreshes, 2)
+        self.assertEqual(finder.detect(snapshot), DATES[1::3])
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertEqual(finder.http_fetcher.fetches, 1)
+
+    def test_expired_session_falls_back_to_the_browser(self):
+        finder = self.create_finder(http=True)
+        self.assertEqual(finder.check(), DATES[1::3])
+
+        self.server.expired = True
+        with self.assertLogs('slot_finder', 'WARNING'):
+            self.assertEqual(finder.check(), DATES[1::3])
+        # Sent to the sign in page, the check is made in the browser and the session is copied again
+        self.assertEqual([path for path, _ in self.server.requests[1:]],
+                         ['/gp/buy/shipoptionselect/', HttpSlotFetcher.SIGN_IN_PATH])
+        self.assertEqual(finder.http_fetcher.expirations, 1)
+        self.assertEqual(finder.driver.refreshes, 1)
+        self.assertTrue(finder.http_fetcher.active)
+
+        self.server.expired = False
+        self.assertEqual(finder.check(), DATES[1::3])
+        self.assertEqual(finder.driver.refreshes, 1)
+        self.assertEqual(finder.http_fetcher.fetches, 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
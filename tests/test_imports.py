@@ -0,0 +1,36 @@
+"""
+    Tests of the imports of main.py for the commands that only read the config file or the database,
+    run in a subprocess under python -X importtime like benchmark.py --imports
+"""
+import tempfile
+import unittest
+
+from benchmark import (DEFAULT_IMPORT_BUDGET_MS, IMPORT_CHECK_COMMANDS, SCANNING_PACKAGES, get_command_import_ms,
+                       run_with_import_times)
+
+# The import time is the best of a few runs, a single one is thrown off by anything else running
+RUNS = 3
+
+
+class ImportBudgetTest(unittest.TestCase):
+
+    def setUp(self):
+        home = tempfile.TemporaryDirectory()
+        self.addCleanup(home.cleanup)
+        self.home = home.name
+        self.startup, _ = run_with_import_times(['-c', 'pass'], self.home)
+
+    def test_help_stays_under_the_budget(self):
+        total_ms = min(get_command_import_ms(['-h'], self.home, self.startup)[0] for _ in range(RUNS))
+        self.assertLessEqual(total_ms, DEFAULT_IMPORT_BUDGET_MS)
+
+    def test_lightweight_commands_do_not_import_the_browser_stack(self):
+        for command in [['-h']] + IMPORT_CHECK_COMMANDS:
+            with self.subTest(command=' '.join(command)):
+                _, imported = get_command_import_ms(command, self.home, self.startup)
+                self.assertIn('database', imported) # main.py did run
+                self.assertEqual(imported.intersection(SCANNING_PACKAGES), set())
+
+
+if __name__ == '__main__':
+    unittest.main()
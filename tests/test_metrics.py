@@ -0,0 +1,65 @@
+"""
+    Tests of the metrics registry and its Prometheus text exposition
+"""
+import os
+import tempfile
+import unittest
+import urllib.request
+
+from metrics import Metrics
+
+
+class MetricsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.metrics = Metrics()
+
+    def test_exposition_of_spans_counters_and_gauges(self):
+        self.metrics.observe('parse', 0.25, account='main')
+        self.metrics.observe('parse', 0.5, account='main')
+        with self.assertRaises(ValueError):
+            with self.metrics.span('refresh', account='main'):
+                raise ValueError('chrome not reachable')
+        self.metrics.increment('notifications_delivered_total')
+        self.metrics.increment('notifications_delivered_total', 2)
+        self.metrics.set_gauge('driver_rss_bytes', 1024, account='a "quoted"\\name')
+
+        lines = self.metrics.render_prometheus().splitlines()
+        self.assertEqual(lines[:3], [
+            '# HELP slot_finder_phase_seconds Time spent in every phase of the check cycle',
+            '# TYPE slot_finder_phase_seconds summary',
+            'slot_finder_phase_seconds_count{phase="parse",account="main"} 2',
+        ])
+        self.assertEqual(lines[3], 'slot_finder_phase_seconds_sum{phase="parse",account="main"} 0.750000')
+        self.assertIn('slot_finder_phase_seconds_max{phase="parse",account="main"} 0.500000', lines)
+        self.assertIn('slot_finder_phase_seconds_count{phase="refresh",account="main"} 1', lines)
+        self.assertEqual(lines[-6:], [
+            '# TYPE slot_finder_notifications_delivered_total counter',
+            'slot_finder_notifications_delivered_total 3',
+            '# TYPE slot_finder_phase_errors_total counter',
+            'slot_finder_phase_errors_total{account="main",phase="refresh"} 1',
+            '# TYPE slot_finder_driver_rss_bytes gauge',
+            'slot_finder_driver_rss_bytes{account="a \\"quoted\\"\\\\name"} 1024',
+        ])
+
+    def test_textfile_and_http_endpoint(self):
+        self.metrics.increment('notification_failures_total')
+        expected = self.metrics.render_prometheus()
+
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, 'slot_finder.prom')
+        self.metrics.write_textfile(path)
+        with open(path, 'r') as metrics_file:
+            self.assertEqual(metrics_file.read(), expected)
+        self.assertEqual(os.listdir(directory.name), ['slot_finder.prom'])
+
+        server = self.metrics.serve(0)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        with urllib.request.urlopen(f'http://127.0.0.1:{server.server_address[1]}/metrics', timeout=5) as response:
+            self.assertEqual(response.read().decode('utf-8'), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
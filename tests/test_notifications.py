@@ -0,0 +1,107 @@
+"""
+    Tests of the notification outbox, on a temporary database
+"""
+import io
+import os
+import tempfile
+import threading
+import unittest
+from contextlib import redirect_stdout
+from types import SimpleNamespace
+
+from database import DatabaseConnection
+from main import report_available_dates
+from notifications import NotificationOutbox
+
+
+class NotifyChangesTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.database = DatabaseConnection(os.path.join(directory.name, 'slot_finder.db'))
+        self.addCleanup(self.database.close)
+        self.database.migrate()
+        self.now = 1000.0
+        self.outbox = NotificationOutbox(SimpleNamespace(database=self.database), clock=lambda: self.now)
+
+    def get_messages(self):
+        return [row[0] for row in self.database.execute('SELECT message FROM notification_outbox ORDER BY id')]
+
+    def report(self, *dates):
+        self.now += 300
+        with redirect_stdout(io.StringIO()):
+            report_available_dates('default', list(dates), self.outbox)
+
+    def test_notifies_the_first_open_dates_once(self):
+        self.report('2026-10-18')
+        self.report('2026-10-18')
+        self.assertEqual(self.get_messages(), ['Time Slots Available: 2026-10-18'])
+
+    def test_notifies_dates_that_open_again(self):
+        self.report('2026-10-18')
+        self.report()
+        self.report('2026-10-18')
+        self.assertEqual(self.get_messages(), ['Time Slots Available: 2026-10-18'] * 2)
+
+    def test_no_notification_for_no_dates(self):
+        self.report()
+        self.report()
+        self.assertEqual(self.get_messages(), [])
+        self.assertEqual(self.outbox.open_dates, {'default': ()})
+
+    def test_previous_dates_of_another_instance(self):
+        self.outbox.notify_changes('default', ['2026-10-18'], 'open', previous_dates=['2026-10-18'])
+        self.assertEqual(self.get_messages(), [])
+        self.outbox.notify_changes('default', ['2026-10-18'], 'open', previous_dates=[])
+        self.assertEqual(self.get_messages(), ['open'])
+
+
+class RecordingEvent(threading.Event):
+    """ Wake up event that returns at once, records the waits and calls back after each one """
+
+    def __init__(self, on_wait):
+        super().__init__()
+        self.on_wait = on_wait
+        self.timeouts = []
+
+    def wait(self, timeout=None):
+        self.timeouts.append(timeout)
+        self.on_wait(len(self.timeouts))
+        return self.is_set()
+
+
+class DeliveryLoopTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.database = DatabaseConnection(os.path.join(directory.name, 'slot_finder.db'))
+        self.addCleanup(self.database.close)
+        self.database.migrate()
+        self.url = ''
+        self.sent = []
+        user_configuration = SimpleNamespace(database=self.database,
+                                             get_notification_subscription_url=lambda: self.url)
+        self.outbox = NotificationOutbox(user_configuration, clock=lambda: 1000.0)
+        self.outbox.services['https://notify.run/c/x'] = SimpleNamespace(send=self.sent.append)
+
+    def test_waits_for_a_url_instead_of_polling(self):
+        def on_wait(waits):
+            if waits == 3:
+                self.url = 'https://notify.run/c/x'
+                self.outbox.wake_up.set()
+            elif waits == 4:
+                self.outbox.stopping.set()
+
+        self.outbox.wake_up = RecordingEvent(on_wait)
+        self.outbox.enqueue('Time Slots Available: 2026-10-18')
+        with self.assertLogs('notifications', 'WARNING'):
+            self.outbox._run() # pylint: disable=protected-access
+        # Due at once but nothing can be sent, the loop sleeps until the url is set
+        self.assertEqual(self.outbox.wake_up.timeouts, [NotificationOutbox.BASE_RETRY_SECONDS] * 3 + [None])
+        self.assertEqual(self.sent, ['Time Slots Available: 2026-10-18'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+"""
+    Tests of the wait for the slot containers, on a stub driver and a fake clock
+"""
+import unittest
+
+from page_readiness import PageReadiness
+
+READY = ('slot-container-2026-10-18:120', 'slot-container-2026-10-19:98')
+
+
+class StubClock:
+    """ Time that only moves when the code under test sleeps """
+
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def __call__(self) -> float:
+        return self.now
+
+    def sleep(self, seconds: float):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class StubDriver:
+    """ Answers the signature script with the given signatures, repeating the last one """
+
+    def __init__(self, *signatures):
+        self.signatures = list(signatures)
+        self.polls = 0
+
+    def execute_script(self, script: str): # pylint: disable=unused-argument
+        self.polls += 1
+        if len(self.signatures) > 1:
+            return list(self.signatures.pop(0))
+        return list(self.signatures[0])
+
+
+class PageReadinessTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = StubClock()
+        self.readiness = PageReadiness(timeout_seconds=10, clock=self.clock, sleep=self.clock.sleep)
+
+    def test_ready_at_once(self):
+        driver = StubDriver(READY)
+        self.assertTrue(self.readiness.wait_until_ready(driver))
+        # Two identical polls make the page stable, with a single poll interval between them
+        self.assertEqual(driver.polls, PageReadiness.STABLE_POLLS)
+        self.assertEqual(self.clock.sleeps, [PageReadiness.POLL_INTERVAL_SECONDS])
+        self.assertEqual(self.readiness.get_stats()['waits'], 1)
+
+    def test_ready_after_polls(self):
+        loading = 4
+        driver = StubDriver(*([()] * loading), READY[:1], READY)
+        self.assertTrue(self.readiness.wait_until_ready(driver))
+        # The empty polls, the partial page, then the full page seen twice
+        self.assertEqual(driver.polls, loading + 1 + PageReadiness.STABLE_POLLS)
+        self.assertAlmostEqual(self.readiness.durations[-1],
+                               (driver.polls - 1) * PageReadiness.POLL_INTERVAL_SECONDS)
+        self.assertEqual(self.readiness.timeouts, 0)
+
+    def test_waits_for_the_containers_to_change(self):
+        driver = StubDriver(READY, READY, READY[:1])
+        self.assertTrue(self.readiness.wait_until_ready(driver, previous=READY))
+        self.assertEqual(driver.polls, 2 + PageReadiness.STABLE_POLLS)
+
+    def test_timeout(self):
+        driver = StubDriver(())
+        with self.assertLogs('page_readiness', 'WARNING'):
+            self.assertFalse(self.readiness.wait_until_ready(driver))
+        self.assertGreaterEqual(self.clock.now, 10)
+        self.assertLess(self.clock.now, 10 + PageReadiness.POLL_INTERVAL_SECONDS * 2)
+        self.assertEqual(self.readiness.timeouts, 1)
+        self.assertEqual(self.readiness.current_timeout(), 10)
+
+    def test_timeout_adapts_to_the_recent_waits(self):
+        self.assertTrue(self.readiness.wait_until_ready(StubDriver(READY)))
+        self.assertEqual(self.readiness.current_timeout(), PageReadiness.MIN_TIMEOUT_SECONDS)
+
+    def test_falls_back_to_sleeping_when_the_script_fails(self):
+
+        class BrokenDriver:
+            def execute_script(self, script):
+                raise RuntimeError('no page')
+
+        with self.assertLogs('page_readiness', 'WARNING'):
+            self.assertFalse(self.readiness.wait_until_ready(BrokenDriver()))
+        self.assertEqual(self.clock.sleeps, [PageReadiness.FALLBACK_SLEEP_SECONDS])
+        self.assertEqual(self.readiness.fallbacks, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
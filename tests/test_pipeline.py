@@ -0,0 +1,94 @@
+"""
+    Tests of the parse pipeline: results in capture order, the bounded queue and the incremental parse
+"""
+import threading
+import unittest
+from unittest import mock
+
+from benchmark import build_page, get_dates
+from pipeline import PageSnapshot, SlotPipeline, SnapshotResult
+from slot_extraction import SlotIndex
+
+DATES = get_dates(4)
+PAGE = build_page([(date, 'open' if index == 1 else 'disabled') for index, date in enumerate(DATES)], padding=5)
+
+
+class BlockingDetect:
+    """ Stands in for detect_snapshot, every snapshot is parsed once its sequence is released """
+
+    def __init__(self):
+        self.released: dict = {}
+
+    def release(self, sequence: int):
+        self.released.setdefault(sequence, threading.Event()).set()
+
+    def __call__(self, snapshot: PageSnapshot, extractor=None) -> SnapshotResult:
+        self.released.setdefault(snapshot.sequence, threading.Event()).wait(5)
+        return SnapshotResult(snapshot.account, snapshot.sequence, [], SlotIndex({}), 0)
+
+
+class SlotPipelineTest(unittest.TestCase):
+
+    def create_pipeline(self, workers: int, max_pending: int, use_processes: bool = False) -> SlotPipeline:
+        slot_pipeline = SlotPipeline(workers, max_pending, use_processes)
+        self.addCleanup(slot_pipeline.close)
+        return slot_pipeline
+
+    def test_results_of_an_account_are_handled_in_capture_order(self):
+        slot_pipeline = self.create_pipeline(3, 3)
+        detect = BlockingDetect()
+        self.addCleanup(lambda: [detect.release(sequence) for sequence in (1, 2, 3)]) # Before the pipeline is closed
+        handled = []
+        with mock.patch('pipeline.detect_snapshot', detect):
+            futures = [slot_pipeline.submit(PageSnapshot(account, DATES)) for account in ('a', 'a', 'b')]
+            for future in futures:
+                future.add_done_callback(lambda done: handled.append((done.result().account, done.result().sequence)))
+
+            # The second snapshot of a waits for the first, b does not
+            detect.release(2)
+            detect.release(3)
+            futures[2].result(5)
+            self.assertFalse(futures[1].done())
+            self.assertEqual(handled, [('b', 3)])
+
+            detect.release(1)
+            futures[1].result(5)
+        self.assertEqual(handled, [('b', 3), ('a', 1), ('a', 2)])
+
+    def test_submit_blocks_while_the_queue_is_full(self):
+        slot_pipeline = self.create_pipeline(1, 2)
+        detect = BlockingDetect()
+        self.addCleanup(lambda: [detect.release(sequence) for sequence in (1, 2, 3)]) # Before the pipeline is closed
+        with mock.patch('pipeline.detect_snapshot', detect):
+            slot_pipeline.submit(PageSnapshot('a', DATES))
+            slot_pipeline.submit(PageSnapshot('a', DATES))
+            submitted = threading.Event()
+            third = threading.Thread(target=lambda: (slot_pipeline.submit(PageSnapshot('a', DATES)), submitted.set()),
+                                     daemon=True)
+            third.start()
+            self.assertFalse(submitted.wait(0.2))
+            self.assertEqual(slot_pipeline.submitted, 2)
+
+            # Room is made once the first parse is done
+            detect.release(1)
+            self.assertTrue(submitted.wait(5))
+            self.assertEqual(slot_pipeline.submitted, 3)
+            third.join(5)
+
+    def test_thread_workers_parse_incrementally(self):
+        slot_pipeline = self.create_pipeline(2, 2)
+        expected = SlotIndex.from_html(PAGE)
+        for _ in range(2):
+            result = slot_pipeline.submit(PageSnapshot('a', DATES, [(PAGE, None)], incremental=True)).result(5)
+            self.assertEqual(result.slot_index.dates, expected.dates)
+            self.assertEqual(result.available_dates, [DATES[1]])
+        self.assertEqual(slot_pipeline.extractors['a'].get_stats()['hits'], 1)
+
+    def test_worker_processes_parse_in_full(self):
+        slot_pipeline = self.create_pipeline(1, 1, use_processes=True)
+        self.assertIsNone(slot_pipeline._get_extractor( # pylint: disable=protected-access
+            PageSnapshot('a', DATES, incremental=True)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+"""
+    Tests of the polling policies, the rate budget and the replay of the recorded checks
+"""
+import unittest
+
+from finder_pool import FinderPool
+from polling_scheduler import (AdaptivePolicy, FixedPolicy, PollingScheduler, RateBudget, RecordedProfile,
+                               SimulationResult, get_open_periods, simulate)
+
+HOUR = 3600
+
+
+class RateBudgetTest(unittest.TestCase):
+
+    def test_reserve_within_the_budget(self):
+        budget = RateBudget(2, 100)
+        self.assertEqual(budget.reserve(10, 0), 10)
+        self.assertEqual(budget.reserve(20, 0), 20)
+        # The window (10, 110] is full until the reservation at 10 expires
+        self.assertAlmostEqual(budget.reserve(30, 0), 110.001)
+
+    def test_release(self):
+        budget = RateBudget(2, 100)
+        budget.reserve(10, 0)
+        budget.reserve(20, 0)
+        budget.release(20)
+        budget.release(25) # Never reserved
+        self.assertEqual(budget.reserve(30, 0), 30)
+
+    def test_load_the_recorded_checks(self):
+        budget = RateBudget(2, 100)
+        budget.load([-50, -20])
+        self.assertAlmostEqual(budget.reserve(0, 0), 50.001)
+
+
+class PollingSchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        self.scheduler = PollingScheduler(FixedPolicy(lambda: 300), RateBudget(3, HOUR), clock=lambda: self.now)
+
+    def test_next_interval_reserves(self):
+        self.assertEqual(self.scheduler.next_interval('a'), 300)
+        self.assertEqual(self.scheduler.budget.reserved, [1300])
+
+    def test_reserve_gives_the_moved_check_back(self):
+        self.scheduler.next_interval('a')
+        self.assertEqual(self.scheduler.reserve('a', 0), 0)
+        self.assertEqual(self.scheduler.budget.reserved, [1000])
+
+    def test_reserve_keeps_the_checks_that_were_made(self):
+        self.scheduler.next_interval('a')
+        self.now += 300
+        self.assertEqual(self.scheduler.reserve('a', 60), 60)
+        self.assertEqual(self.scheduler.budget.reserved, [1300, 1360])
+
+    def test_reserve_waits_for_the_budget(self):
+        for account in 'abc':
+            self.scheduler.reserve(account, 0)
+        self.assertAlmostEqual(self.scheduler.reserve('d', 0), HOUR + 0.001)
+
+    def test_staggered_first_checks_go_through_the_budget(self):
+        pool = FinderPool(dict.fromkeys('abcd'), None, self.scheduler.next_interval, clock=lambda: self.now,
+                          reserve=self.scheduler.reserve)
+        pool._stagger() # pylint: disable=protected-access
+        self.assertEqual(sorted(due for due, _ in pool.schedule)[:3], [1000, 1075, 1150])
+        self.assertAlmostEqual(max(due for due, _ in pool.schedule), 1000 + HOUR + 0.001)
+        self.assertEqual(len(self.scheduler.budget.reserved), 4)
+
+
+class SimulationTest(unittest.TestCase):
+
+    def setUp(self):
+        # Checks every 10 minutes over two weeks, slots open for 20 minutes at the start of a single hour
+        self.start = 1_000_000 * HOUR
+        self.opening = opening = self.start + 10 * 24 * HOUR + 5 * HOUR
+        self.checks = [(checked_at, opening <= checked_at < opening + 1200)
+                       for checked_at in range(self.start, self.start + 14 * 24 * HOUR, 600)]
+
+    def test_recorded_profile_only_sees_the_past(self):
+        now = [self.start + 7 * 24 * HOUR]
+        profile = RecordedProfile(self.checks, lambda: now[0])
+        rows = profile('a')
+        self.assertEqual(sum(row[2] for row in rows), 7 * 24 * 6)
+        self.assertEqual(sum(row[4] for row in rows), 0)
+        now[0] = self.checks[-1][0] + 1
+        self.assertEqual(sum(row[4] for row in profile('a')), 1)
+
+    def simulate(self, profile_source) -> SimulationResult:
+        scheduler = PollingScheduler(AdaptivePolicy(profile_source, 60, 7200))
+        if profile_source is None:
+            scheduler.policy.profile_source = RecordedProfile(self.checks, lambda: scheduler.clock())
+        # Up to the end of the opening, the replay is scored on it alone
+        return simulate('adaptive', scheduler, 'a', get_open_periods(self.checks), self.start, self.opening + 1200)
+
+    def test_adaptive_replay_does_not_learn_the_openings_it_is_scored_on(self):
+        ahead = self.simulate(RecordedProfile(self.checks, lambda: float('inf')))
+        # Knowing the hour of the opening, the replay checks every minute in it and catches it at once
+        self.assertEqual((ahead.caught, ahead.delay_seconds), (1, 0))
+
+        result = self.simulate(None)
+        # Nothing opened before, every check is spread evenly
+        span = self.opening + 1200 - self.start
+        self.assertEqual(result.checks, -(-span // ((60 + 7200) / 2)))
+        self.assertEqual(result.caught, 1)
+        self.assertGreater(result.delay_seconds, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,159 @@
+"""
+    Equivalence of every parser backend and the extraction script with the original
+    BeautifulSoup parse of the whole page, on the benchmark pages and recorded fixtures,
+    and of the incremental parse with a full parse
+"""
+import os
+import unittest
+from typing import Dict, List, Tuple
+
+from bs4 import BeautifulSoup
+
+from benchmark import (build_page, build_synthetic_scenarios, create_finder, get_backends, get_dates,
+                       load_recorded_scenarios)
+from metrics import METRICS
+from pipeline import PageSnapshot, build_slot_index
+from slot_extraction import IncrementalSlotExtractor, SlotIndex
+
+# Directory of recorded ship option pages to add to the synthetic ones, like benchmark.py --fixtures
+FIXTURES_ENVIRONMENT_VARIABLE = 'SLOT_FIXTURES'
+
+
+def get_original_slots(source: str, date_range: List[str]) -> Dict[str, Tuple[bool, bool, int, int]]:
+    """
+        (found, alert, windows, disabled) of every date, read the way get_available_dates and
+        has_open_slots did before the SlotIndex: html.parser on the whole page, then a find by id
+    """
+    parsed_source = BeautifulSoup(source, "html.parser")
+    slots = {}
+    for date in date_range:
+        time_slot = parsed_source.find(id=f'slot-container-{date}')
+        if time_slot is None:
+            slots[date] = (False, False, 0, 0)
+            continue
+        time_slot_unattended = time_slot.find("div", {"id": "slot-container-UNATTENDED"})
+        if time_slot_unattended.find("div", {"class": "a-box a-alert a-alert-info"}):
+            slots[date] = (True, True, 0, 0)
+            continue
+        list_of_time_slots = time_slot_unattended.find("div", id=f'root-{date}-UNATTENDED-box-group').find_all(
+            "div", recursive=False)
+        disabled_time_slots = time_slot_unattended.find_all("div", {"class": "disabledRadioBox"})
+        slots[date] = (True, False, len(list_of_time_slots), len(disabled_time_slots))
+    return slots
+
+
+def get_original_script_results(pages: List[str], date_range: List[str]) -> List[dict]:
+    """ What SLOT_EXTRACTION_SCRIPT returns on every page, built from the original parse """
+    script_results = []
+    for page in pages:
+        result = {}
+        for date, (found, alert, windows, disabled) in get_original_slots(page, date_range).items():
+            if found:
+                result[date] = {'found': found, 'alert': alert, 'disabled': disabled, 'slots': [],
+                                'windows': [True] * (windows - disabled) + [False] * disabled}
+        script_results.append(result)
+    return script_results
+
+
+def get_corpus() -> Dict[str, List[str]]:
+    """ The benchmark scenarios, a page missing dates of the range and the recorded fixtures """
+    # The markup around the slot grid is the same on every page, less of it keeps the test fast
+    corpus = build_synthetic_scenarios(padding=50)
+    dates = get_dates(6)
+    corpus['missing_dates'] = [build_page([(dates[1], 'open'), (dates[4], 'alert')], padding=5)]
+    fixtures = os.environ.get(FIXTURES_ENVIRONMENT_VARIABLE)
+    if fixtures:
+        corpus.update(load_recorded_scenarios(fixtures))
+    return corpus
+
+
+class SlotExtractionEquivalenceTest(unittest.TestCase):
+
+    def test_every_backend_matches_the_original_parse(self):
+        # Dates past the ones on the pages are compared as well, they must not be found
+        date_range = get_dates(30)
+        for scenario, pages in get_corpus().items():
+            # The dates are read from the last page, after every next click
+            expected = get_original_slots(pages[-1], date_range)
+            expected_dates = [date for date, (_, alert, windows, disabled) in expected.items()
+                              if not alert and windows != disabled]
+            script_results = get_original_script_results(pages, date_range)
+            for backend, settings in get_backends().items():
+                with self.subTest(scenario=scenario, backend=backend):
+                    finder = create_finder(pages, script_results, settings)
+                    # Twice, the incremental parse reuses the regions of the first cycle
+                    for _ in range(2):
+                        self.assertEqual(finder.check(), expected_dates)
+                        slots = {date: (date_slots.found, date_slots.alert, date_slots.window_count,
+                                        date_slots.disabled_count)
+                                 for date, date_slots in ((date, finder.slot_index.get(date)) for date in date_range)}
+                        self.assertEqual(slots, expected)
+
+
+class IncrementalSlotExtractorTest(unittest.TestCase):
+
+    DATES = get_dates(5)
+
+    def setUp(self):
+        self.extractor = IncrementalSlotExtractor()
+
+    def build_page(self, states: Dict[str, str]) -> str:
+        return build_page(list(states.items()), padding=5)
+
+    def extract(self, page: str) -> SlotIndex:
+        """ The incremental parse of the page, which has to match the full parse """
+        slot_index = self.extractor.extract(page)
+        self.assertEqual(slot_index.dates, SlotIndex.from_html(page).dates)
+        return slot_index
+
+    def assert_stats(self, **expected):
+        stats = self.extractor.get_stats()
+        self.assertEqual({name: stats[name] for name in expected}, expected)
+
+    def test_unchanged_page_is_not_parsed_again(self):
+        page = self.build_page({date: 'disabled' for date in self.DATES})
+        self.extract(page)
+        self.assert_stats(hits=0, misses=1, dates_parsed=5, dates_reused=0)
+        self.extract(page)
+        self.assert_stats(hits=1, misses=1, dates_parsed=5, dates_reused=5, full_parses=0)
+
+    def test_only_the_changed_date_is_parsed_again(self):
+        states = {date: 'disabled' for date in self.DATES}
+        self.extract(self.build_page(states))
+        states[self.DATES[2]] = 'open'
+        slot_index = self.extract(self.build_page(states))
+        self.assertEqual(slot_index.get_available_dates(self.DATES), [self.DATES[2]])
+        self.assert_stats(hits=0, misses=2, dates_parsed=6, dates_reused=4)
+
+    def test_added_and_removed_dates(self):
+        states = {date: 'disabled' for date in self.DATES[:4]}
+        self.extract(self.build_page(states))
+        # A new date at the end is parsed, the others are reused
+        states[self.DATES[4]] = 'open'
+        self.extract(self.build_page(states))
+        self.assert_stats(dates_parsed=5, dates_reused=4)
+        # A date that is no longer shown is left out of the index
+        del states[self.DATES[0]]
+        slot_index = self.extract(self.build_page(states))
+        self.assertNotIn(self.DATES[0], slot_index.dates)
+        self.assert_stats(hits=1, dates_parsed=5, dates_reused=8)
+
+    def test_page_without_delimited_containers_is_parsed_in_full(self):
+        page = self.build_page({date: 'open' for date in self.DATES})
+        # The last container is never closed
+        truncated = page[:page.rindex('</div></div></div>')]
+        self.extract(truncated)
+        self.assert_stats(full_parses=1, misses=1, dates_parsed=len(SlotIndex.from_html(truncated).dates))
+
+    def test_stats_are_exported_as_gauges(self):
+        page = self.build_page({date: 'disabled' for date in self.DATES})
+        snapshot = PageSnapshot('incremental-test', self.DATES, [(page, None)])
+        build_slot_index(snapshot, self.extractor)
+        build_slot_index(snapshot, self.extractor)
+        self.assertEqual(METRICS.gauges[('incremental_hits', (('account', 'incremental-test'),))], 1)
+        self.assertIn('slot_finder_incremental_dates_reused{account="incremental-test"} 5',
+                      METRICS.render_prometheus())
+
+
+if __name__ == '__main__':
+    unittest.main()
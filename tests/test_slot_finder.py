@@ -0,0 +1,106 @@
+"""
+    Tests of the browser recovery of the slot finder, on fake drivers
+"""
+import unittest
+from unittest import mock
+
+from selenium.common.exceptions import WebDriverException
+
+from benchmark import FakeClock, FakeSlotFinder, FakeWebDriver, build_page, get_dates
+from memory_usage import MemoryLimits
+from page_readiness import PageReadiness
+from slot_finder import AmazonSlotFinder, ChromeAmazonSlotFinder, NotLoggedInError
+
+DATES = get_dates(4)
+PAGES = [build_page([(date, 'open' if index == 2 else 'disabled') for index, date in enumerate(DATES)],
+                    padding=10)]
+SIGN_IN_URL = 'https://www.amazon.com/ap/signin?openid.return_to=shipoptionselect'
+
+
+class CrashedWebDriver(FakeWebDriver):
+    """ A browser whose window was closed """
+
+    def execute_script(self, script: str, *args):
+        raise WebDriverException('chrome not reachable')
+
+
+class RecoveringSlotFinder(FakeSlotFinder):
+    """ Starts the given drivers in turn when the browser is replaced """
+
+    def __init__(self, *drivers, memory_limits=None):
+        clock = FakeClock()
+        super().__init__(drivers[0], readiness=PageReadiness(clock=clock, sleep=clock.sleep),
+                         memory_limits=memory_limits)
+        self.drivers = list(drivers[1:])
+        self.logged_in = True
+        self.get_date_range = lambda: DATES
+
+    def create_driver(self):
+        return self.drivers.pop(0)
+
+
+@mock.patch('builtins.input', side_effect=AssertionError('A check must never prompt'))
+class RecoveryTest(unittest.TestCase):
+
+    def test_create_driver_is_abstract(self, _):
+        with self.assertRaises(TypeError):
+            AmazonSlotFinder(FakeWebDriver(PAGES)) # pylint: disable=abstract-class-instantiated
+
+    def test_crashed_browser_is_replaced(self, _):
+        replacement = FakeWebDriver(PAGES)
+        finder = RecoveringSlotFinder(CrashedWebDriver(PAGES), replacement)
+        with self.assertLogs('slot_finder', 'WARNING'):
+            self.assertEqual(finder.check(), DATES[2:3])
+        self.assertIs(finder.driver, replacement)
+        self.assertEqual(replacement.refreshes, 0) # The new browser has just loaded the page
+
+    def test_lost_session_is_reported_instead_of_prompting(self, _):
+        replacement = FakeWebDriver(PAGES)
+        replacement.current_url = SIGN_IN_URL
+        finder = RecoveringSlotFinder(CrashedWebDriver(PAGES), replacement)
+        with self.assertLogs('slot_finder', 'WARNING'), self.assertRaises(NotLoggedInError):
+            finder.check()
+        self.assertFalse(finder.logged_in)
+
+        # The browser is left on the sign in page until the user is back on the slot page
+        with self.assertRaises(NotLoggedInError):
+            finder.check()
+        replacement.current_url = AmazonSlotFinder.SLOT_PAGE_URL
+        self.assertEqual(finder.check(), DATES[2:3])
+        self.assertTrue(finder.logged_in)
+
+
+class RecycleTest(unittest.TestCase):
+
+    def test_recycles_a_browser_that_keeps_the_login(self):
+        replacement = FakeWebDriver(PAGES)
+        finder = RecoveringSlotFinder(FakeWebDriver(PAGES), replacement, memory_limits=MemoryLimits(recycle_checks=1))
+        finder.can_recycle = lambda: True
+        finder.check()
+        self.assertEqual(finder.check(), DATES[2:3])
+        self.assertIs(finder.driver, replacement)
+
+    def test_keeps_a_browser_that_cannot_be_recycled(self):
+        driver = FakeWebDriver(PAGES)
+        finder = RecoveringSlotFinder(driver, memory_limits=MemoryLimits(recycle_checks=1))
+        finder.check()
+        finder.check()
+        self.assertIs(finder.driver, driver)
+
+    def test_attached_browser_is_not_measured_or_recycled(self):
+        finder = ChromeAmazonSlotFinder.__new__(ChromeAmazonSlotFinder)
+        finder.driver = FakeWebDriver(PAGES)
+        finder.driver.service = mock.Mock()
+        finder.user_data_dir = '/profiles/a'
+        finder.debugger_address = None
+        self.assertTrue(finder.can_recycle())
+        self.assertIs(finder.get_driver_pid(), finder.driver.service.process.pid)
+
+        finder.debugger_address = '127.0.0.1:9222'
+        self.assertTrue(finder.can_resume_session())
+        self.assertFalse(finder.can_recycle())
+        self.assertIsNone(finder.get_driver_pid())
+
+
+if __name__ == '__main__':
+    unittest.main()
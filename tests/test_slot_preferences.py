@@ -0,0 +1,114 @@
+"""
+    Tests of the window label times and of the preference rules
+"""
+import unittest
+
+import yaml
+
+from slot_extraction import ATTENDED, UNATTENDED, DateSlots, TimeWindow, parse_minutes
+from slot_preferences import PreferenceRule, SlotPreferences, parse_time_of_day
+
+SATURDAY = '2026-10-17'
+MONDAY = '2026-10-19'
+
+
+def build_slots(date: str, *windows: TimeWindow) -> DateSlots:
+    unattended = [window for window in windows if window.delivery_type == UNATTENDED]
+    return DateSlots(date, found=True, window_count=len(unattended),
+                     disabled_count=sum(1 for window in unattended if not window.enabled), windows=windows)
+
+
+class ParseMinutesTest(unittest.TestCase):
+
+    def test_window_labels(self):
+        labels = {
+            '8:00 AM - 10:00 AM': (480, 600),
+            '8 - 10 AM': (480, 600),
+            '11:00 AM - 1:00 PM': (660, 780),
+            '11 - 1 PM': (660, 780),
+            '12:00 PM - 2:00 PM': (720, 840),
+            '10:00 PM - 12:00 AM': (1320, 1440),
+            '13:00 - 15:00': (780, 900),
+            '22:00 - 00:00': (1320, 1440),
+            '9:00 - 11:00': (540, 660),
+            'Morning': (-1, -1),
+            'Before 10:00 AM': (-1, -1),
+        }
+        for label, minutes in labels.items():
+            with self.subTest(label=label):
+                self.assertEqual(parse_minutes(label), minutes)
+
+
+class ParseTimeOfDayTest(unittest.TestCase):
+
+    def test_times_and_hours(self):
+        self.assertEqual(parse_time_of_day('08:00'), 480)
+        self.assertEqual(parse_time_of_day('17:30'), 1050)
+        self.assertEqual(parse_time_of_day('9'), 540)
+        self.assertEqual(parse_time_of_day(17), 1020)
+        self.assertEqual(parse_time_of_day(17.5), 1050)
+        self.assertEqual(parse_time_of_day(0), 0)
+
+    def test_unquoted_time_is_refused(self):
+        rules = yaml.safe_load('- name: evenings\n  from: 17:30\n')
+        self.assertEqual(rules[0]['from'], 1050) # What YAML makes of it
+        with self.assertRaisesRegex(ValueError, 'from of the preference evenings.*"17:30"'):
+            SlotPreferences.from_config(rules)
+        for value in (24, 90, -1, 100000):
+            with self.subTest(value=value), self.assertRaisesRegex(ValueError, 'in quotes'):
+                parse_time_of_day(value)
+
+
+class PreferenceRuleTest(unittest.TestCase):
+
+    def test_time_range_and_delivery_type(self):
+        rule = PreferenceRule.from_dict({'from': '08:00', 'until': '12:00'})
+        self.assertTrue(rule.matches_window(TimeWindow(UNATTENDED, True, '8:00 AM - 10:00 AM')))
+        self.assertTrue(rule.matches_window(TimeWindow(UNATTENDED, True, '10:00 AM - 12:00 PM')))
+        self.assertFalse(rule.matches_window(TimeWindow(UNATTENDED, True, '11:00 AM - 1:00 PM')))
+        self.assertFalse(rule.matches_window(TimeWindow(UNATTENDED, True, '7:00 AM - 9:00 AM')))
+        self.assertFalse(rule.matches_window(TimeWindow(UNATTENDED, False, '8:00 AM - 10:00 AM')))
+        self.assertFalse(rule.matches_window(TimeWindow(ATTENDED, True, '8:00 AM - 10:00 AM')))
+        self.assertFalse(rule.matches_window(TimeWindow(UNATTENDED, True, 'Morning')))
+
+    def test_days_and_min_windows(self):
+        rule = PreferenceRule.from_dict({'days': ['Saturday', 'sun'], 'delivery': 'any', 'min_windows': 2})
+        windows = (TimeWindow(ATTENDED, True, '8:00 AM - 10:00 AM'), TimeWindow(UNATTENDED, True, 'Morning'))
+        self.assertTrue(rule.matches(build_slots(SATURDAY, *windows), 5))
+        self.assertFalse(rule.matches(build_slots(SATURDAY, *windows[:1]), 5))
+        self.assertFalse(rule.matches(build_slots(MONDAY, *windows), 0))
+
+    def test_unknown_delivery_type(self):
+        with self.assertRaises(ValueError):
+            PreferenceRule.from_dict({'delivery': 'drone'})
+
+
+class SlotPreferencesTest(unittest.TestCase):
+
+    def test_any_rule_matches(self):
+        preferences = SlotPreferences.from_config(yaml.safe_load('''
+            - name: weekday mornings
+              days: [mon, tue, wed, thu, fri]
+              from: '08:00'
+              until: '12:00'
+            - name: weekend evenings
+              days: [sat, sun]
+              delivery: any
+              from: '17:00'
+        '''))
+        morning = TimeWindow(UNATTENDED, True, '9:00 AM - 11:00 AM')
+        evening = TimeWindow(ATTENDED, True, '6:00 PM - 8:00 PM')
+        self.assertTrue(preferences.matches(build_slots(MONDAY, morning)))
+        self.assertFalse(preferences.matches(build_slots(MONDAY, evening)))
+        self.assertTrue(preferences.matches(build_slots(SATURDAY, evening)))
+        self.assertFalse(preferences.matches(build_slots(SATURDAY, morning)))
+
+    def test_without_rules_any_open_unattended_window(self):
+        preferences = SlotPreferences()
+        self.assertTrue(preferences.matches(build_slots(MONDAY, TimeWindow(UNATTENDED, True, 'Morning'))))
+        self.assertFalse(preferences.matches(build_slots(MONDAY, TimeWindow(UNATTENDED, False, 'Morning'),
+                                                         TimeWindow(ATTENDED, True, 'Morning'))))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+"""
+    Tests of the snapshot archive: recording pages or their slot containers and replaying them
+"""
+import os
+import tempfile
+import unittest
+
+from benchmark import build_page, get_dates, get_script_results
+from pipeline import PageSnapshot
+from snapshot_archive import RECORD_PAGE, RECORD_SLOTS, SnapshotArchive, SnapshotRecorder, replay
+
+DATES = get_dates(4)
+OPEN_PAGE = build_page([(date, 'open' if index == 2 else 'disabled') for index, date in enumerate(DATES)], padding=5)
+CLOSED_PAGE = build_page([(date, 'disabled') for date in DATES], padding=5)
+
+
+class SnapshotArchiveTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.archive = SnapshotArchive(os.path.join(directory.name, 'snapshots'))
+
+    def record(self, mode: str, account: str, *pages):
+        SnapshotRecorder(self.archive, mode).record(PageSnapshot(account, DATES, pages))
+
+    def count_objects(self) -> int:
+        return sum(len(files) for _, _, files in os.walk(self.archive.objects_dir))
+
+    def test_replay_finds_the_recorded_dates(self):
+        self.record(RECORD_PAGE, 'a', (CLOSED_PAGE, None))
+        self.record(RECORD_PAGE, 'a', (OPEN_PAGE, None))
+        self.record(RECORD_SLOTS, 'b', (OPEN_PAGE, None))
+        self.record(RECORD_SLOTS, 'b', (OPEN_PAGE, None))
+        self.record(RECORD_PAGE, 'c', (None, get_script_results([OPEN_PAGE])[0]))
+        # Two whole pages, the four containers of the open page and one script result
+        self.assertEqual(self.count_objects(), 7)
+
+        for use_processes in (False, True):
+            with self.subTest(use_processes=use_processes):
+                report = replay(self.archive, workers=2, use_processes=use_processes)
+                self.assertEqual([(result.account, result.available_dates, result.dates_found)
+                                  for result in report.results],
+                                 [('a', [], 4), ('a', [DATES[2]], 4), ('b', [DATES[2]], 4), ('b', [DATES[2]], 4),
+                                  ('c', [DATES[2]], 4)])
+                self.assertEqual(report.errors, 0)
+
+        self.assertEqual([result.available_dates for result in replay(self.archive, account='b', workers=1,
+                                                                      use_processes=False).results],
+                         [[DATES[2]], [DATES[2]]])
+
+    def test_replay_counts_the_snapshots_it_cannot_load(self):
+        self.record(RECORD_PAGE, 'a', (OPEN_PAGE, None))
+        self.record(RECORD_PAGE, 'a', (CLOSED_PAGE, None))
+        entries = list(self.archive.iter_entries())
+        os.unlink(self.archive._get_object_path(entries[1]['pages'][0]['source'])) # pylint: disable=protected-access
+        with open(self.archive.index_file, 'a', encoding='utf-8') as index_file:
+            index_file.write('{"account": "a", "cut short\n')
+
+        with self.assertLogs('snapshot_archive', 'WARNING'):
+            report = replay(self.archive, workers=1, use_processes=False)
+        self.assertEqual([result.available_dates for result in report.results], [[DATES[2]], []])
+        self.assertEqual(report.errors, 1)
+        self.assertIn('FileNotFoundError', report.results[1].error)
+
+
+if __name__ == '__main__':
+    unittest.main()